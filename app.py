@@ -1,38 +1,204 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
-from openai import OpenAI
+from werkzeug.middleware.proxy_fix import ProxyFix
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import openai
+import httpx
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 import io
+import asyncio
 import json
 import time
 import math
+import random
 import secrets
 import re
+import base64
+import hashlib
+import importlib.util
+import email.utils
+import unicodedata
+import heapq
+import inspect
+import sqlite3
+import tempfile
+import threading
+from types import SimpleNamespace
+from collections import OrderedDict, deque
+
+import numpy as np
 
 app = Flask(__name__)
-CORS(app, origins=[
+CORS_ORIGINS = [
     "https://drsprinter.github.io",
     "https://drsprinter.github.io/nail_sample",
     "http://localhost:5500"
-])
+]
+CORS(app, origins=CORS_ORIGINS)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Render などの TLS 終端プロキシの後ろでは request.url_root が http:// になり、画像 URL が mixed content になる。
+# X-Forwarded-Proto / X-Forwarded-For を信じるプロキシの段数。既定は 0（信じない。直に叩かれたときに偽装されないように）。
+# プロキシの後ろに置くデプロイで TRUSTED_PROXY_HOPS=1 などを明示するか、PUBLIC_BASE_URL を設定する
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
 
 # =========================================================
 # 0) Utilities
 # =========================================================
 
-def safe_extract_json(text: str) -> dict:
-    t = (text or "").strip()
-    if t.startswith("```"):
-        parts = t.split("```")
-        if len(parts) >= 2:
-            t = parts[1].strip()
-    start = t.find("{")
-    end = t.rfind("}")
-    if start == -1 or end == -1:
-        raise ValueError("JSONが見つかりませんでした: " + (text[:200] if text else ""))
-    return json.loads(t[start:end+1])
+# response_format={"type": "json_object"} を付けるモデル（JSON モードがあるもの）
+JSON_MODE_MODELS = {m.strip() for m in os.getenv("JSON_MODE_MODELS", "gpt-4o-mini,gpt-4o").split(",") if m.strip()}
+TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+def json_mode(req: dict) -> dict:
+    """chat.completions の引数に JSON モードを足す（対応モデルだけ）"""
+    if req.get("model") in JSON_MODE_MODELS:
+        req["response_format"] = {"type": "json_object"}
+    return req
+
+def close_json(t: str) -> str:
+    """
+    途中で切れた JSON の文字列/配列/オブジェクトを閉じる（末尾のカンマ・コロンは落とす）
+    """
+    stack, in_str, esc = [], False, False
+    for ch in t:
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == "\\":
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_str:
+        t += '"'
+    return t.rstrip().rstrip(",:").rstrip() + "".join(reversed(stack))
+
+def tolerant_json_loads(t: str) -> dict:
+    """
+    json.loads -> 末尾カンマを消して再挑戦 -> 途中で切れていれば閉じて、ダメなら最後の要素を削りながら再挑戦
+    """
+    for s in (t, TRAILING_COMMA_RE.sub(r"\1", t)):
+        try:
+            v = json.loads(s)
+            return v if isinstance(v, dict) else {}
+        except ValueError:
+            pass
+    s = t
+    while s:
+        try:
+            v = json.loads(TRAILING_COMMA_RE.sub(r"\1", close_json(s)))
+            return v if isinstance(v, dict) else {}
+        except ValueError:
+            cut = s.rfind(",")
+            if cut <= 0:
+                return {}
+            s = s[:cut]
+    return {}
+
+class JsonStreamParser:
+    """
+    ストリームで届くトークンを feed していき、最初のトップレベル JSON オブジェクトが閉じた時点で done
+    （後ろに続く解説文は読まなくてよい）。途中でも partial() でそこまでの内容を取れる
+    """
+    def __init__(self):
+        self.text = ""
+        self.start = -1
+        self.end = -1
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+
+    @property
+    def done(self) -> bool:
+        return self.end >= 0
+
+    def feed(self, chunk: str) -> bool:
+        pos = len(self.text)
+        self.text += chunk or ""
+        for i in range(pos, len(self.text)):
+            if self.done:
+                break
+            ch = self.text[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif self.start < 0:
+                if ch == "{":
+                    self.start, self._depth = i, 1
+            elif ch == '"':
+                self._in_str = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.end = i + 1
+        return self.done
+
+    def partial(self) -> dict:
+        if self.start < 0:
+            return {}
+        return tolerant_json_loads(self.text[self.start:self.end if self.done else len(self.text)])
+
+    def fields(self) -> dict:
+        """
+        書き終わったトップレベルのフィールドだけ（書きかけの最後のキーは除く）
+        """
+        obj = self.partial()
+        if not self.done and obj:
+            obj.pop(list(obj)[-1])
+        return obj
+
+class TruncatedJsonError(ValueError):
+    """返答が途中で切れている（finish_reason == "length" か、JSON オブジェクトが閉じていない）"""
+
+def cut_off(res) -> bool:
+    """chat.completions の返答が max_tokens などで打ち切られたか"""
+    choices = getattr(res, "choices", None) or []
+    return bool(choices) and getattr(choices[0], "finish_reason", None) == "length"
+
+def safe_extract_json(text: str, drop_cut_field: bool = False, strict: bool = False) -> dict:
+    """
+    LLM の返答から JSON オブジェクトを取り出す。コードフェンスや前後の解説文（{} を含んでいても）は無視し、
+    壊れていれば（末尾カンマ・途中で切れている）直せる範囲で直す。何も取れなければ ValueError
+    drop_cut_field=True なら、途中で切れていたときの書きかけの最後のフィールドは捨てる（JsonStreamParser.fields）
+    strict=True なら、途中で切れていたときは直さずに TruncatedJsonError
+    """
+    t = text or ""
+    decoder = json.JSONDecoder()
+    i = t.find("{")
+    while i >= 0:
+        try:
+            v, _ = decoder.raw_decode(t, i)
+            if isinstance(v, dict):
+                return v
+        except ValueError:
+            parser = JsonStreamParser()
+            parser.feed(t[i:])
+            v = parser.partial()
+            if v:
+                if parser.done:
+                    return v
+                if strict:
+                    raise TruncatedJsonError("JSONが途中で切れています: " + t[i:i + 200])
+                return parser.fields() if drop_cut_field else v
+        i = t.find("{", i + 1)
+    raise ValueError("JSONが見つかりませんでした: " + (text[:200] if text else ""))
+
+def query_flag(value) -> bool:
+    return str(value or "").strip().lower() in ("1", "true", "yes")
 
 def form_to_dict(req_form) -> dict:
     data = {}
@@ -77,98 +243,887 @@ def safe_int(x, default=0):
         return default
 
 # =========================================================
-# 1) Persona registry (readable by persona_id)
+# 0.5) Upload image preprocessing
 # =========================================================
 
-DEFAULT_PERSONA_ID = "nailist_01"
-
-PERSONA_REGISTRY = {
-    "nailist_01": {
-        "persona_id": "nailist_01",
-        "display_name": "そのちゃん",
-        "tagline": "お友達",
-        "voice": {
-            "tone": "柔らかい。男前感もあるさっぱりさ。",
-            "style_keywords": ["上品", "透明感", "うる艶", "抜け感"],
-            "avoid_phrases": ["ギャルすぎ", "盛る", "ゴテゴテ"]
-        },
-        "design_policy": {
-            "must_keep": [
-                "Keep customer's selected options first: vibe, purpose, avoid_colors, nail_duration, age",
-                "Not overly eccentric; aim for ~80% freshness (discover a new side but wearable)",
-                "Adjust daily-fit depending on purpose (work/daily=subtle, event=slightly playful but elegant)",
-                "Do not lean too heavily toward plain beige monochrome; keep it moderately vivid and lively",
-                "Use stones/glitter/art appropriately with ONE tasteful accent point"
-            ],
-            "signature_moves": [
-                "Sheer / milky base with 'churun' glossy finish to make hands look clean and beautiful",
-                "Gradient or jelly-like translucency (soft ombre) to add depth without looking heavy",
-                "Modern French variations: thin French, diagonal French, glitter French, color French (kept elegant)",
-                "Micro-glitter / aurora / subtle magnetic shine used softly (never too flashy)",
-                "Fine mirror/metallic line accents to sharpen the look while keeping it minimal",
-                "One-nail (or max two nails) accent: bijou/stone, small charm, or delicate art as a focal point",
-                "When using motifs/characters, limit color count and keep the overall palette cohesive and clean"
-            ],
-            "taboo": [
-                "Overloaded decoration on all nails (too many stones, heavy glitter, 3D everywhere)",
-                "Too many colors with no cohesion (scattered look)",
-                "Neon / overly saturated primary colors used as full coverage without balance",
-                "Flat heavy matte finish across all nails (prefers glossy / sheer look)",
-                "Solid black full set without design intent (black is fine as an accent/art element)"
-            ],
-            "accent_rules": {
-                "max_accent_nails": 2,
-                "accent_types_preferred": [
-                    "micro_glitter",
-                    "aurora",
-                    "magnet",
-                    "mirror_line",
-                    "thin_french",
-                    "subtle_stone",
-                    "bijou_one_nail",
-                    "small_charm",
-                    "minimal_art",
-                    "hand drawing art"
-                ],
-                "accent_intensity": 0.40,
-                "placement_notes": "Either 'one focal point' (bijou on 1 nail) OR 'soft distributed shine' (micro glitter/aurora on multiple nails), but avoid half-hearted scattered accents."
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") != "0"
+IMAGE_TARGET_SIZE = int(os.getenv("IMAGE_TARGET_SIZE", "1024"))  # images.edit の size と揃える
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "90"))
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow が無ければアップロードをそのまま使う
+    Image = None
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:  # 無ければ HEIC は 400（images.edit も読めないので、そのまま渡さない）
+    pass
+
+HEIF_BRANDS = {b"heic", b"heix", b"hevc", b"hevx", b"heim", b"heis", b"mif1", b"msf1"}
+
+def is_heif(img_bytes: bytes) -> bool:
+    """iPhone の HEIC など（ISO BMFF の ftyp ボックスのブランドで見る）"""
+    return img_bytes[4:8] == b"ftyp" and img_bytes[8:12] in HEIF_BRANDS
+
+def image_filename(img_bytes: bytes) -> str:
+    """
+    images.edit に渡すファイル名（拡張子で形式が判定されるので中身から決める）
+    """
+    head = img_bytes[:16]
+    if head.startswith(b"\x89PNG"):
+        return "nail.png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "nail.webp"
+    return "nail.jpg"
+
+def preprocess_upload(img_bytes: bytes) -> bytes:
+    """
+    アップロード直後に1回だけ: EXIF回転を反映 -> 中央で正方形に切り抜き ->
+    IMAGE_TARGET_SIZE まで縮小 -> JPEG で再エンコード
+    読めない形式（Pillow 無し等）は元のバイトのまま返す。ただし HEIC は JPEG に直せなければ GameInputError
+    """
+    if not IMAGE_PREPROCESS or Image is None:
+        return check_heif(img_bytes)
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as im:
+            # JPEG は DCT 段階で縮小デコードできる（12MP でも速い）
+            im.draft("RGB", (IMAGE_TARGET_SIZE, IMAGE_TARGET_SIZE))
+            im = ImageOps.exif_transpose(im)
+            if im.mode in ("RGBA", "LA", "P"):
+                im = im.convert("RGBA")
+                bg = Image.new("RGB", im.size, (255, 255, 255))
+                bg.paste(im, mask=im.split()[-1])
+                im = bg
+            elif im.mode != "RGB":
+                im = im.convert("RGB")
+
+            side = min(im.size)
+            target = min(side, IMAGE_TARGET_SIZE)
+            im = ImageOps.fit(im, (target, target), method=Image.LANCZOS, centering=(0.5, 0.5))
+
+            out = io.BytesIO()
+            im.save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+            return out.getvalue()
+    except Exception:
+        return check_heif(img_bytes)
+
+def check_heif(img_bytes: bytes) -> bytes:
+    """変換できなかった HEIC を nail.jpg として images.edit に渡さない"""
+    if is_heif(img_bytes):
+        raise GameInputError("HEIC の写真を読み込めませんでした。JPEG か PNG で送ってください")
+    return img_bytes
+
+# =========================================================
+# 0.6) LLM response cache (content-addressed)
+# =========================================================
+
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", "")  # 空なら永続層なし（メモリのみ）
+FREE_SPEC_CACHE_SIZE = int(os.getenv("FREE_SPEC_CACHE_SIZE", "2048"))
+FREE_SPEC_CACHE_TTL_SEC = float(os.getenv("FREE_SPEC_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+
+def cache_key(*parts) -> str:
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def cache_allowed(cache_control: str = "", no_cache: str = "") -> bool:
+    """
+    リクエスト単位のキャッシュ無効化: Cache-Control: no-cache/no-store か ?no_cache=1
+    """
+    cc = (cache_control or "").lower()
+    if "no-cache" in cc or "no-store" in cc:
+        return False
+    return str(no_cache or "").strip().lower() not in ("1", "true", "yes")
+
+class ResponseCache:
+    """
+    LLM応答のキャッシュ。メモリ LRU + 任意の SQLite 永続層（どちらも TTL 付き）
+    値は JSON で持つので、get で返るのは毎回新しいオブジェクト
+    """
+    def __init__(self, name: str, max_items: int, ttl_sec: float, db_path: str = ""):
+        self.name = name
+        self.max_items = max_items
+        self.ttl_sec = ttl_sec
+        self.db_path = db_path
+        self._data = OrderedDict()  # key -> (expires, json)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._persistent_hits = 0
+        self._misses = 0
+        if db_path:
+            with self._connect() as con:
+                con.execute("PRAGMA journal_mode=WAL")
+                con.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    " name TEXT NOT NULL, key TEXT NOT NULL, expires REAL NOT NULL, value TEXT NOT NULL,"
+                    " PRIMARY KEY (name, key))"
+                )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _remember(self, key: str, expires: float, raw: str):
+        # lock 内から呼ぶ
+        self._data[key] = (expires, raw)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_items:
+            self._data.popitem(last=False)
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(key)
+                self._hits += 1
+                return json.loads(item[1])
+            if item is not None:
+                del self._data[key]
+
+        row = None
+        if self.db_path:
+            try:
+                with self._connect() as con:
+                    row = con.execute(
+                        "SELECT expires, value FROM llm_cache WHERE name = ? AND key = ? AND expires > ?",
+                        (self.name, key, now)
+                    ).fetchone()
+            except sqlite3.Error:
+                row = None
+
+        with self._lock:
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._persistent_hits += 1
+            self._remember(key, row[0], row[1])
+        return json.loads(row[1])
+
+    def put(self, key: str, value):
+        expires = time.time() + self.ttl_sec
+        raw = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, expires, raw)
+        if self.db_path:
+            try:
+                with self._connect() as con:
+                    con.execute(
+                        "INSERT OR REPLACE INTO llm_cache (name, key, expires, value) VALUES (?, ?, ?, ?)",
+                        (self.name, key, expires, raw)
+                    )
+                    con.execute("DELETE FROM llm_cache WHERE name = ? AND expires <= ?", (self.name, time.time()))
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_items": self.max_items,
+                "hits": self._hits,
+                "persistent_hits": self._persistent_hits,
+                "misses": self._misses,
             }
-        },
-        "params": {
-            "risk": 0.6,
-            "daily_fit": 0.70,
-            "trend": 0.70,
-            "minimal": 0.7,
-            "sparkle": 0.40,
-            "vivid": 0.4,
-            "safety": 1.0
-        },
-        "color_direction": {
-            "base_palette_notes": "Milky white, sheer beige, greige, dusty pink, soft mauve, light gray, pale blue. Prioritize translucency and hand-brightening tones.",
-            "allowed_accents_notes": "Silver/gold mirror lines, aurora/iridescent shine, subtle magnetic shimmer. Navy/blue as a clean 'tightening' color. Burgundy/red for seasonal/event moods (kept elegant).",
-            "avoid_palette_notes": "Neon full coverage, overly saturated primary colors without balance, muddy/dark heavy full-coverage sets that lose translucency."
-        },
-        "format_constraints": {
-            "output_language": "ja",
-            "plan_format": [
-                "【ネイルコンセプト】...",
-                "【デザイン詳細】..."
-            ],
-            "length_hint": "全体で250〜450文字目安"
-        }
-    }
+
+# =========================================================
+# 0.7) Metrics (Prometheus text format, in-process)
+# =========================================================
+# プロセスごとの集計（gunicorn などで複数ワーカーにしたらワーカーごとの値になる）
+
+STAGE_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60]
+
+def _label_text(labels: tuple, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {v:g}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: list = STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = list(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        i = next((j for j, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with self._lock:
+            s = self._series.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0, 0])
+            s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, s in sorted(self._series.items()):
+                cum = 0
+                for b, n in zip(self.buckets + ["+Inf"], s[:-2]):
+                    cum += n
+                    le = 'le="%s"' % b
+                    lines.append(f"{self.name}_bucket{_label_text(key, le)} {cum}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {s[-2]:.6f}")
+                lines.append(f"{self.name}_count{_label_text(key)} {s[-1]}")
+        return lines
+
+class Gauge:
+    """
+    /metrics を出すときに collect() で今の値を取る（キャッシュやストアの stats() 用）
+    collect() は [(labels dict, 値), ...]。取れなかったらその回は何も出さない
+    """
+    def __init__(self, name: str, help_text: str, collect):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            samples = list(self.collect())
+        except Exception:
+            samples = []
+        for labels, v in samples:
+            lines.append(f"{self.name}{_label_text(tuple(sorted(labels.items())))} {v:.15g}")
+        return lines
+
+def stats_samples(label: str, sources: dict):
+    """{名前: stats() を持つもの} -> Gauge 用の [({label: 名前, "stat": キー}, 値), ...]（数値だけ）"""
+    for name, obj in sources.items():
+        for stat, v in obj.stats().items():
+            if isinstance(v, (int, float)):
+                yield {label: name, "stat": stat}, v
+
+STAGE_SECONDS = Histogram("nail_stage_seconds", "Wall time per finalize stage / Bayesian step")
+STAGE_ERRORS = Counter("nail_stage_errors_total", "Stage failures (including ones that fell back)")
+LLM_TOKENS = Counter("nail_llm_tokens_total",
+                     "Tokens reported in res.usage (estimated for streams cut off before the usage chunk), by stage and kind")
+LLM_RETRIES = Counter("nail_llm_retries_total", "OpenAI call retries, by stage")
+METRICS = [STAGE_SECONDS, STAGE_ERRORS, LLM_TOKENS, LLM_RETRIES]
+
+def render_metrics() -> str:
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+class observe_stage:
+    """
+    with observe_stage("eval"): ...  -> 所要時間を STAGE_SECONDS に、例外なら STAGE_ERRORS に
+    timings（dict）を渡すとリクエスト単位の内訳にも書く
+    """
+    def __init__(self, stage: str, timings: dict = None, origin: float = None):
+        self.stage = stage
+        self.timings = timings
+        self.origin = origin
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        sec = time.perf_counter() - self.t0
+        STAGE_SECONDS.observe(sec, stage=self.stage)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):  # 打ち切った投機ステージは失敗ではない
+            STAGE_ERRORS.inc(stage=self.stage)
+        if self.timings is not None:
+            self.timings[self.stage] = {
+                "start_ms": round(1000 * (self.t0 - self.origin), 1) if self.origin is not None else None,
+                "ms": round(1000 * sec, 1),
+            }
+        return False
+
+def record_usage(stage: str, res):
+    """chat.completions（prompt/completion）と images（input/output）の usage を数える"""
+    usage = getattr(res, "usage", None)
+    if usage is None:
+        return
+    for kind, attr in (("prompt", "prompt_tokens"), ("completion", "completion_tokens"),
+                       ("prompt", "input_tokens"), ("completion", "output_tokens")):
+        n = getattr(usage, attr, None)
+        if isinstance(n, (int, float)) and n:
+            LLM_TOKENS.inc(n, stage=stage, kind=kind)
+
+def record_error(stage: str):
+    STAGE_ERRORS.inc(stage=stage)
+
+# =========================================================
+# 0.8) OpenAI clients (pools / timeouts / retries)
+# =========================================================
+# 小さい chat と大きい multipart の images.edit を別プールに分けて、画像アップロードが
+# chat の接続を塞がないようにする。httpx のクライアントはスレッドからも asyncio の
+# タスクからも共有してよいので、(kind, sync/async) ごとに1つだけ作って使い回す。
+
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "1") != "0" and importlib.util.find_spec("h2") is not None  # pip install h2
+OPENAI_POOL_SIZE = {
+    "chat": int(os.getenv("OPENAI_CHAT_POOL_SIZE", "64")),
+    "image": int(os.getenv("OPENAI_IMAGE_POOL_SIZE", "16")),
+}
+OPENAI_KEEPALIVE_SEC = float(os.getenv("OPENAI_KEEPALIVE_SEC", "30"))
+OPENAI_CONNECT_TIMEOUT_SEC = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SEC", "5"))
+# ステージごとの読み取りタイムアウト（images.edit はアップロードも長いので write も同じ値）
+OPENAI_STAGE_TIMEOUT_SEC = {
+    "free_spec": float(os.getenv("OPENAI_TIMEOUT_FREE_SPEC_SEC", "20")),
+    "candidate": float(os.getenv("CANDIDATE_TIMEOUT_SEC", "60")),
+    "eval": float(os.getenv("OPENAI_TIMEOUT_EVAL_SEC", "60")),
+    "edit_prompt": float(os.getenv("OPENAI_TIMEOUT_EDIT_PROMPT_SEC", "30")),
+    "image": float(os.getenv("OPENAI_TIMEOUT_IMAGE_SEC", "180")),
+}
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE_SEC = float(os.getenv("OPENAI_RETRY_BASE_SEC", "0.5"))
+OPENAI_RETRY_MAX_SEC = float(os.getenv("OPENAI_RETRY_MAX_SEC", "8"))
+OPENAI_RETRY_AFTER_MAX_SEC = float(os.getenv("OPENAI_RETRY_AFTER_MAX_SEC", "30"))  # これより長く待てと言われたら諦める
+RETRY_STATUSES = {408, 409, 429}
+
+def stage_timeout(stage: str) -> httpx.Timeout:
+    return httpx.Timeout(OPENAI_STAGE_TIMEOUT_SEC[stage], connect=OPENAI_CONNECT_TIMEOUT_SEC)
+
+def openai_http_client(kind: str, is_async: bool = False):
+    limits = httpx.Limits(
+        max_connections=OPENAI_POOL_SIZE[kind],
+        max_keepalive_connections=OPENAI_POOL_SIZE[kind],
+        keepalive_expiry=OPENAI_KEEPALIVE_SEC,
+    )
+    timeout = stage_timeout("image" if kind == "image" else "eval")
+    cls = DefaultAsyncHttpxClient if is_async else DefaultHttpxClient
+    return cls(limits=limits, timeout=timeout, http2=OPENAI_HTTP2)
+
+_OPENAI_CLIENTS = {}
+_OPENAI_CLIENTS_LOCK = threading.Lock()
+
+def openai_client(kind: str = "chat", is_async: bool = False):
+    """
+    kind は "chat" / "image"。SDK の再試行は切って call_with_retry 側でやる
+    """
+    key = (kind, is_async)
+    with _OPENAI_CLIENTS_LOCK:
+        if key not in _OPENAI_CLIENTS:
+            cls = AsyncOpenAI if is_async else OpenAI
+            _OPENAI_CLIENTS[key] = cls(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                max_retries=0,
+                http_client=openai_http_client(kind, is_async),
+            )
+        return _OPENAI_CLIENTS[key]
+
+def retry_after_sec(headers):
+    """retry-after-ms / retry-after（秒 or HTTP 日付）-> 秒。なければ None"""
+    if headers is None:
+        return None
+    try:
+        return float(headers.get("retry-after-ms")) / 1000.0
+    except (TypeError, ValueError):
+        pass
+    ra = headers.get("retry-after")
+    if not ra:
+        return None
+    try:
+        return float(ra)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(ra).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(e: Exception, attempt: int):
+    """
+    再試行までの待ち秒（再試行しないなら None）。Retry-After があればそれ、なければ full jitter
+    """
+    if attempt >= OPENAI_MAX_RETRIES:
+        return None
+    if isinstance(e, openai.APIStatusError):
+        headers = e.response.headers
+        if headers.get("x-should-retry") == "false":
+            return None
+        if e.status_code not in RETRY_STATUSES and e.status_code < 500:
+            return None
+        wait_sec = retry_after_sec(headers)
+        if wait_sec is not None:
+            if wait_sec > OPENAI_RETRY_AFTER_MAX_SEC:
+                return None
+            return wait_sec + random.uniform(0, OPENAI_RETRY_BASE_SEC)
+    elif not isinstance(e, openai.APIConnectionError):  # APITimeoutError もここ
+        return None
+    return random.uniform(0, min(OPENAI_RETRY_MAX_SEC, OPENAI_RETRY_BASE_SEC * 2 ** attempt))
+
+def rate_limit_pause(e: Exception, delay) -> float:
+    """
+    429 のとき枠全体を止める秒数。Retry-After があれば（再試行しない長さでも）それに従う
+    """
+    wait_sec = retry_after_sec(e.response.headers) if isinstance(e, openai.APIStatusError) else None
+    if wait_sec is not None:
+        return wait_sec
+    return delay if delay is not None else OPENAI_RETRY_BASE_SEC
+
+def estimate_tokens(req: dict) -> int:
+    """
+    TPM の予約用のざっくり見積もり（日本語混じりなので 2文字 ≒ 1トークン + 返答ぶん）
+    """
+    chars = sum(len(str(m.get("content", ""))) for m in req.get("messages") or [])
+    return chars // 2 + UPSTREAM_COMPLETION_TOKENS
+
+def record_stream_usage(stage: str, usage_chunk, req: dict, text: str):
+    """
+    stream=True の usage を数える。include_usage の最後の chunk まで読まずに切ったときは
+    estimate_tokens と同じ 2文字 ≒ 1トークンで見積もる
+    """
+    if usage_chunk is not None:
+        record_usage(stage, usage_chunk)
+        return
+    LLM_TOKENS.inc(max(0, estimate_tokens(req) - UPSTREAM_COMPLETION_TOKENS), stage=stage, kind="prompt")
+    if text:
+        LLM_TOKENS.inc(len(text) // 2, stage=stage, kind="completion")
+
+def acquire_speculative(limiter, tokens: int, cancelled):
+    """投機呼び出しの枠取り: 負けが決まっていたり、すぐに取れる枠が無ければ SpeculationSkipped"""
+    if cancelled.is_set() or not limiter.try_acquire(tokens):
+        raise SpeculationSkipped()
+
+def call_with_retry(stage: str, fn, tokens: int = 0, consume=None, cancelled=None):
+    """
+    fn() を上流の枠（UPSTREAM_LIMITERS）を取ってから呼び、失敗したら retry_delay に従って再試行する
+    consume を渡すと fn() の戻り値（stream=True のストリームなど）を枠を持ったまま読み切り、その結果を返す
+    cancelled（threading.Event）を渡すと投機呼び出し: 枠は待たずに取れるときだけ取り、
+    再試行の前にも見て、立っていれば SpeculationSkipped（スレッドは止められないので、投げる前に止める）
+    """
+    limiter = upstream_limiter(stage)
+    attempt = 0
+    while True:
+        if cancelled is None:
+            limiter.acquire(tokens)
+        else:
+            acquire_speculative(limiter, tokens, cancelled)
+        try:
+            res = fn()
+            return consume(res) if consume else res
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(rate_limit_pause(e, delay))
+            if delay is None:
+                raise
+        finally:
+            limiter.release()
+        LLM_RETRIES.inc(stage=stage)
+        time.sleep(delay)
+        attempt += 1
+
+async def call_with_retry_async(stage: str, fn, tokens: int = 0, consume=None, cancelled=None):
+    limiter = upstream_limiter(stage)
+    attempt = 0
+    while True:
+        if cancelled is None:
+            await limiter.acquire_async(tokens)
+        else:
+            acquire_speculative(limiter, tokens, cancelled)
+        try:
+            res = await fn()
+            return (await consume(res)) if consume else res
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if isinstance(e, openai.RateLimitError):
+                limiter.pause(rate_limit_pause(e, delay))
+            if delay is None:
+                raise
+        finally:
+            limiter.release()
+        LLM_RETRIES.inc(stage=stage)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+client = openai_client("chat")
+image_client = openai_client("image")
+
+# =========================================================
+# 0.9) Upstream rate limits / admission control
+# =========================================================
+# chat と image で別々に「同時実行数 + RPM + TPM」の枠を持つ（0 は無制限）。
+# 枠待ちの列は長さに上限があり、あふれたら待たずに UpstreamBusy（retry_after 付き）。
+# ルートでは finalize を始める前に admission_check して、混んでいれば 503 + Retry-After で
+# （?job=1 は混んでいるときのためのキューなので、ここではなく job_admission_check で積める数だけ見る）
+# すぐ返す。走り出した finalize の中で枠が取れなかった呼び出しは通常の失敗と同じく
+# フォールバック（候補の代替・image_error）になる。値はプロセスごと。
+
+UPSTREAM_COMPLETION_TOKENS = int(os.getenv("UPSTREAM_COMPLETION_TOKENS", "600"))
+
+class UpstreamBusy(Exception):
+    """上流の枠が空かない。retry_after 秒後にやり直してほしい"""
+
+    def __init__(self, kind: str, retry_after: float):
+        self.kind = kind
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        super().__init__(f"混み合っています。{self.retry_after}秒ほどおいてもう一度お試しください。")
+
+class SpeculationSkipped(Exception):
+    """投機呼び出しを上流に投げなかった（負けが決まった / 待たずに取れる枠が無い）"""
+
+class TokenBucket:
+    """1分あたり per_minute（= バースト上限）。スレッドセーフではないので UpstreamLimiter のロック内で使う"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.t = time.monotonic()
+
+    def wait_for(self, n: float, now: float) -> float:
+        if self.capacity <= 0:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.t) * self.rate)
+        self.t = now
+        n = min(n, self.capacity)
+        return 0.0 if self.level >= n else (n - self.level) / self.rate
+
+    def take(self, n: float):
+        if self.capacity > 0:
+            self.level -= min(n, self.capacity)
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+class UpstreamLimiter:
+    """
+    同時実行数の枠待ちは release で起こす（sync は Condition、async は待ち手ごとの Future）。
+    時間で決まる待ち（RPM/TPM の補充・429 の一時停止）だけ、その秒数だけ寝る。
+    Flask のスレッド・ジョブワーカー・ASGI のイベントループで1つを共有するので、asyncio.Condition は使わない
+    """
+    def __init__(self, kind: str, max_concurrency: int, rpm: float, tpm: float, max_queue: int, max_wait_sec: float):
+        self.kind = kind
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait_sec = max_wait_sec
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.inflight = 0
+        self.waiting = 0
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._async_waiters = deque()  # (loop, Future)
+
+    def _try_acquire(self, tokens: int):
+        """lock 内から呼ぶ。取れたら 0、同時実行数の枠待ちなら None（release で起こす）、レート待ちなら秒"""
+        now = time.monotonic()
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.max_concurrency > 0 and self.inflight >= self.max_concurrency:
+            return None
+        wait_sec = max(self.rpm.wait_for(1, now), self.tpm.wait_for(tokens, now))
+        if wait_sec > 0:
+            return wait_sec
+        self.rpm.take(1)
+        self.tpm.take(tokens)
+        self.inflight += 1
+        return 0.0
+
+    def _enqueue(self) -> float:
+        """lock 内から呼ぶ。列に並んで締め切り（time.monotonic）を返す。列が一杯なら UpstreamBusy"""
+        if self.waiting >= self.max_queue:
+            UPSTREAM_REJECTED.inc(kind=self.kind)
+            raise UpstreamBusy(self.kind, self._retry_hint())
+        self.waiting += 1
+        return time.monotonic() + self.max_wait_sec
+
+    def _time_left(self, wait_sec, deadline: float) -> float:
+        """lock 内から呼ぶ。締め切りまでに取れる見込みがなければ UpstreamBusy"""
+        left = deadline - time.monotonic()
+        if (left <= 0) if wait_sec is None else (wait_sec > left):
+            UPSTREAM_REJECTED.inc(kind=self.kind)
+            raise UpstreamBusy(self.kind, self._retry_hint() if wait_sec is None else wait_sec)
+        return left
+
+    def _notify(self):
+        # lock 内から呼ぶ。枠が1つ空いたので、sync と async の待ち手を1人ずつ起こす（取れなかった方は待ち直す）
+        self._cond.notify()
+        while self._async_waiters:
+            loop, fut = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_wake, fut)
+                return
+            except RuntimeError:  # ループがもう閉じている
+                continue
+
+    def _forget(self, waiter, handoff: bool):
+        # lock 内から呼ぶ。起こされたのに枠を取らずに抜ける（キャンセルなど）なら、次の待ち手に回す
+        try:
+            self._async_waiters.remove(waiter)
+        except ValueError:
+            if handoff:
+                self._notify()
+
+    def try_acquire(self, tokens: int = 0) -> bool:
+        """待たずに取れるときだけ取る（投機呼び出し用。枠を待っている本命の呼び出しは追い越さない）"""
+        with self._lock:
+            return not self.waiting and self._try_acquire(tokens) == 0
+
+    def acquire(self, tokens: int = 0):
+        with self._cond:
+            wait_sec = self._try_acquire(tokens)
+            if wait_sec == 0:
+                return
+            deadline = self._enqueue()
+            try:
+                while wait_sec != 0:
+                    left = self._time_left(wait_sec, deadline)
+                    self._cond.wait(left if wait_sec is None else wait_sec)
+                    wait_sec = self._try_acquire(tokens)
+            finally:
+                self.waiting -= 1
+
+    async def acquire_async(self, tokens: int = 0):
+        loop = asyncio.get_running_loop()
+        deadline, waiter = None, None
+        try:
+            while True:
+                with self._lock:
+                    if waiter is not None:
+                        self._forget(waiter, handoff=False)
+                        waiter = None
+                    wait_sec = self._try_acquire(tokens)
+                    if wait_sec == 0:
+                        return
+                    if deadline is None:
+                        deadline = self._enqueue()
+                    left = self._time_left(wait_sec, deadline)
+                    if wait_sec is None:
+                        waiter = (loop, loop.create_future())
+                        self._async_waiters.append(waiter)
+                if waiter is None:
+                    await asyncio.sleep(wait_sec)
+                else:
+                    await asyncio.wait((waiter[1],), timeout=left)
+        finally:
+            if deadline is not None or waiter is not None:
+                with self._lock:
+                    if deadline is not None:
+                        self.waiting -= 1
+                    if waiter is not None:
+                        self._forget(waiter, handoff=True)
+
+    def release(self):
+        with self._lock:
+            self.inflight -= 1
+            self._notify()
+
+    def pause(self, sec: float):
+        """上流が 429 を返したら、全員まとめて sec 秒止める"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + sec)
+
+    def _retry_hint(self) -> float:
+        now = time.monotonic()
+        return max(1.0, self.paused_until - now, self.rpm.wait_for(1, now),
+                   self.max_wait_sec * self.waiting / max(1, self.max_queue))
+
+    def overloaded(self):
+        """新しい finalize を受けるべきでなければ retry_after 秒、受けてよければ None"""
+        with self._lock:
+            now = time.monotonic()
+            if self.waiting >= self.max_queue or self.paused_until - now > self.max_wait_sec:
+                return self._retry_hint()
+        return None
+
+def _limiter_from_env(kind: str, max_concurrency: str, rpm: str, tpm: str, max_queue: str) -> UpstreamLimiter:
+    prefix = f"UPSTREAM_{kind.upper()}_"
+    return UpstreamLimiter(
+        kind,
+        max_concurrency=int(os.getenv(prefix + "MAX_CONCURRENCY", max_concurrency)),
+        rpm=float(os.getenv(prefix + "RPM", rpm)),
+        tpm=float(os.getenv(prefix + "TPM", tpm)),
+        max_queue=int(os.getenv(prefix + "MAX_QUEUE", max_queue)),
+        max_wait_sec=float(os.getenv(prefix + "MAX_WAIT_SEC", "20")),
+    )
+
+UPSTREAM_REJECTED = Counter("nail_upstream_rejected_total", "Calls/requests turned away by admission control, by kind")
+METRICS.append(UPSTREAM_REJECTED)
+UPSTREAM_LIMITERS = {
+    "chat": _limiter_from_env("chat", max_concurrency="32", rpm="0", tpm="0", max_queue="128"),
+    "image": _limiter_from_env("image", max_concurrency="8", rpm="0", tpm="0", max_queue="32"),
 }
 
+def upstream_limiter(stage: str) -> UpstreamLimiter:
+    return UPSTREAM_LIMITERS["image" if stage == "image" else "chat"]
+
+def admission_check(kinds=("chat", "image")):
+    """finalize（や画像の作り直し）を始める前に。混んでいれば UpstreamBusy"""
+    for kind in kinds:
+        retry_after = UPSTREAM_LIMITERS[kind].overloaded()
+        if retry_after is not None:
+            UPSTREAM_REJECTED.inc(kind=kind)
+            raise UpstreamBusy(kind, retry_after)
+
+def busy_headers(e: UpstreamBusy) -> dict:
+    return {"Retry-After": str(e.retry_after)}
+
+# =========================================================
+# 1) Persona registry (readable by persona_id)
+# =========================================================
+
+DEFAULT_PERSONA_ID = os.getenv("DEFAULT_PERSONA_ID", "nailist_01")
+# 複数ファイルは os.pathsep 区切り。1ファイルにペルソナ1件（dict）でも複数件（list）でもよい
+PERSONA_PATHS = [
+    p for p in os.getenv(
+        "PERSONA_PATHS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "personas.json")
+    ).split(os.pathsep) if p.strip()
+]
+PERSONA_RELOAD_SEC = float(os.getenv("PERSONA_RELOAD_SEC", "2"))  # mtime を見に行く間隔
+
+PERSONA_REQUIRED = {"persona_id": str, "display_name": str}
+PERSONA_SECTIONS = ["voice", "design_policy", "params", "color_direction", "format_constraints"]
+
+def validate_persona(persona, path: str) -> dict:
+    if not isinstance(persona, dict):
+        raise ValueError(f"{path}: ペルソナは JSON オブジェクトで書いてください")
+    for key, typ in PERSONA_REQUIRED.items():
+        if not isinstance(persona.get(key), typ) or not persona[key].strip():
+            raise ValueError(f"{path}: {key} がありません")
+    for key in PERSONA_SECTIONS:
+        if key in persona and not isinstance(persona[key], dict):
+            raise ValueError(f"{path}: {persona['persona_id']}.{key} はオブジェクトで書いてください")
+    for key, v in persona.get("params", {}).items():
+        if not isinstance(v, (int, float)):
+            raise ValueError(f"{path}: {persona['persona_id']}.params.{key} は数値で書いてください")
+    return persona
+
+def load_personas(paths: list) -> dict:
+    """
+    ペルソナファイルを全部読んで検証する -> {persona_id: persona}。1件でも壊れていれば ValueError
+    """
+    personas = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for persona in (data if isinstance(data, list) else [data]):
+            persona = validate_persona(persona, path)
+            pid = persona["persona_id"]
+            if pid in personas:
+                raise ValueError(f"{path}: persona_id {pid} が重複しています")
+            personas[pid] = persona
+    if DEFAULT_PERSONA_ID not in personas:
+        raise ValueError(f"デフォルトのペルソナ {DEFAULT_PERSONA_ID} がありません")
+    return personas
+
+class PersonaRegistry:
+    """
+    persona_id -> ペルソナ。ファイルの mtime が変わったら読み直して丸ごと差し替える
+    （読み直しに失敗したら前の内容のまま）。プロンプト用の JSON は読み込み時に1回だけ作る
+    """
+    def __init__(self, paths: list, reload_sec: float = PERSONA_RELOAD_SEC):
+        self.paths = list(paths)
+        self.reload_sec = reload_sec
+        self._lock = threading.Lock()
+        self._checked = time.time()
+        self._mtimes = self._stat()
+        self._swap(load_personas(self.paths))
+
+    def _stat(self) -> tuple:
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _swap(self, personas: dict):
+        fragments = {pid: (p, json.dumps(p, ensure_ascii=False)) for pid, p in personas.items()}
+        # 読み手は self._state を1回読むだけなので、代入1回で入れ替わる
+        self._state = (personas, fragments)
+
+    def maybe_reload(self) -> bool:
+        now = time.time()
+        if now - self._checked < self.reload_sec or not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._checked = now
+            mtimes = self._stat()
+            if mtimes == self._mtimes:
+                return False
+            self._mtimes = mtimes
+            try:
+                self._swap(load_personas(self.paths))
+            except (OSError, ValueError):
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+    def get(self, persona_id: str) -> dict:
+        self.maybe_reload()
+        personas, _ = self._state
+        return personas.get(persona_id) or personas[DEFAULT_PERSONA_ID]
+
+    def ids(self) -> list:
+        self.maybe_reload()
+        return list(self._state[0].keys())
+
+    def fragment(self, persona: dict) -> str:
+        """
+        プロンプトに埋め込むペルソナ JSON（読み込み済みのものは前計算した文字列）
+        """
+        entry = self._state[1].get(persona.get("persona_id"))
+        if entry is not None and entry[0] is persona:
+            return entry[1]
+        return json.dumps(persona, ensure_ascii=False)
+
+PERSONA_REGISTRY = PersonaRegistry(PERSONA_PATHS)
+
 def get_persona_from_form(form: dict) -> dict:
     pid = str(form.get("persona_id", "") or "").strip()
     if not pid:
         pid = DEFAULT_PERSONA_ID
-    return PERSONA_REGISTRY.get(pid, PERSONA_REGISTRY[DEFAULT_PERSONA_ID])
+    return PERSONA_REGISTRY.get(pid)
+
+FANOUT_MAX_PERSONAS = int(os.getenv("FANOUT_MAX_PERSONAS", "8"))
+
+def personas_from_form(form: dict):
+    """
+    persona_ids（カンマ区切り or 複数値 or "all"）-> 比較するペルソナのリスト。指定がなければ None（従来の1人モード）
+    知らない id は無視し、FANOUT_MAX_PERSONAS 人まで
+    """
+    raw = form.get("persona_ids", "")
+    vals = raw if isinstance(raw, list) else [raw]
+    ids = [x.strip() for v in vals for x in str(v or "").split(",") if x.strip()]
+    if not ids:
+        return None
+    known = PERSONA_REGISTRY.ids()
+    if "all" in ids:
+        ids = known
+    ids = [pid for pid in dict.fromkeys(ids) if pid in known][:FANOUT_MAX_PERSONAS]
+    return [PERSONA_REGISTRY.get(pid) for pid in ids] or None
 
 # =========================================================
 # 1.5) Free input -> spec (Lv2)
 # =========================================================
 
+# 自由入力/プランで拾うデザイン・色の語彙（具体度推定とローカル事前フィルタで共通）
+SPEC_DESIGN_TERMS = ["フレンチ", "グラデ", "マグネット", "ミラー", "オーロラ", "ちゅるん", "シアー",
+                     "ストーン", "ラメ", "ニュアンス", "チェック", "ハート", "リボン", "キャラ"]
+SPEC_COLOR_TERMS = ["ブルー", "ネイビー", "ピンク", "赤", "黒", "白", "グレー", "ベージュ", "ブラウン", "グリーン"]
+
 def quick_specificity_heuristic(free_text: str) -> int:
     """
     LLMが落ちた時の雑な具体度推定（0-100）
@@ -181,31 +1136,27 @@ def quick_specificity_heuristic(free_text: str) -> int:
     # length
     score += min(60, len(t))
     # keywords (rough)
-    keywords = ["フレンチ", "グラデ", "マグネット", "ミラー", "オーロラ", "ちゅるん", "シアー",
-                "ストーン", "ラメ", "ニュアンス", "チェック", "ハート", "リボン", "キャラ",
-                "ブルー", "ネイビー", "ピンク", "赤", "黒", "白", "グレー", "ベージュ", "ブラウン", "グリーン"]
+    keywords = SPEC_DESIGN_TERMS + SPEC_COLOR_TERMS
     score += 5 * sum(1 for k in keywords if k in t)
     # "NG" patterns
     if "NG" in t or "苦手" in t or "避け" in t or "なし" in t:
         score += 10
     return max(0, min(100, score))
 
-def extract_free_spec(free_text: str, selected_summary: dict) -> dict:
+def empty_free_spec(specificity: int = 0) -> dict:
+    return {
+        "specificity": specificity,
+        "must": [],
+        "must_not": [],
+        "soft": [],
+        "keywords": [],
+        "summary": ""
+    }
+
+def free_spec_request(free_text: str, selected_summary: dict) -> dict:
     """
-    avoid_colors(自由入力)を 'spec' に変換して、強制力を持たせる
-    spec = {specificity:0-100, must:[], must_not:[], soft:[], keywords:[], summary:"..."}
+    extract_free_spec の chat.completions.create 引数（sync/async 共通）
     """
-    free_text = (free_text or "").strip()
-    if not free_text:
-        return {
-            "specificity": 0,
-            "must": [],
-            "must_not": [],
-            "soft": [],
-            "keywords": [],
-            "summary": ""
-        }
-
     prompt = f"""
 You are an expert nail concierge.
 
@@ -239,43 +1190,81 @@ Customer selection summary (for context only):
 {json.dumps(selected_summary, ensure_ascii=False)}
 """.strip()
 
-    try:
-        res = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Return JSON only."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.2
-        )
-        spec = safe_extract_json(res.choices[0].message.content)
-
-        # sanitize
-        spec_out = {
-            "specificity": max(0, min(100, safe_int(spec.get("specificity", 0), 0))),
-            "must": [str(x).strip() for x in (spec.get("must") or []) if str(x).strip()],
-            "must_not": [str(x).strip() for x in (spec.get("must_not") or []) if str(x).strip()],
-            "soft": [str(x).strip() for x in (spec.get("soft") or []) if str(x).strip()],
-            "keywords": [str(x).strip() for x in (spec.get("keywords") or []) if str(x).strip()],
-            "summary": str(spec.get("summary", "") or "").strip()
-        }
+    return json_mode({
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "Return JSON only."},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.2,
+        "timeout": stage_timeout("free_spec")
+    })
 
-        # fallback if somehow empty
-        if spec_out["specificity"] == 0:
-            spec_out["specificity"] = quick_specificity_heuristic(free_text)
+FREE_SPEC_CACHE = ResponseCache("free_spec", FREE_SPEC_CACHE_SIZE, FREE_SPEC_CACHE_TTL_SEC, LLM_CACHE_DB_PATH)
+METRICS.append(Gauge("nail_llm_cache", "LLM response cache size and hit/miss totals, by cache and stat",
+                     lambda: stats_samples("cache", {"free_spec": FREE_SPEC_CACHE})))
 
-        return spec_out
+def normalize_free_text(free_text: str) -> str:
+    """
+    キャッシュキー用: 全角/半角・大小文字・空白の揺れを吸収（"黒ＮＧ" と "黒ng" は同じ）
+    """
+    t = unicodedata.normalize("NFKC", free_text or "").strip().lower()
+    return re.sub(r"\s+", " ", t)
 
-    except Exception:
-        # fallback heuristic
-        return {
-            "specificity": quick_specificity_heuristic(free_text),
-            "must": [],
-            "must_not": [],
-            "soft": [],
-            "keywords": [],
-            "summary": ""
-        }
+def free_spec_cache_key(free_text: str, selected_summary: dict, model: str) -> str:
+    summary = dict(selected_summary, avoid_colors=normalize_free_text(str(selected_summary.get("avoid_colors", "") or "")))
+    return cache_key("free_spec", model, normalize_free_text(free_text), summary)
+
+def parse_free_spec(content: str, truncated: bool = False) -> dict:
+    """
+    LLM 出力の sanitize だけ（キャッシュするのはこの形。ヒューリスティックは混ぜない）
+    途中で切れた返答（must_not の書きかけなど）は TruncatedJsonError（呼び出し側でヒューリスティックに落とし、キャッシュしない）
+    """
+    if truncated:
+        raise TruncatedJsonError("free_spec の返答が途中で切れています")
+    spec = safe_extract_json(content, strict=True)
+
+    # sanitize
+    spec_out = {
+        "specificity": max(0, min(100, safe_int(spec.get("specificity", 0), 0))),
+        "must": [str(x).strip() for x in (spec.get("must") or []) if str(x).strip()],
+        "must_not": [str(x).strip() for x in (spec.get("must_not") or []) if str(x).strip()],
+        "soft": [str(x).strip() for x in (spec.get("soft") or []) if str(x).strip()],
+        "keywords": [str(x).strip() for x in (spec.get("keywords") or []) if str(x).strip()],
+        "summary": str(spec.get("summary", "") or "").strip()
+    }
+    return spec_out
+
+def finish_free_spec(spec: dict, free_text: str) -> dict:
+    # fallback if somehow empty
+    if spec["specificity"] == 0:
+        spec["specificity"] = quick_specificity_heuristic(free_text)
+    return spec
+
+def extract_free_spec(free_text: str, selected_summary: dict, use_cache: bool = True) -> dict:
+    """
+    avoid_colors(自由入力)を 'spec' に変換して、強制力を持たせる
+    spec = {specificity:0-100, must:[], must_not:[], soft:[], keywords:[], summary:"..."}
+    """
+    free_text = (free_text or "").strip()
+    if not free_text:
+        return empty_free_spec()
+
+    req = free_spec_request(free_text, selected_summary)
+    key = free_spec_cache_key(free_text, selected_summary, req["model"])
+    spec = FREE_SPEC_CACHE.get(key) if use_cache else None
+    if spec is None:
+        try:
+            res = call_with_retry("free_spec", lambda: client.chat.completions.create(**req), estimate_tokens(req))
+            record_usage("free_spec", res)
+            spec = parse_free_spec(res.choices[0].message.content, cut_off(res))
+        except Exception:
+            # fallback heuristic (not cached)
+            record_error("free_spec")
+            return empty_free_spec(quick_specificity_heuristic(free_text))
+        if use_cache:
+            FREE_SPEC_CACHE.put(key, spec)
+    return finish_free_spec(spec, free_text)
 
 def build_persona_candidate_prompt(candidate_id: str, persona: dict, user_text: str, selected_summary: dict, free_spec: dict) -> str:
     """
@@ -286,7 +1275,8 @@ def build_persona_candidate_prompt(candidate_id: str, persona: dict, user_text:
         "B": "B：一番“今っぽい”（トレンド寄り。ただし上品で現実的。マグネット/オーロラ/ミラーはやりすぎない）",
         "C": "C：アクセントが新鮮（1〜2本 or 先端など、ワンポイントで攻める。奇抜NG、でも新しい自分）"
     }
-    role_text = role_map.get(candidate_id, "方向性が被らないように提案する")
+    # 複数ペルソナ比較では id が "persona_id:A" になる
+    role_text = role_map.get(candidate_id.rsplit(":", 1)[-1], "方向性が被らないように提案する")
 
     specificity = safe_int(free_spec.get("specificity", 0), 0)
     free_mode = "LOW"
@@ -321,7 +1311,7 @@ def build_persona_candidate_prompt(candidate_id: str, persona: dict, user_text:
 お客様に合うネイル提案を【1案】だけ作ってください。
 
 【ネイリストのペルソナ（必ず従う）】
-{json.dumps(persona, ensure_ascii=False)}
+{PERSONA_REGISTRY.fragment(persona)}
 
 【自由入力の解釈（free_spec）】
 {json.dumps(free_spec, ensure_ascii=False)}
@@ -353,6 +1343,127 @@ def build_persona_candidate_prompt(candidate_id: str, persona: dict, user_text:
 {json.dumps(selected_summary, ensure_ascii=False)}
 """.strip()
 
+# =========================================================
+# 1.6) Candidate generation (A/B/C in parallel)
+# =========================================================
+
+CANDIDATE_IDS = ["A", "B", "C"]
+CANDIDATE_STREAM = os.getenv("CANDIDATE_STREAM", "0") == "1"  # 候補をストリームで受け、JSON が閉じた時点で打ち切る
+FANOUT_MAX_CONCURRENCY = int(os.getenv("FANOUT_MAX_CONCURRENCY", "8"))  # 複数ペルソナ比較で同時に投げる候補数
+FANOUT_DEADLINE_SEC = float(os.getenv("FANOUT_DEADLINE_SEC", "45"))  # finalize 開始からの締め切り
+
+def fallback_candidate(candidate_id: str, persona: dict) -> dict:
+    return {
+        "id": candidate_id,
+        "plan_ja": "【ネイルコンセプト】\n（プラン生成に失敗しました）\n【デザイン詳細】\n（もう一度お試しください）",
+        "style_hint": f"fallback persona:{persona.get('persona_id','unknown')}"
+    }
+
+def is_fallback_candidate(candidate: dict) -> bool:
+    return str(candidate.get("style_hint", "") or "").startswith("fallback")
+
+def candidate_request(candidate_id: str, persona: dict, user_text: str, selected_summary: dict, free_spec: dict) -> dict:
+    prompt = build_persona_candidate_prompt(candidate_id, persona, user_text, selected_summary, free_spec)
+    return json_mode({
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": "あなたはトップネイルアーティストです。必ずJSONのみを返してください。"},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0.65,
+        "timeout": stage_timeout("candidate")
+    })
+
+def parse_candidate(content: str, candidate_id: str, persona: dict, truncated: bool = False) -> dict:
+    """
+    途中で切れた返答の plan_ja（書きかけ）は使わない。plan_ja が無ければ ValueError（呼び出し側で fallback_candidate）
+    """
+    if truncated:
+        raise TruncatedJsonError("候補の返答が途中で切れています")
+    payload = safe_extract_json(content, drop_cut_field=True)
+    if not payload.get("plan_ja"):
+        raise ValueError("plan_ja がありません（途中で切れた返答など）")
+    if payload.get("id") != candidate_id:
+        payload["id"] = candidate_id
+    if "style_hint" not in payload:
+        payload["style_hint"] = f"persona:{persona.get('persona_id','unknown')}"
+    return payload
+
+def read_json_stream(stream, req: dict = None) -> str:
+    """
+    ストリームの delta を JsonStreamParser に流し、オブジェクトが閉じたら残り（解説文など）は読まずに切る
+    usage は record_stream_usage で candidate ステージに数える
+    """
+    parser, usage_chunk = JsonStreamParser(), None
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage_chunk = chunk
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta and parser.feed(delta):
+                break
+    finally:
+        stream.close()
+    record_stream_usage("candidate", usage_chunk, req or {}, parser.text)
+    return parser.text
+
+def generate_candidate(candidate_id: str, persona: dict, user_text: str, selected_summary: dict, free_spec: dict) -> dict:
+    """
+    1案だけ生成する。API失敗/JSON崩れは fallback_candidate に落とす
+    """
+    try:
+        req = candidate_request(candidate_id, persona, user_text, selected_summary, free_spec)
+        truncated = False  # ストリームは JSON が閉じたかどうかで見る（parse_candidate の drop_cut_field）
+        if CANDIDATE_STREAM:
+            content = call_with_retry(
+                "candidate",
+                lambda: client.chat.completions.create(**req, stream=True, stream_options={"include_usage": True}),
+                estimate_tokens(req), consume=lambda stream: read_json_stream(stream, req),
+            )
+        else:
+            res = call_with_retry("candidate", lambda: client.chat.completions.create(**req), estimate_tokens(req))
+            record_usage("candidate", res)
+            content, truncated = res.choices[0].message.content, cut_off(res)
+        return parse_candidate(content, candidate_id, persona, truncated)
+    except Exception:
+        record_error("candidate")
+        return fallback_candidate(candidate_id, persona)
+
+def fanout_jobs(personas: list) -> list:
+    return [(f"{p['persona_id']}:{cid}", p) for p in personas for cid in CANDIDATE_IDS]
+
+def generate_candidates_fanout(personas: list, user_text: str, selected_summary: dict, free_spec: dict, deadline: float) -> dict:
+    """
+    ペルソナ × A/B/C を同時に FANOUT_MAX_CONCURRENCY 件ずつ投げ、deadline（time.monotonic）までに
+    返ってきた分だけ使う。1件も間に合わなければ最初の1件だけ待つ
+    -> {"candidates": [...], "dropped": [間に合わなかった id]}
+    締め切り後、待ち行列の分は捨てるが、すでに上流に投げた呼び出しはスレッドを止められないので
+    stage_timeout("candidate") まで走り切る（結果は捨てる）
+    """
+    jobs = fanout_jobs(personas)
+    stop = threading.Event()
+
+    def one(cid, persona):
+        if stop.is_set():  # shutdown と取り出しがすれ違った分も上流に投げない
+            return None
+        return generate_candidate(cid, persona, user_text, selected_summary, free_spec)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(FANOUT_MAX_CONCURRENCY, len(jobs))), thread_name_prefix="fanout")
+    try:
+        futures = [pool.submit(one, cid, persona) for cid, persona in jobs]
+        done, _ = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+        if not done:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+    finally:
+        # 待ち行列のものは捨てる（投げてしまった分は結果を読まないだけ）
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    return {
+        "candidates": [f.result() for f in futures if f in done],
+        "dropped": [cid for (cid, _), f in zip(jobs, futures) if f not in done],
+        "persona_ids": [p["persona_id"] for p in personas],
+    }
+
 # =========================================================
 # 2) Bayesian type model (unchanged)
 # =========================================================
@@ -511,47 +1622,302 @@ def likelihood(question_id: str, answer_value: str, theta: dict, form: dict) ->
 
     return 0.2
 
+class PosteriorEngine:
+    """
+    QUESTIONS × options × TYPE_SPACE の尤度テンソル L[q, o, t] を起動時に1回だけ作り、
+    事後更新と期待情報利得（EIG）を NumPy の配列演算で計算する
+    （likelihood() は form を見ていないので、テンソルは form に依存しない）
+    """
+    def __init__(self, questions: dict, type_space: list):
+        self.qids = list(questions.keys())
+        self.q_index = {qid: i for i, qid in enumerate(self.qids)}
+        self.option_index = {
+            qid: {opt["value"]: j for j, opt in enumerate(questions[qid]["options"])}
+            for qid in self.qids
+        }
+        self.type_space = type_space
+        n_opt = max((len(questions[qid]["options"]) for qid in self.qids), default=0)
+
+        self.L = np.zeros((len(self.qids), n_opt, len(type_space)))
+        self.mask = np.zeros((len(self.qids), n_opt), dtype=bool)  # 選択肢数が質問ごとに違うので
+        for qi, qid in enumerate(self.qids):
+            for oj, opt in enumerate(questions[qid]["options"]):
+                self.L[qi, oj] = [likelihood(qid, opt["value"], th, {}) for th in type_space]
+                self.mask[qi, oj] = True
+
+    def likelihood_vector(self, question_id: str, answer_value: str) -> np.ndarray:
+        qi = self.q_index.get(question_id)
+        oj = self.option_index.get(question_id, {}).get(answer_value)
+        if qi is None or oj is None:
+            # 選択肢にない自由回答は従来どおり文字列判定で
+            return np.array([likelihood(question_id, answer_value, th, {}) for th in self.type_space])
+        return self.L[qi, oj]
+
+    def update(self, posterior, question_id: str, answer_value: str) -> np.ndarray:
+        return normalize_array(np.asarray(posterior, dtype=float) * self.likelihood_vector(question_id, answer_value))
+
+    def information_gain(self, posterior, question_ids: list) -> np.ndarray:
+        p = np.asarray(posterior, dtype=float)
+        qi = [self.q_index[q] for q in question_ids]
+        L = self.L[qi]                  # [Q, O, T]
+        mask = self.mask[qi]            # [Q, O]
+
+        un = L * p                      # [Q, O, T]
+        p_opt = un.sum(axis=2)          # [Q, O]
+        n_types = L.shape[2]
+        safe = np.where(p_opt > 0, p_opt, 1.0)[..., None]
+        post = np.where(p_opt[..., None] > 0, un / safe, 1.0 / n_types)
+        H = entropy_array(post, axis=2)  # [Q, O]
+
+        p_ans = np.where(mask, p_opt, 0.0)
+        total = p_ans.sum(axis=1, keepdims=True)
+        n_valid = mask.sum(axis=1, keepdims=True)
+        p_ans = np.where(total > 0, p_ans / np.where(total > 0, total, 1.0), mask / np.maximum(n_valid, 1))
+
+        return entropy(list(p)) - (p_ans * H).sum(axis=1)
+
+    def best_question(self, posterior, question_ids: list):
+        if not question_ids:
+            return None
+        ig = self.information_gain(posterior, question_ids)
+        return question_ids[int(np.argmax(ig))]
+
+def normalize_array(w: np.ndarray) -> np.ndarray:
+    s = w.sum()
+    if s <= 0:
+        return np.full(len(w), 1.0 / len(w))
+    return w / s
+
+def entropy_array(p: np.ndarray, axis: int = -1) -> np.ndarray:
+    safe = np.where(p > 1e-12, p, 1.0)
+    return -np.where(p > 1e-12, p * np.log(safe), 0.0).sum(axis=axis)
+
+POSTERIOR_ENGINE = PosteriorEngine(QUESTIONS, TYPE_SPACE)
+
 def bayes_update(posterior: list, form: dict, question_id: str, answer_value: str) -> list:
-    new_w = []
-    for i, th in enumerate(TYPE_SPACE):
-        new_w.append(posterior[i] * likelihood(question_id, answer_value, th, form))
-    return normalize(new_w)
+    return POSTERIOR_ENGINE.update(posterior, question_id, answer_value).tolist()
 
-def choose_next_question(posterior: list, form: dict):
+def unanswered_questions(form: dict) -> list:
     unanswered = []
     for qid in QUESTIONS.keys():
         v = form.get(qid, "")
         if not str(v).strip():
             unanswered.append(qid)
-    if not unanswered:
+    return unanswered
+
+def choose_next_question(posterior: list, form: dict):
+    best_qid = POSTERIOR_ENGINE.best_question(posterior, unanswered_questions(form))
+    if best_qid is None:
         return None
 
-    H0 = entropy(posterior)
-    best = None
-    for qid in unanswered:
-        opts = QUESTIONS[qid]["options"]
-
-        p_ans = []
-        post_by_ans = []
-        for opt in opts:
-            un = []
-            for i, th in enumerate(TYPE_SPACE):
-                un.append(posterior[i] * likelihood(qid, opt["value"], th, form))
-            p = sum(un)
-            p_ans.append(p)
-            post_by_ans.append(normalize(un) if p <= 0 else [u/p for u in un])
-
-        p_ans = normalize(p_ans)
-        expected_H = sum(pa * entropy(post) for pa, post in zip(p_ans, post_by_ans))
-        ig = H0 - expected_H
-        if (best is None) or (ig > best["ig"]):
-            best = {"qid": qid, "ig": ig}
-
-    if best is None:
+    q = QUESTIONS[best_qid]
+    return {"id": best_qid, "text": q["text"], "options": q["options"], "required": True}
+
+# =========================================================
+# 2.5) Precomputed question policy
+# =========================================================
+# 事前分布は purpose / vibe / age の少数の値だけで決まり、追加質問も選択肢が固定なので、
+# 「選択 × 回答」の全状態について次の質問と事後分布を前計算できる。
+#   python compile_policy.py            # question_policy.npz を作る
+#   python compile_policy.py --verify   # ライブ計算と突き合わせる
+
+ASK_MORE_ENTROPY = float(os.getenv("ASK_MORE_ENTROPY", "1.15"))
+QUESTION_POLICY_PATH = os.getenv(
+    "QUESTION_POLICY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "question_policy.npz")
+)
+
+# prior_from_selections が見ている値（ここ以外の値は事前分布に効かない）
+PRIOR_PURPOSES = ["仕事用", "イベント", "気分転換"]
+PRIOR_VIBES = ["上品", "可愛い", "クール", "トレンド感"]
+PRIOR_AGES = ["", "20代", "40代"]  # 効き方で3通り（若め / 上 / どちらでもない）の代表値
+
+def compute_posterior(form: dict) -> list:
+    post = prior_from_selections(form)
+    for qid in QUESTIONS.keys():
+        ans = str(form.get(qid, "") or "").strip()
+        if ans:
+            post = bayes_update(post, form, qid, ans)
+    return post
+
+def compute_next_question(form: dict, post: list):
+    """
+    まだ迷っていれば次に聞く質問（なければ None）。テーブルが使えないときのライブ計算
+    """
+    next_q = choose_next_question(post, form)
+    if next_q is not None and entropy(post) > ASK_MORE_ENTROPY:
+        return next_q
+    return None
+
+def _as_list(v) -> list:
+    return [v] if isinstance(v, str) else list(v or [])
+
+def prior_key(form: dict):
+    """
+    form -> 事前分布の状態番号。テーブルの外（年齢が両方に当たる等）は None
+    """
+    purpose = _as_list(form.get("purpose", []))
+    vibe = _as_list(form.get("vibe", []))
+    age = str(form.get("age", "") or "")
+
+    young = "10代" in age or "20代" in age
+    older = "40代" in age or "50代" in age
+    if young and older:
         return None
+    key = 2 if older else (1 if young else 0)
+    for v in PRIOR_VIBES:
+        key = key * 2 + (v in vibe)
+    for p in PRIOR_PURPOSES:
+        key = key * 2 + (p in purpose)
+    return key
+
+def prior_form(key: int) -> dict:
+    """prior_key の逆（コンパイル/検証用の代表 form）"""
+    purpose, vibe = [], []
+    for p in reversed(PRIOR_PURPOSES):
+        if key % 2:
+            purpose.insert(0, p)
+        key //= 2
+    for v in reversed(PRIOR_VIBES):
+        if key % 2:
+            vibe.insert(0, v)
+        key //= 2
+    return {"purpose": purpose, "vibe": vibe, "age": PRIOR_AGES[key]}
+
+N_PRIOR_KEYS = len(PRIOR_AGES) * 2 ** (len(PRIOR_VIBES) + len(PRIOR_PURPOSES))
+QUESTION_IDS = list(QUESTIONS.keys())
+ANSWER_RADIX = [len(QUESTIONS[qid]["options"]) + 1 for qid in QUESTION_IDS]  # 0 = 未回答
+N_ANSWER_KEYS = math.prod(ANSWER_RADIX)
+
+def answer_key(form: dict):
+    """
+    form の追加質問への回答 -> 状態番号。選択肢にない回答は None
+    """
+    key = 0
+    for qid, radix in zip(QUESTION_IDS, ANSWER_RADIX):
+        v = form.get(qid, "")
+        if not isinstance(v, str):
+            return None
+        v = v.strip()
+        if v:
+            j = POSTERIOR_ENGINE.option_index[qid].get(v)
+            if j is None:
+                return None
+            digit = j + 1
+        else:
+            digit = 0
+        key = key * radix + digit
+    return key
+
+def answer_form(key: int) -> dict:
+    """answer_key の逆"""
+    form = {}
+    for qid, radix in reversed(list(zip(QUESTION_IDS, ANSWER_RADIX))):
+        digit = key % radix
+        key //= radix
+        form[qid] = QUESTIONS[qid]["options"][digit - 1]["value"] if digit else ""
+    return form
+
+def policy_fingerprint() -> str:
+    """
+    テーブルの前提（質問・タイプ・事前分布/尤度のコード・閾値）が変わったら別物として扱う
+    """
+    src = "".join(inspect.getsource(f) for f in (prior_from_selections, likelihood, PosteriorEngine, prior_key))
+    return cache_key(json.dumps([QUESTIONS, TYPE_SPACE, ASK_MORE_ENTROPY], ensure_ascii=False, sort_keys=True), src)
+
+class QuestionPolicy:
+    """
+    状態（事前分布 × 回答）-> 次の質問 / 事後分布 のルックアップ
+    next_q[s] は質問の番号（-1 = もう聞かない）。事後分布は prior_w[p] * answer_w[a] を正規化するだけ
+    （全状態ぶんの事後分布をそのまま持つより2桁小さい）
+    """
+    def __init__(self, next_q, prior_w, answer_w, fingerprint: str):
+        self.next_q = next_q
+        self.prior_w = prior_w
+        self.answer_w = answer_w
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        ファイルがない/前提が変わっていれば None（呼び出し側はライブ計算に落ちる）
+        """
+        try:
+            with np.load(path) as z:
+                fingerprint = str(z["fingerprint"])
+                if fingerprint != policy_fingerprint():
+                    return None
+                return cls(z["next_q"], z["prior_w"], z["answer_w"], fingerprint)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path: str):
+        np.savez_compressed(
+            path, next_q=self.next_q, prior_w=self.prior_w, answer_w=self.answer_w,
+            fingerprint=np.array(self.fingerprint)
+        )
 
-    q = QUESTIONS[best["qid"]]
-    return {"id": best["qid"], "text": q["text"], "options": q["options"], "required": True}
+    def lookup(self, form: dict):
+        """
+        -> (posterior, next_question or None)。テーブルの外なら None
+        """
+        p = prior_key(form)
+        a = answer_key(form)
+        if p is None or a is None:
+            return None
+        post = normalize_array(self.prior_w[p] * self.answer_w[a]).tolist()
+        qi = int(self.next_q[p * N_ANSWER_KEYS + a])
+        if qi < 0:
+            return post, None
+        qid = QUESTION_IDS[qi]
+        q = QUESTIONS[qid]
+        return post, {"id": qid, "text": q["text"], "options": q["options"], "required": True}
+
+def compile_question_policy() -> QuestionPolicy:
+    """
+    全状態を列挙してテーブルを作る（オフライン用。数十秒かかる）
+    """
+    prior_w = np.array([prior_from_selections(prior_form(p)) for p in range(N_PRIOR_KEYS)])
+    answer_w = np.ones((N_ANSWER_KEYS, len(TYPE_SPACE)))
+    answer_forms = [answer_form(a) for a in range(N_ANSWER_KEYS)]
+    for a, af in enumerate(answer_forms):
+        for qid, v in af.items():
+            if v:
+                answer_w[a] *= POSTERIOR_ENGINE.likelihood_vector(qid, v)
+
+    q_index = {qid: i for i, qid in enumerate(QUESTION_IDS)}
+    next_q = np.full(N_PRIOR_KEYS * N_ANSWER_KEYS, -1, dtype=np.int8)
+    for p in range(N_PRIOR_KEYS):
+        pf = prior_form(p)
+        for a, af in enumerate(answer_forms):
+            form = dict(pf, **af)
+            nq = compute_next_question(form, compute_posterior(form))
+            if nq is not None:
+                next_q[p * N_ANSWER_KEYS + a] = q_index[nq["id"]]
+    return QuestionPolicy(next_q, prior_w, answer_w, policy_fingerprint())
+
+def verify_question_policy(policy: QuestionPolicy, sample: int = 0, tol: float = 1e-9) -> list:
+    """
+    テーブルとライブ計算を突き合わせる -> 食い違った状態のリスト（sample > 0 なら無作為抽出）
+    """
+    states = range(N_PRIOR_KEYS * N_ANSWER_KEYS)
+    if sample:
+        rng = np.random.default_rng(0)
+        states = rng.choice(len(states), size=min(sample, len(states)), replace=False).tolist()
+
+    mismatches = []
+    for s in states:
+        p, a = divmod(s, N_ANSWER_KEYS)
+        form = dict(prior_form(p), **answer_form(a))
+        post = compute_posterior(form)
+        live_q = compute_next_question(form, post)
+        table_post, table_q = policy.lookup(form)
+        if (live_q and live_q["id"]) != (table_q and table_q["id"]) or \
+                max(abs(x - y) for x, y in zip(post, table_post)) > tol:
+            mismatches.append({"state": s, "form": form,
+                               "live": live_q and live_q["id"], "table": table_q and table_q["id"]})
+    return mismatches
+
+QUESTION_POLICY = QuestionPolicy.load(QUESTION_POLICY_PATH)
 
 # =========================================================
 # 3) Candidate evaluation / selection (Lv2: free_input_alignment)
@@ -652,18 +2018,666 @@ def pick_by_expected_utility(candidates: list, eval_payload: dict, posterior: li
 
     return best or {"candidate": candidates[0] if candidates else {}, "eval": {}, "eu": 0.0, "tup": (0.0, 0.0, 0.0)}
 
+INCREMENTAL_EVAL = os.getenv("INCREMENTAL_EVAL", "0") == "1"
+EARLY_EXIT_MIN_EU = float(os.getenv("EARLY_EXIT_MIN_EU", "0.75"))
+
+def passes_early_exit(result: dict, posterior: list, free_spec: dict) -> bool:
+    """
+    この1案で決めてよいか: pick と同じハードゲート（具体度 >= 70 なら free_input_alignment >= 70）を通り、
+    期待効用が EARLY_EXIT_MIN_EU 以上
+    """
+    scores = (result or {}).get("scores") or {}
+    hard_gate = safe_int(free_spec.get("specificity", 0), 0) >= 70
+    if hard_gate and float(scores.get(FREE_AXIS, 0) or 0) < 70:
+        return False
+    return expected_utility(scores, posterior, free_spec) >= EARLY_EXIT_MIN_EU
+
+# ---------------------------------------------------------
+# Local pre-filter (LLM 採点の前に、語彙マッチだけで明らかな NG を落とす)
+# ---------------------------------------------------------
+
+LOCAL_PREFILTER = os.getenv("LOCAL_PREFILTER", "1") != "0"
+
+# プラン側では同じ色を別の書き方をすることが多い
+SPEC_TERM_ALIASES = {
+    "黒": ["ブラック"], "白": ["ホワイト"], "赤": ["レッド", "ボルドー"], "ブルー": ["青"],
+    "グリーン": ["緑", "カーキ"], "ブラウン": ["茶"], "グレー": ["グレージュ"],
+    "ラメ": ["グリッター"], "グラデ": ["グラデーション"],
+}
+# 「いや」（かわいいやつ）や「嫌」単体のような、ほかの語の一部になりやすい言い回しは入れない
+NG_MARKERS = ["NG", "ＮＧ", "苦手", "避け", "なし", "無し", "嫌い", "嫌だ", "イヤ", "やめ"]
+NEGATION_MARKERS = NG_MARKERS + ["使わ", "不使用", "控え", "抜き", "入れない", "しない", "ではなく"]
+CLAUSE_BREAK_RE = re.compile(r"[。、,，.\n/／]")
+# 逆接で節が変わる（「黒がいいけど白はNG」の「けど」、「可愛いが派手はNG」の形容詞 + が）
+CONTRAST_RE = re.compile(r"けど|けれど|でも|しかし|だが|ですが|ますが|(?<=[いな])が")
+# 「黒や白はNG」のように並べた語には、後ろの NG がまとめてかかる
+LIST_JOINER_RE = re.compile(r"(?:系|色|カラー)?(?:や|と|とか|も|・|＆|&)?")
+KANJI_RE = re.compile(r"[\u4e00-\u9fff]")
+
+def _term_words(term: str) -> list:
+    return [term] + SPEC_TERM_ALIASES.get(term, [])
+
+VOCAB_WORDS = sorted({w for t in SPEC_DESIGN_TERMS + SPEC_COLOR_TERMS for w in _term_words(t)}, key=len, reverse=True)
+
+def word_positions(text: str, word: str) -> list:
+    """
+    word の出現位置（開始）。1文字の漢字は直前も漢字なら別の語の一部とみなす（「面白い」の「白」）
+    """
+    starts = []
+    i = text.find(word)
+    while i >= 0:
+        if not (len(word) == 1 and KANJI_RE.match(word) and i > 0 and KANJI_RE.match(text[i - 1])):
+            starts.append(i)
+        i = text.find(word, i + 1)
+    return starts
+
+def next_vocabulary_word(text: str, start: int = 0):
+    """text[start:] で最初に出てくる語彙 -> (位置, 長さ) / なければ None"""
+    hits = [(i, -len(w)) for w in VOCAB_WORDS for i in word_positions(text, w) if i >= start]
+    if not hits:
+        return None
+    i, neg_len = min(hits)
+    return i, -neg_len
+
+def vocabulary_terms(text: str) -> list:
+    text = str(text or "")
+    return [t for t in SPEC_DESIGN_TERMS + SPEC_COLOR_TERMS if term_positions(text, t)]
+
+def clause_after(text: str, end: int, window: int = 12) -> str:
+    """
+    text[end:] のうち、直前の語にかかる範囲。句読点・逆接・次の語彙で止める
+    （次の語彙が「や」「と」などで並べたものなら、その後ろまで伸ばす）
+    """
+    tail = CLAUSE_BREAK_RE.split(text[end:end + window], 1)[0]
+    tail = CONTRAST_RE.split(tail, 1)[0]
+    pos = 0
+    while True:
+        hit = next_vocabulary_word(tail, pos)
+        if hit is None:
+            return tail
+        i, n = hit
+        if not LIST_JOINER_RE.fullmatch(tail[pos:i]):
+            return tail[:i]
+        pos = i + n
+
+def negated_after(text: str, end: int, markers: list, window: int = 12) -> bool:
+    """
+    直前の語にかかる範囲（clause_after）に否定/NGの言い回しがあるか（「黒は使わず」「黒NG」「黒や白はNG」など）
+    """
+    tail = clause_after(text, end, window)
+    return any(m in tail for m in markers)
+
+def term_positions(text: str, term: str) -> list:
+    """term（と別表記）の出現位置の終端"""
+    return [i + len(w) for w in _term_words(term) for i in word_positions(text, w)]
+
+def mentions(text: str, term: str) -> bool:
+    """否定されずに term が出てくるか"""
+    return any(not negated_after(text, end, NEGATION_MARKERS) for end in term_positions(text, term))
+
+def prefilter_terms(free_spec: dict, selected_summary: dict) -> dict:
+    """
+    free_spec.must / must_not / keywords / soft と avoid_colors の NG 表現 -> 語彙の集合
+    語彙に載らない言い回しは判定できないので LLM 採点に任せる
+    inferred: avoid_colors の言い回しから推しただけの must_not（free_spec には無い。読み違いがありうるので、
+    free_spec.must に入っている語は NG にしない）
+    """
+    must = {t for phrase in free_spec.get("must") or [] for t in vocabulary_terms(phrase)}
+    must_not = {t for phrase in free_spec.get("must_not") or [] for t in vocabulary_terms(phrase)}
+    avoid = str(selected_summary.get("avoid_colors", "") or "")
+    inferred = set()
+    for t in vocabulary_terms(avoid):
+        if t not in must_not and t not in must and any(negated_after(avoid, end, NG_MARKERS) for end in term_positions(avoid, t)):
+            inferred.add(t)
+    must_not |= inferred
+    must -= must_not
+    soft = {t for phrase in (free_spec.get("keywords") or []) + (free_spec.get("soft") or [])
+            for t in vocabulary_terms(phrase)} - must - must_not
+    return {"must": sorted(must), "must_not": sorted(must_not), "soft": sorted(soft), "inferred": sorted(inferred)}
+
+def local_score_candidate(candidate: dict, terms: dict) -> dict:
+    """
+    1案ぶんのローカル採点。must_not を踏んでいたら disqualified（生成失敗の代替案も常に disqualified）
+    local_score（0-100）は must の充足率を主に、keywords/soft で少し加点
+    """
+    plan = str(candidate.get("plan_ja", "") or "")
+    if is_fallback_candidate(candidate):
+        return {"id": candidate.get("id"), "disqualified": True, "violations": ["fallback"],
+                "must_hits": [], "soft_hits": [], "local_score": 0}
+    violations = [t for t in terms["must_not"] if mentions(plan, t)]
+    must_hits = [t for t in terms["must"] if mentions(plan, t)]
+    soft_hits = [t for t in terms["soft"] if mentions(plan, t)]
+    if violations:
+        score = 0
+    elif terms["must"]:
+        score = round(80 * len(must_hits) / len(terms["must"])) + min(20, 5 * len(soft_hits))
+    else:
+        score = 60 + min(40, 10 * len(soft_hits))
+    return {
+        "id": candidate.get("id"),
+        "disqualified": bool(violations),
+        "violations": violations,
+        "must_hits": must_hits,
+        "soft_hits": soft_hits,
+        "local_score": score,
+    }
+
+def local_prefilter(candidates: list, free_spec: dict, selected_summary: dict) -> dict:
+    """
+    -> {"terms", "scores": [...], "survivors": [ローカル点の高い順の候補], "inferred_drop": bool}
+    全部落ちたら（語彙判定の誤りもありうるので）生成に成功した候補を全部残す（代替案は最後）
+    inferred_drop: avoid_colors から推しただけの must_not でしか落ちていない案がある
+    （そのときは生き残りが1案でも LLM 採点を飛ばさない）
+    """
+    terms = prefilter_terms(free_spec, selected_summary)
+    scores = [local_score_candidate(c, terms) for c in candidates]
+    inferred = set(terms["inferred"])
+    survivors = ([c for c, sc in zip(candidates, scores) if not sc["disqualified"]]
+                 or [c for c in candidates if not is_fallback_candidate(c)]
+                 or list(candidates))
+    by_id = {sc["id"]: sc for sc in scores}
+    survivors.sort(key=lambda c: (is_fallback_candidate(c), -by_id[c.get("id")]["local_score"]))
+    inferred_drop = any(sc["disqualified"] and sc["violations"] and set(sc["violations"]) <= inferred for sc in scores)
+    return {"terms": terms, "scores": scores, "survivors": survivors, "inferred_drop": inferred_drop}
+
+def local_eval_payload(prefilter: dict) -> dict:
+    """
+    LLM 採点を飛ばしたときの eval 結果（free_input_alignment にローカル点を入れる）
+    """
+    survivors = {c.get("id") for c in prefilter["survivors"]}
+    return {
+        "source": "local_prefilter",
+        "results": [
+            {"id": sc["id"], "scores": {FREE_AXIS: sc["local_score"]}, "notes": "local prefilter"}
+            for sc in prefilter["scores"] if sc["id"] in survivors
+        ]
+    }
+
 # =========================================================
 # 4) Sessions
 # =========================================================
 
-SESSIONS = {}
 SESSION_TTL_SEC = 10 * 60
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory | sqlite
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", os.path.join(tempfile.gettempdir(), "nail_sessions.sqlite3"))
+SESSION_BLOB_DIR = os.getenv("SESSION_BLOB_DIR", os.path.join(tempfile.gettempdir(), "nail_session_blobs"))
+SESSION_CLEANUP_BATCH = 64  # 1リクエストあたりに掃除する期限切れセッションの上限
+# memory バックエンドで画像を抱えておける上限（SESSION_STORE の分。RESULT_STORE は RESULT_MEMORY_BUDGET_BYTES）
+SESSION_MEMORY_BUDGET_BYTES = int(os.getenv("SESSION_MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))
+SESSION_SPILL_THRESHOLD_BYTES = int(os.getenv("SESSION_SPILL_THRESHOLD_BYTES", str(2 * 1024 * 1024)))
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", os.path.join(tempfile.gettempdir(), "nail_session_spill"))
+
+class MemorySessionStore:
+    """
+    プロセス内 dict + 期限ヒープ（1プロセス運用向け）
+    cleanup は期限切れの先頭だけをヒープから取り出すので全件走査しない
+
+    画像バイトはメモリ予算（memory_budget_bytes）内で保持し、超えたら古い順（LRU）に
+    画像を一時ファイルへ逃がす（セッション自体は /answer を待っているかもしれないので消さない）。
+    spill_threshold_bytes 以上の画像は最初から一時ファイルに逃がす
+    """
+    def __init__(self, ttl_sec: float, memory_budget_bytes: int = SESSION_MEMORY_BUDGET_BYTES,
+                 spill_threshold_bytes: int = SESSION_SPILL_THRESHOLD_BYTES, spill_dir: str = SESSION_SPILL_DIR):
+        self.ttl_sec = ttl_sec
+        self.memory_budget_bytes = memory_budget_bytes
+        self.spill_threshold_bytes = spill_threshold_bytes
+        self.spill_dir = spill_dir
+        self._data = OrderedDict()  # token -> (expires, sess(画像抜き), img_bytes or None, spill_path or None)
+        self._expiry = []  # (expires, token)
+        self._memory_bytes = 0
+        self._evictions = 0
+        self._spills = 0
+        self._lock = threading.Lock()
+
+    def _spill(self, token: str, img_bytes: bytes) -> str:
+        os.makedirs(self.spill_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=token[:8] + "_", suffix=".bin", dir=self.spill_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(img_bytes)
+        return path
+
+    def _drop(self, token: str):
+        # lock 内から呼ぶ。削除したファイルは呼び出し側で消す
+        expires, _, img_bytes, path = self._data.pop(token)
+        if img_bytes is not None:
+            self._memory_bytes -= len(img_bytes)
+        return path
+
+    def _remove_files(self, paths: list):
+        for path in paths:
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def put(self, token: str, sess: dict):
+        expires = time.time() + self.ttl_sec
+        sess = dict(sess)
+        img_bytes = sess.pop("img_bytes")
+        path = None
+        if len(img_bytes) >= self.spill_threshold_bytes:
+            path = self._spill(token, img_bytes)
+            img_bytes = None
+
+        removed = []
+        with self._lock:
+            if path:
+                self._spills += 1
+            if token in self._data:
+                removed.append(self._drop(token))
+            self._data[token] = (expires, sess, img_bytes, path)
+            heapq.heappush(self._expiry, (expires, token))
+            if img_bytes is not None:
+                self._memory_bytes += len(img_bytes)
+            victims = self._over_budget()
+        self._remove_files(removed)
+        if victims:
+            self._spill_victims(victims)
+
+    def _over_budget(self) -> list:
+        # lock 内から呼ぶ。予算に収まるまで、メモリに画像を持っているものを古い順に選ぶ（ディスク上のものは飛ばす）
+        victims, excess = [], self._memory_bytes - self.memory_budget_bytes
+        for token, item in self._data.items():
+            if excess <= 0:
+                break
+            if item[2] is not None:
+                victims.append((token, item))
+                excess -= len(item[2])
+        return victims
+
+    def _spill_victims(self, victims: list):
+        # 書き込みは lock の外。書いている間に pop / 上書きされたものはファイルを捨てる
+        spilled = [(token, item, self._spill(token, item[2])) for token, item in victims]
+        stale = []
+        with self._lock:
+            for token, item, path in spilled:
+                if self._data.get(token) is not item:
+                    stale.append(path)
+                    continue
+                expires, sess, img_bytes, _ = item
+                self._data[token] = (expires, sess, None, path)
+                self._memory_bytes -= len(img_bytes)
+                self._evictions += 1
+                self._spills += 1
+        self._remove_files(stale)
+
+    def exists(self, token: str) -> bool:
+        with self._lock:
+            item = self._data.get(token)
+            if item is not None:
+                self._data.move_to_end(token)
+        return item is not None and item[0] > time.time()
+
+    def _load(self, item):
+        expires, sess, img_bytes, path = item
+        if expires <= time.time():
+            return None
+        if path:
+            try:
+                with open(path, "rb") as f:
+                    img_bytes = f.read()
+            except OSError:
+                return None
+        return dict(sess, img_bytes=img_bytes)
+
+    def get(self, token: str):
+        with self._lock:
+            item = self._data.get(token)
+            if item is not None:
+                self._data.move_to_end(token)
+        return None if item is None else self._load(item)
+
+    def pop(self, token: str):
+        with self._lock:
+            item = self._data.get(token)
+            if item is not None:
+                self._drop(token)
+        if item is None:
+            return None
+        try:
+            return self._load(item)
+        finally:
+            self._remove_files([item[3]])
+
+    def cleanup(self, limit: int = SESSION_CLEANUP_BATCH):
+        now = time.time()
+        removed = []
+        with self._lock:
+            for _ in range(limit):
+                if not self._expiry or self._expiry[0][0] > now:
+                    break
+                expires, token = heapq.heappop(self._expiry)
+                item = self._data.get(token)
+                if item is not None and item[0] == expires:
+                    removed.append(self._drop(token))
+        self._remove_files(removed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._data),
+                "memory_bytes": self._memory_bytes,
+                "memory_budget_bytes": self.memory_budget_bytes,
+                "spill_threshold_bytes": self.spill_threshold_bytes,
+                "evictions": self._evictions,
+                "spills": self._spills,
+            }
+
+class SqliteSessionStore:
+    """
+    複数ワーカーで共有するセッション（SQLite + 画像は blob ディレクトリにファイルで置く）
+    期限は expires のインデックスで古い順に消すので全件走査しない
+    img_bytes 以外のキーは JSON でまとめて持つ
+    """
+    def __init__(self, ttl_sec: float, db_path: str, blob_dir: str, table: str = "sessions"):
+        self.ttl_sec = ttl_sec
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self.table = table
+        os.makedirs(blob_dir, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                " token TEXT PRIMARY KEY, expires REAL NOT NULL, data TEXT NOT NULL, blob_path TEXT NOT NULL)"
+            )
+            con.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires ON {table} (expires)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def _blob_path(self, token: str) -> str:
+        return os.path.join(self.blob_dir, f"{self.table}_{token}.bin")
+
+    def _remove_blob(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def put(self, token: str, sess: dict):
+        sess = dict(sess)
+        path = self._blob_path(token)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(sess.pop("img_bytes"))
+        os.replace(tmp, path)
+        with self._connect() as con:
+            con.execute(
+                f"INSERT OR REPLACE INTO {self.table} (token, expires, data, blob_path) VALUES (?, ?, ?, ?)",
+                (token, time.time() + self.ttl_sec, json.dumps(sess, ensure_ascii=False), path)
+            )
+
+    def exists(self, token: str) -> bool:
+        with self._connect() as con:
+            row = con.execute(
+                f"SELECT 1 FROM {self.table} WHERE token = ? AND expires > ?", (token, time.time())
+            ).fetchone()
+        return row is not None
+
+    def _load(self, row):
+        expires, data, path = row
+        if expires <= time.time():
+            return None
+        try:
+            with open(path, "rb") as f:
+                img_bytes = f.read()
+        except OSError:
+            return None
+        return dict(json.loads(data), img_bytes=img_bytes)
+
+    def get(self, token: str):
+        with self._connect() as con:
+            row = con.execute(
+                f"SELECT expires, data, blob_path FROM {self.table} WHERE token = ?", (token,)
+            ).fetchone()
+        return None if row is None else self._load(row)
+
+    def pop(self, token: str):
+        with self._connect() as con:
+            row = con.execute(
+                f"SELECT expires, data, blob_path FROM {self.table} WHERE token = ?", (token,)
+            ).fetchone()
+            if row is None:
+                return None
+            # 別ワーカーが先に取った場合は rowcount が 0
+            if con.execute(f"DELETE FROM {self.table} WHERE token = ?", (token,)).rowcount != 1:
+                return None
+        try:
+            return self._load(row)
+        finally:
+            self._remove_blob(row[2])
+
+    def cleanup(self, limit: int = SESSION_CLEANUP_BATCH):
+        with self._connect() as con:
+            rows = con.execute(
+                f"SELECT token, blob_path FROM {self.table} WHERE expires <= ? ORDER BY expires LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+            con.executemany(f"DELETE FROM {self.table} WHERE token = ?", [(r[0],) for r in rows])
+        for _, path in rows:
+            self._remove_blob(path)
+
+    def stats(self) -> dict:
+        with self._connect() as con:
+            (n,) = con.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        return {"sessions": n}
+
+def make_session_store(backend: str = SESSION_BACKEND, ttl_sec: float = SESSION_TTL_SEC, table: str = "sessions",
+                       memory_budget_bytes: int = SESSION_MEMORY_BUDGET_BYTES):
+    if backend == "memory":
+        return MemorySessionStore(ttl_sec, memory_budget_bytes)
+    if backend == "sqlite":
+        return SqliteSessionStore(ttl_sec, SESSION_DB_PATH, SESSION_BLOB_DIR, table)
+    raise ValueError("不明な SESSION_BACKEND です: " + backend)
+
+SESSION_STORE = make_session_store()
+
+# finalize 済みの結果（edit_prompt / plan / 前処理済み画像）。画像だけ再生成するのに使う
+# メモリ予算はセッションとは別枠で小さめ（やり直しは一部のお客様だけなので、超えた分は一時ファイルで十分）。
+# プロセスが画像に使うメモリの上限は SESSION_MEMORY_BUDGET_BYTES + RESULT_MEMORY_BUDGET_BYTES
+RESULT_TTL_SEC = float(os.getenv("RESULT_TTL_SEC", str(15 * 60)))
+RESULT_MEMORY_BUDGET_BYTES = int(os.getenv("RESULT_MEMORY_BUDGET_BYTES", str(64 * 1024 * 1024)))
+RESULT_STORE = make_session_store(ttl_sec=RESULT_TTL_SEC, table="results", memory_budget_bytes=RESULT_MEMORY_BUDGET_BYTES)
+METRICS.append(Gauge("nail_session_store", "Session/result store size, memory and spill totals, by store and stat",
+                     lambda: stats_samples("store", {"sessions": SESSION_STORE, "results": RESULT_STORE})))
 
 def cleanup_sessions():
+    SESSION_STORE.cleanup()
+    RESULT_STORE.cleanup()
+    cleanup_artifacts()
+
+class GameInputError(ValueError):
+    """400 で返す入力エラー（メッセージはそのままユーザーに見せる）"""
+
+def posterior_from_form(form: dict, timings: dict = None, origin: float = None) -> list:
+    with observe_stage("posterior", timings, origin):
+        hit = QUESTION_POLICY and QUESTION_POLICY.lookup(form)
+        if hit:
+            return hit[0]
+        return compute_posterior(form)
+
+QUESTION_BUDGET = int(os.getenv("QUESTION_BUDGET", "1"))  # 1セッションで聞く追加質問の上限（1 = 従来どおり）
+
+def question_node(qid: str, next_nodes: dict = None) -> dict:
+    q = QUESTIONS[qid]
+    return {
+        "id": qid, "text": q["text"], "options": q["options"], "required": True,
+        "next": next_nodes or {opt["value"]: None for opt in q["options"]}
+    }
+
+def plan_questions(form: dict, post: list, budget: int):
+    """
+    残り budget 問ぶんの質問を先読みで決めて、回答ごとに分岐する木で返す（聞かないなら None）
+    各ノードは {"id","text","options","required","next": {回答: 次のノード or None}}
+    期待エントロピー（= 期待情報利得の合計）が最小になる質問を選ぶ。ASK_MORE_ENTROPY 以下なら枝を止める
+    """
+    memo = {}
+
+    def solve(p: np.ndarray, answered: tuple, budget: int):
+        key = (answered, budget)
+        if key in memo:
+            return memo[key]
+        h = float(entropy_array(p))
+        done = {q for q, _ in answered}
+        unanswered = [q for q in unanswered_questions(form) if q not in done]
+        if budget <= 0 or not unanswered or h <= ASK_MORE_ENTROPY:
+            memo[key] = (h, None)
+            return memo[key]
+
+        best = None
+        for qid in unanswered:
+            expected_h, branches = 0.0, {}
+            un = [p * POSTERIOR_ENGINE.likelihood_vector(qid, opt["value"]) for opt in QUESTIONS[qid]["options"]]
+            p_ans = normalize_array(np.array([u.sum() for u in un]))
+            for opt, pa, u in zip(QUESTIONS[qid]["options"], p_ans, un):
+                child = tuple(sorted(answered + ((qid, opt["value"]),)))
+                hh, node = solve(normalize_array(u), child, budget - 1)
+                expected_h += pa * hh
+                branches[opt["value"]] = node
+            if best is None or expected_h < best[0]:
+                best = (expected_h, qid, branches)
+
+        memo[key] = (best[0], question_node(best[1], best[2]))
+        return memo[key]
+
+    return solve(np.asarray(post, dtype=float), (), budget)[1]
+
+def maybe_ask_more(img_bytes: bytes, form: dict, post: list, asked: int = 0, timings: dict = None, origin: float = None):
+    """
+    まだ迷っていれば残りの追加質問をまとめて計画してセッションに積む（need_more レスポンスを返す）
+    十分なら / 質問の上限に達していれば None
+    """
+    remaining = QUESTION_BUDGET - asked
+    if remaining <= 0:
+        return None
+    with observe_stage("ask_more", timings, origin):
+        if remaining == 1:
+            # 1問だけなら先読みは貪欲法と同じ -> 前計算テーブルが使える
+            hit = QUESTION_POLICY and QUESTION_POLICY.lookup(form)
+            next_q = hit[1] if hit else compute_next_question(form, post)
+            plan = next_q and question_node(next_q["id"])
+        else:
+            plan = plan_questions(form, post, remaining)
+    if plan is None:
+        return None
+
+    token = secrets.token_urlsafe(16)
+    SESSION_STORE.put(token, {"img_bytes": img_bytes, "form": form, "posterior": post, "asked": asked})
+    question = {k: v for k, v in plan.items() if k != "next"}
+    return {"status":"need_more","token":token,"question":question,"plan":plan,"remaining":remaining}
+
+def parse_answers(answers_json, qid, ans) -> dict:
+    """
+    answers（{"質問id": "回答", ...} の JSON）でまとめて、または従来の question_id / answer で1問
+    """
+    answers_json = str(answers_json or "").strip()
+    if not answers_json:
+        return {str(qid or "").strip(): ans}
+    try:
+        answers = json.loads(answers_json)
+    except ValueError:
+        raise GameInputError("answers の形式が不正です。")
+    if not isinstance(answers, dict):
+        raise GameInputError("answers の形式が不正です。")
+    return answers
+
+def resume_session(token, answers: dict, timings: dict = None, origin: float = None) -> tuple:
+    """
+    追加質問の回答でセッションを取り出し、事後分布を更新する -> (img_bytes, form, posterior, asked)
+    """
+    token = str(token or "").strip()
+    answers = {str(q or "").strip(): str(a or "").strip() for q, a in answers.items()}
+
+    if not token or not SESSION_STORE.exists(token):
+        raise GameInputError("セッションが見つかりません。最初からやり直してください。")
+    if not answers:
+        raise GameInputError("回答が空です。")
+    for qid, ans in answers.items():
+        if qid not in QUESTIONS:
+            raise GameInputError("不明な質問です。")
+        if not ans:
+            raise GameInputError("回答が空です。")
+
+    sess = SESSION_STORE.pop(token)
+    if sess is None:
+        raise GameInputError("セッションが見つかりません。最初からやり直してください。")
+    img_bytes = sess["img_bytes"]
+    form = sess["form"]
+    post = sess["posterior"]
+
+    with observe_stage("posterior", timings, origin):
+        for qid, ans in answers.items():
+            form[qid] = ans
+            post = bayes_update(post, form, qid, ans)
+    return img_bytes, form, post, sess.get("asked", 0) + len(answers)
+
+# =========================================================
+# 4.5) Generated image artifacts
+# =========================================================
+
+IMAGE_DELIVERY = os.getenv("IMAGE_DELIVERY", "url")  # url | inline（従来の data URL）
+IMAGE_ARTIFACT_DIR = os.getenv("IMAGE_ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "nail_images"))
+IMAGE_ARTIFACT_TTL_SEC = float(os.getenv("IMAGE_ARTIFACT_TTL_SEC", str(24 * 3600)))
+IMAGE_ARTIFACT_SWEEP_SEC = 10 * 60
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")  # 例: https://makeup-enz8.onrender.com
+ARTIFACT_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+_last_artifact_sweep = 0.0
+
+def store_image_artifact(b64: str) -> str:
+    """
+    生成画像（b64_json）を1回だけデコードしてファイルに置く。id は中身のハッシュ（= ETag）
+    """
+    png = base64.b64decode(b64)
+    artifact_id = hashlib.sha256(png).hexdigest()[:32]
+    os.makedirs(IMAGE_ARTIFACT_DIR, exist_ok=True)
+    path = artifact_path(artifact_id)
+    if not os.path.exists(path):
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=IMAGE_ARTIFACT_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+    return artifact_id
+
+def artifact_path(artifact_id: str) -> str:
+    return os.path.join(IMAGE_ARTIFACT_DIR, artifact_id + ".png")
+
+def find_artifact(artifact_id: str):
+    if not ARTIFACT_ID_RE.match(artifact_id or ""):
+        return None
+    path = artifact_path(artifact_id)
+    return path if os.path.isfile(path) else None
+
+def cleanup_artifacts():
+    """
+    期限切れ画像の掃除（ディレクトリ走査なので IMAGE_ARTIFACT_SWEEP_SEC に1回だけ）
+    """
+    global _last_artifact_sweep
     now = time.time()
-    dead = [k for k, v in SESSIONS.items() if now - v.get("created", now) > SESSION_TTL_SEC]
-    for k in dead:
-        SESSIONS.pop(k, None)
+    if now - _last_artifact_sweep < IMAGE_ARTIFACT_SWEEP_SEC:
+        return
+    _last_artifact_sweep = now
+    try:
+        entries = list(os.scandir(IMAGE_ARTIFACT_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if now - entry.stat().st_mtime > IMAGE_ARTIFACT_TTL_SEC:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+def public_image_url(image_url: str, base_url: str = "") -> str:
+    """
+    /api/images/... の相対パスを絶対URLにする（フロントは別オリジン）
+    PUBLIC_BASE_URL が無ければリクエストの URL（プロキシの後ろでは ProxyFix で https に直したもの）
+    """
+    if image_url and image_url.startswith("/"):
+        return (PUBLIC_BASE_URL or (base_url or "").rstrip("/")) + image_url
+    return image_url
 
 # =========================================================
 # 5) Routes
@@ -674,6 +2688,7 @@ def game_start():
     if request.method == "OPTIONS":
         return "", 204
 
+    t0, timings = time.perf_counter(), {}
     try:
         cleanup_sessions()
 
@@ -683,24 +2698,34 @@ def game_start():
         img_bytes = image_file.read()
         if not img_bytes:
             return jsonify({"error": "爪の写真が空でした（ファイルサイズ0の可能性）"}), 400
+        img_bytes = preprocess_upload(img_bytes)
 
         form = form_to_dict(request.form)
+        post = posterior_from_form(form, timings, t0)
 
-        post = prior_from_selections(form)
-        for qid in QUESTIONS.keys():
-            ans = str(form.get(qid, "") or "").strip()
-            if ans:
-                post = bayes_update(post, form, qid, ans)
+        stream = wants_stream(request.headers.get("Accept", ""), request.args.get("stream", ""))
 
-        next_q = choose_next_question(post, form)
-
-        if next_q is not None and entropy(post) > 1.15:
-            token = secrets.token_urlsafe(16)
-            SESSIONS[token] = {"created": time.time(), "img_bytes": img_bytes, "form": form, "posterior": post}
-            return jsonify({"status":"need_more","token":token,"question":next_q})
-
-        return finalize_with_posterior(img_bytes, form, post)
+        need_more = maybe_ask_more(img_bytes, form, post, timings=timings, origin=t0)
+        if need_more is not None:
+            return sse_response([("need_more", need_more)]) if stream else jsonify(need_more)
 
+        job = wants_job(request.headers.get("Prefer", ""), request.args.get("job", ""))
+        if job:
+            job_admission_check()
+        else:
+            admission_check()
+        use_cache = cache_allowed(request.headers.get("Cache-Control", ""), request.args.get("no_cache", ""))
+        timing = query_flag(request.args.get("timing", ""))
+        if job:
+            return jsonify(submit_job(img_bytes, form, post, use_cache, request.url_root, timing)), 202
+        if stream:
+            return sse_response(finalize_events(img_bytes, form, post, use_cache, request.url_root, timing, timings, t0))
+        return finalize_with_posterior(img_bytes, form, post, use_cache, request.url_root, timing, timings, t0)
+
+    except GameInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except UpstreamBusy as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 503, busy_headers(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -709,30 +2734,96 @@ def game_answer():
     if request.method == "OPTIONS":
         return "", 204
 
+    t0, timings = time.perf_counter(), {}
     try:
         cleanup_sessions()
 
-        token = str(request.form.get("token", "") or "").strip()
-        qid = str(request.form.get("question_id", "") or "").strip()
-        ans = str(request.form.get("answer", "") or "").strip()
+        answers = parse_answers(
+            request.form.get("answers", ""),
+            request.form.get("question_id", ""),
+            request.form.get("answer", "")
+        )
+        # セッションを消費する前に（混んでいればトークンはそのまま、Retry-After 後に同じ回答を送り直せる）
+        # ジョブで受けるなら上流の混み具合ではなく、キューに積めるかだけを見る
+        job = wants_job(request.headers.get("Prefer", ""), request.args.get("job", ""))
+        if job:
+            job_admission_check()
+        else:
+            admission_check()
+        img_bytes, form, post2, asked = resume_session(request.form.get("token", ""), answers, timings, t0)
+
+        stream = wants_stream(request.headers.get("Accept", ""), request.args.get("stream", ""))
+
+        # 複数ラウンド（QUESTION_BUDGET > 1）で、まだ迷っていて予算が残っていればもう一度聞く
+        need_more = maybe_ask_more(img_bytes, form, post2, asked, timings, t0)
+        if need_more is not None:
+            return sse_response([("need_more", need_more)]) if stream else jsonify(need_more)
+
+        use_cache = cache_allowed(request.headers.get("Cache-Control", ""), request.args.get("no_cache", ""))
+        timing = query_flag(request.args.get("timing", ""))
+        if job:
+            return jsonify(submit_job(img_bytes, form, post2, use_cache, request.url_root, timing)), 202
+        if stream:
+            return sse_response(finalize_events(img_bytes, form, post2, use_cache, request.url_root, timing, timings, t0))
+        return finalize_with_posterior(img_bytes, form, post2, use_cache, request.url_root, timing, timings, t0)
+
+    except GameInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except UpstreamBusy as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 503, busy_headers(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        if not token or token not in SESSIONS:
-            return jsonify({"error": "セッションが見つかりません。最初からやり直してください。"}), 400
-        if qid not in QUESTIONS:
-            return jsonify({"error": "不明な質問です。"}), 400
-        if not ans:
-            return jsonify({"error": "回答が空です。"}), 400
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
 
-        sess = SESSIONS.pop(token)
-        img_bytes = sess["img_bytes"]
-        form = sess["form"]
-        post = sess["posterior"]
+@app.route("/api/game/retry_image", methods=["POST", "OPTIONS"])
+def game_retry_image():
+    """
+    finalize 済みのプランで画像だけ作り直す（chat 系の呼び出しはしない）
+    """
+    if request.method == "OPTIONS":
+        return "", 204
 
-        form[qid] = ans
-        post2 = bayes_update(post, form, qid, ans)
+    try:
+        cleanup_sessions()
 
-        return finalize_with_posterior(img_bytes, form, post2)
+        admission_check(("image",))
+        token = request.form.get("result_token", "")
+        result, edit_prompt = load_result(token, request.form.get("variation", ""))
+        image = run_image_edit(prepare_image_upload(result["img_bytes"]), edit_prompt)
+        return jsonify(build_retry_payload(token.strip(), result, image, request.url_root))
 
+    except GameInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except UpstreamBusy as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 503, busy_headers(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/images/<artifact_id>", methods=["GET"])
+def get_image(artifact_id):
+    """
+    生成画像の配信（ETag/If-None-Match, Range 対応。中身のハッシュが id なので immutable）
+    """
+    path = find_artifact(artifact_id)
+    if path is None:
+        return jsonify({"error": "画像が見つかりません（期限切れの可能性）"}), 404
+    res = send_file(path, mimetype="image/png", conditional=True, etag=artifact_id, max_age=int(IMAGE_ARTIFACT_TTL_SEC))
+    res.headers["Cache-Control"] = f"public, max-age={int(IMAGE_ARTIFACT_TTL_SEC)}, immutable"
+    return res
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    ?job=1 で積んだ finalize の進み具合（stage）と、終わっていれば result（通常のレスポンスと同じJSON）
+    """
+    try:
+        job = job_status(job_id)
+        if job is None:
+            return jsonify({"error": "ジョブが見つかりません（期限切れの可能性）"}), 404
+        return jsonify(job)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -740,10 +2831,82 @@ def game_answer():
 # 6) Main finalize (Lv2)
 # =========================================================
 
-def finalize_with_posterior(img_bytes: bytes, form: dict, posterior: list):
-    user_text = build_user_text(form)
+STAGE_MAX_WORKERS = int(os.getenv("STAGE_MAX_WORKERS", "8"))
+SPECULATIVE_EDIT_PROMPT = os.getenv("SPECULATIVE_EDIT_PROMPT", "1") != "0"
 
-    selected_summary = {
+def timed_stage(name: str, fn, timings: dict = None, origin: float = None):
+    """ステージ関数を observe_stage で包む（STAGE_SECONDS / STAGE_ERRORS / リクエスト内訳）"""
+    def run(results):
+        with observe_stage(name, timings, origin):
+            return fn(results)
+    return run
+
+def speculative_stage(deps: tuple, fn, cancelled=None) -> tuple:
+    """
+    投機実行のステージ。ほかのステージが全部終わったら、これの完了は待たずにグラフを終える（結果は捨てる）
+    cancelled（threading.Event）が立ったら、終わりを待たずに捨てる（fn 側もそれを見て上流に投げない）
+    """
+    fn.speculative = True
+    fn.cancelled = cancelled
+    return deps, fn
+
+def is_speculative(stage: tuple) -> bool:
+    return getattr(stage[1], "speculative", False)
+
+def is_abandoned(stage: tuple) -> bool:
+    cancelled = getattr(stage[1], "cancelled", None)
+    return cancelled is not None and cancelled.is_set()
+
+def stage_ready(deps: tuple, results: dict) -> bool:
+    """
+    deps の要素はステージ名か、results を受け取って待つステージ名（待たないなら None）を返す関数。
+    関数は手前の名前が揃ってから呼ぶ（("picked", 勝者の投機ステージ) のように書ける）
+    """
+    for d in deps:
+        if callable(d):
+            d = d(results)
+            if d is None:
+                continue
+        if d not in results:
+            return False
+    return True
+
+def iter_stage_graph(stages: dict, timings: dict = None, origin: float = None):
+    """
+    依存関係つきのステージ実行器（DAG）
+    stages = {name: (deps, fn)}。fn(results) は完了済みステージの結果 dict を受け取る
+    依存が揃ったもの（stage_ready）から並列に走らせ、終わった順に (name, value) を yield する
+    投機ステージ（speculative_stage）しか走っていなければ、それは待たずに終わる（スレッドは裏で走り切る）。
+    cancelled が立った投機ステージはその時点で待つのをやめる（まだ上流に投げていなければ投げない）
+    どれかが例外を出したら残りを捨てて再送出する
+    timings を渡すとステージごとの開始/所要時間（ms）を書き込む（開始は origin = perf_counter から。省略時はいま）
+    """
+    results = {}
+    pending = dict(stages)
+    running = {}
+    origin = time.perf_counter() if origin is None else origin
+    pool = ThreadPoolExecutor(max_workers=STAGE_MAX_WORKERS, thread_name_prefix="stage")
+    try:
+        while pending or any(not is_speculative(stages[n]) for n in running.values()):
+            for name, (deps, fn) in list(pending.items()):
+                if stage_ready(deps, results):
+                    running[pool.submit(timed_stage(name, fn, timings, origin), dict(results))] = name
+                    del pending[name]
+            if not running:
+                raise ValueError("ステージの依存関係が解決できません: " + ", ".join(sorted(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for f in done:
+                name = running.pop(f)
+                results[name] = f.result()
+                yield name, results[name]
+            for f in [f for f, name in running.items() if is_abandoned(stages[name])]:
+                del running[f]
+                f.cancel()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def build_selected_summary(form: dict) -> dict:
+    return {
         "age": form.get("age", ""),
         "nail_duration": form.get("nail_duration", ""),
         "purpose": form.get("purpose", []),
@@ -755,50 +2918,15 @@ def finalize_with_posterior(img_bytes: bytes, form: dict, posterior: list):
         "accent_preference": form.get("accent_preference", "")
     }
 
-    persona = get_persona_from_form(form)
-
-    # --- Lv2: Build free_spec from free input ---
-    free_text = str(form.get("avoid_colors", "") or "").strip()
-    free_spec = extract_free_spec(free_text, selected_summary)
-
-    # -----------------------------------------------------
-    # (1) Generate 3 candidates (A/B/C) with free_spec injected
-    # -----------------------------------------------------
-    candidates = []
-    for cid in ["A", "B", "C"]:
-        prompt = build_persona_candidate_prompt(cid, persona, user_text, selected_summary, free_spec)
-
-        res = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "あなたはトップネイルアーティストです。必ずJSONのみを返してください。"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.65
-        )
+def prepare_image_upload(img_bytes: bytes) -> io.BytesIO:
+    img_stream = io.BytesIO(img_bytes)
+    img_stream.name = image_filename(img_bytes)
+    return img_stream
 
-        try:
-            payload = safe_extract_json(res.choices[0].message.content)
-            if payload.get("id") != cid:
-                payload["id"] = cid
-            if not payload.get("plan_ja"):
-                payload["plan_ja"] = "【ネイルコンセプト】\n（生成に失敗しました）\n【デザイン詳細】\n（もう一度お試しください）"
-            if "style_hint" not in payload:
-                payload["style_hint"] = f"persona:{persona.get('persona_id','unknown')}"
-            candidates.append(payload)
-        except Exception:
-            candidates.append({
-                "id": cid,
-                "plan_ja": "【ネイルコンセプト】\n（プラン生成に失敗しました）\n【デザイン詳細】\n（もう一度お試しください）",
-                "style_hint": f"fallback persona:{persona.get('persona_id','unknown')}"
-            })
-
-    # -----------------------------------------------------
-    # (2) Evaluate candidates (add free_input_alignment)
-    # -----------------------------------------------------
+def eval_request(candidates: list, free_spec: dict, selected_summary: dict) -> dict:
     eval_prompt = f"""
 あなたはネイル提案の品質評価者です。
-下の「お客様の選択項目」「free_spec（自由入力の解釈）」「候補3案」を読み、各案を0〜100点で採点してください。
+下の「お客様の選択項目」「free_spec（自由入力の解釈）」「候補{len(candidates)}案」を読み、各案を0〜100点で採点してください。
 
 採点軸（0〜100）：
 - adherence_to_selections: 選択項目（vibe/purpose/nail_duration/age）への忠実さ
@@ -841,23 +2969,128 @@ free_spec（自由入力の解釈）：
 {json.dumps(candidates, ensure_ascii=False)}
 """.strip()
 
-    eval_res = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
+    return json_mode({
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "system", "content": "You are a strict evaluator. Return JSON only."},
             {"role": "user", "content": eval_prompt}
         ],
-        temperature=0.2
-    )
-    eval_payload = safe_extract_json(eval_res.choices[0].message.content)
+        "temperature": 0.2,
+        "timeout": stage_timeout("eval")
+    })
 
-    # Pick with Lv2: hard-gate + bonus from free alignment
-    picked = pick_by_expected_utility(candidates, eval_payload, posterior, free_spec)
-    plan_text = (picked.get("candidate") or {}).get("plan_ja") or candidates[0].get("plan_ja", "")
+def parse_eval(content: str, truncated: bool = False) -> dict:
+    """
+    採点結果が読めなくても finalize は止めない（results 空 -> pick は先頭候補に落ちる）
+    途中で切れた返答も parse_error（最後の案の軸が欠けて 0 点扱いになるので、部分的な結果は使わない）
+    """
+    try:
+        if truncated:
+            raise TruncatedJsonError("eval の返答が途中で切れています")
+        payload = safe_extract_json(content, strict=True)
+    except ValueError as e:
+        record_error("eval_parse")
+        return {"results": [], "parse_error": str(e)}
+    if not isinstance(payload.get("results"), list):
+        payload["results"] = []
+    return payload
+
+def evaluate_candidates(candidates: list, free_spec: dict, selected_summary: dict) -> dict:
+    req = eval_request(candidates, free_spec, selected_summary)
+    eval_res = call_with_retry("eval", lambda: client.chat.completions.create(**req), estimate_tokens(req))
+    record_usage("eval", eval_res)
+    return parse_eval(eval_res.choices[0].message.content, cut_off(eval_res))
+
+def judge_one(candidate: dict, terms, free_spec: dict, selected_summary: dict):
+    """
+    1案だけ採点する -> (eval の結果1件 or None, ローカル採点 or None)
+    ローカル事前フィルタで落ちた案は LLM に回さない。採点の失敗は None
+    """
+    local = local_score_candidate(candidate, terms) if terms is not None else None
+    if local and local["disqualified"]:
+        return None, local
+    try:
+        results = evaluate_candidates([candidate], free_spec, selected_summary).get("results") or []
+    except Exception:
+        return None, local
+    return (dict(results[0], id=candidate.get("id")) if results else None), local
+
+def incremental_result(jobs: list, finished: dict, early_exit) -> dict:
+    """
+    generate_candidates_incremental の戻り値（sync/async 共通）。finished = {id: (候補, 採点, ローカル採点)}
+    """
+    done = [finished[cid] for cid, _ in jobs if cid in finished]
+    judged = [c for c, res, _ in done if res is not None]
+    return {
+        "candidates": [c for c, _, _ in done],
+        "judged": judged or [c for c, _, _ in done],
+        "eval": {"source": "incremental", "results": [res for _, res, _ in done if res is not None]},
+        "prefilter_scores": [local for _, _, local in done if local is not None],
+        "dropped": [cid for cid, _ in jobs if cid not in finished],
+        "early_exit": early_exit,
+        "persona_ids": list(dict.fromkeys(p["persona_id"] for _, p in jobs)),
+    }
+
+def generate_candidates_incremental(jobs: list, user_text: str, selected_summary: dict, free_spec: dict,
+                                    posterior: list, deadline: float) -> dict:
+    """
+    候補を生成しながら届いた順に1案ずつ採点し、passes_early_exit を満たす案が出たら残りを打ち切る
+    jobs = [(candidate_id, persona)]。締め切り（deadline）の扱いは generate_candidates_fanout と同じ
+    """
+    terms = prefilter_terms(free_spec, selected_summary) if LOCAL_PREFILTER else None
+    # 打ち切ったあとも走っているスレッドは止められないので、生成/採点の前に見て余計な LLM 呼び出しをしない
+    stop = threading.Event()
+
+    def one(cid, persona):
+        if stop.is_set():
+            return None
+        c = generate_candidate(cid, persona, user_text, selected_summary, free_spec)
+        if stop.is_set():
+            return c, None, None
+        return (c,) + judge_one(c, terms, free_spec, selected_summary)
+
+    finished, early_exit = {}, None
+    pool = ThreadPoolExecutor(max_workers=max(1, min(FANOUT_MAX_CONCURRENCY, len(jobs))), thread_name_prefix="incremental")
+    try:
+        pending = {pool.submit(one, cid, persona): cid for cid, persona in jobs}
+        while pending and early_exit is None:
+            timeout = max(0.0, deadline - time.monotonic()) if finished else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for f in done:
+                cid = pending.pop(f)
+                finished[cid] = f.result()
+                if early_exit is None and passes_early_exit(finished[cid][1], posterior, free_spec):
+                    early_exit = cid
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+    return incremental_result(jobs, finished, early_exit)
+
+def fallback_edit_prompt(free_spec: dict) -> str:
+    # fallback: basic prompt + free_spec highlights
+    must = free_spec.get("must") or []
+    must_not = free_spec.get("must_not") or []
+    edit_prompt = (
+        "Keep the same hand, skin tone, lighting, background, and composition. "
+        "Edit ONLY the nails (do not change fingers/skin/jewelry/background). "
+        "No text, no watermark. "
+        "Follow customer selections first. "
+        "Aim for ~80% freshness while staying wearable and elegant. "
+        "Avoid a plain beige-only look; keep it moderately vivid. "
+        "Use only ONE tasteful accent point if needed. "
+    )
+    if must:
+        edit_prompt += "Must include: " + "; ".join(must) + ". "
+    if must_not:
+        edit_prompt += "Must NOT include: " + "; ".join(must_not) + ". "
+    return edit_prompt
 
-    # -----------------------------------------------------
-    # (3) Build English image-edit prompt (prioritize free_spec when specific)
-    # -----------------------------------------------------
+def edit_prompt_request(plan_text: str, free_spec: dict, selected_summary: dict, user_text: str) -> dict:
+    """
+    英語の画像編集プロンプトを作る（free_spec が具体的ならそれを優先）
+    """
     spec_prompt = f"""
 You are a top nail artist who writes image-edit prompts.
 
@@ -894,60 +3127,234 @@ Chosen nail plan (Japanese, for reference only):
 {plan_text}
 """.strip()
 
-    spec_res = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
+    return json_mode({
+        "model": "gpt-4o-mini",
+        "messages": [
             {"role": "system", "content": "You write prompts for image editing. Return JSON only."},
             {"role": "user", "content": spec_prompt}
         ],
-        temperature=0.25
-    )
-    spec = safe_extract_json(spec_res.choices[0].message.content)
-    edit_prompt = (spec.get("edit_prompt_en") or "").strip()
-
-    if not edit_prompt:
-        # fallback: basic prompt + free_spec highlights
-        must = free_spec.get("must") or []
-        must_not = free_spec.get("must_not") or []
-        edit_prompt = (
-            "Keep the same hand, skin tone, lighting, background, and composition. "
-            "Edit ONLY the nails (do not change fingers/skin/jewelry/background). "
-            "No text, no watermark. "
-            "Follow customer selections first. "
-            "Aim for ~80% freshness while staying wearable and elegant. "
-            "Avoid a plain beige-only look; keep it moderately vivid. "
-            "Use only ONE tasteful accent point if needed. "
-        )
-        if must:
-            edit_prompt += "Must include: " + "; ".join(must) + ". "
-        if must_not:
-            edit_prompt += "Must NOT include: " + "; ".join(must_not) + ". "
-
-    # -----------------------------------------------------
-    # (4) Image edit
-    # -----------------------------------------------------
+        "temperature": 0.25,
+        "timeout": stage_timeout("edit_prompt")
+    })
+
+def parse_edit_prompt(content: str, truncated: bool = False):
+    """
+    edit_prompt_en を取り出す。読めない・途中で切れている（書きかけのプロンプトを images.edit に送らない）なら None
+    （呼び出し側で fallback_edit_prompt に落とす）
+    """
+    try:
+        if truncated:
+            raise TruncatedJsonError("edit_prompt の返答が途中で切れています")
+        spec = safe_extract_json(content, strict=True)
+    except ValueError:
+        record_error("edit_prompt_parse")
+        return None
+    return str(spec.get("edit_prompt_en") or "").strip() or None
+
+def generate_edit_prompt(plan_text: str, free_spec: dict, selected_summary: dict, user_text: str, cancelled=None) -> str:
+    req = edit_prompt_request(plan_text, free_spec, selected_summary, user_text)
+    spec_res = call_with_retry("edit_prompt", lambda: client.chat.completions.create(**req), estimate_tokens(req),
+                               cancelled=cancelled)
+    record_usage("edit_prompt", spec_res)
+    edit_prompt = parse_edit_prompt(spec_res.choices[0].message.content, cut_off(spec_res))
+    return edit_prompt or fallback_edit_prompt(free_spec)
+
+def try_generate_edit_prompt(plan_text: str, free_spec: dict, selected_summary: dict, user_text: str, cancelled):
+    """
+    投機実行用: 失敗したら None（勝者になった場合だけ作り直す）
+    cancelled は負けが決まったら立つ。立っているか、上流の枠が空いていなければ投げずに None
+    """
+    try:
+        return generate_edit_prompt(plan_text, free_spec, selected_summary, user_text, cancelled)
+    except SpeculationSkipped:
+        return None
+    except Exception:
+        record_error("edit_prompt")
+        return None
+
+def image_edit_request(img_stream: io.BytesIO, edit_prompt: str) -> dict:
+    img_stream.seek(0)
+    return {
+        "model": "gpt-image-1",
+        "image": img_stream,
+        "prompt": edit_prompt,
+        "size": "1024x1024",
+        "n": 1,
+        "timeout": stage_timeout("image")
+    }
+
+def parse_image_result(img_res) -> dict:
     image_data_url = None
     image_error = None
+    b64 = getattr(img_res.data[0], "b64_json", None)
+    url = getattr(img_res.data[0], "url", None)
+    if b64 and IMAGE_DELIVERY == "inline":
+        image_data_url = "data:image/png;base64," + b64
+    elif b64:
+        image_data_url = "/api/images/" + store_image_artifact(b64)
+    elif url:
+        image_data_url = url
+    else:
+        image_error = "画像データがレスポンスに含まれていません（b64_json/url共に無し）"
+    return {"image_data_url": image_data_url, "image_error": image_error}
+
+def run_image_edit(img_stream: io.BytesIO, edit_prompt: str) -> dict:
     try:
-        img_stream = io.BytesIO(img_bytes)
-        img_stream.name = "nail.jpg"
-        img_res = client.images.edit(
-            model="gpt-image-1",
-            image=img_stream,
-            prompt=edit_prompt,
-            size="1024x1024",
-            n=1
-        )
-        b64 = getattr(img_res.data[0], "b64_json", None)
-        url = getattr(img_res.data[0], "url", None)
-        if b64:
-            image_data_url = "data:image/png;base64," + b64
-        elif url:
-            image_data_url = url
-        else:
-            image_error = "画像データがレスポンスに含まれていません（b64_json/url共に無し）"
+        img_res = call_with_retry("image", lambda: image_client.images.edit(**image_edit_request(img_stream, edit_prompt)))
+        record_usage("image", img_res)
+        return parse_image_result(img_res)
     except Exception as e:
-        image_error = str(e)
+        record_error("image")
+        return {"image_data_url": None, "image_error": str(e)}
+
+SYNC_STAGE_OPS = SimpleNamespace(
+    extract_free_spec=extract_free_spec,
+    prepare_image_upload=prepare_image_upload,
+    generate_candidate=generate_candidate,
+    generate_candidates_fanout=generate_candidates_fanout,
+    generate_candidates_incremental=generate_candidates_incremental,
+    evaluate_candidates=evaluate_candidates,
+    generate_edit_prompt=generate_edit_prompt,
+    try_generate_edit_prompt=try_generate_edit_prompt,
+    run_image_edit=run_image_edit,
+)
+
+def stage_candidates(r: dict) -> list:
+    """
+    ステージ結果から候補のリスト（1人モードは cand_A/B/C、複数ペルソナ比較は candidates）
+    """
+    if "candidates" in r:
+        return r["candidates"]["candidates"]
+    return [r["cand_" + cid] for cid in CANDIDATE_IDS]
+
+def build_finalize_stages(img_bytes: bytes, form: dict, posterior: list, persona: dict,
+                          user_text: str, selected_summary: dict, ops=SYNC_STAGE_OPS, use_cache: bool = True,
+                          personas: list = None) -> dict:
+    """
+    finalize のステージ依存グラフ
+      free_spec ─┬─ cand_A/B/C ─┬─ prefilter ─ eval ─ picked ─ edit_prompt ─ image
+                 │              └─ edit_prompt_A/B/C（投機的, eval と並走）
+      upload ────┴──────────────────────────────────────────────────────────┘
+    edit_prompt は picked と勝者の edit_prompt_X だけを待つ（負けた案の分は待たずに捨てる）
+    prefilter（LOCAL_PREFILTER）は語彙マッチで NG 案を落とし、1案しか残らなければ eval は LLM を呼ばない
+    ops はステージの実処理（asgi_app は AsyncOpenAI 版を渡す）
+    use_cache=False なら free_spec のキャッシュを使わない
+    personas を渡すと cand_A/B/C の代わりに candidates（ペルソナ × A/B/C、締め切りつき）1段にして、
+    eval でまとめて採点する（投機的 edit_prompt はしない）
+    INCREMENTAL_EVAL なら candidates の中で届いた順に1案ずつ採点し、十分良い案が出たら残りを打ち切る
+    （eval はその採点結果をまとめるだけ）
+    """
+    free_text = str(form.get("avoid_colors", "") or "").strip()
+    if personas or INCREMENTAL_EVAL:
+        cand_keys = ["candidates"]
+    else:
+        cand_keys = ["cand_" + cid for cid in CANDIDATE_IDS]
+    prefilter = LOCAL_PREFILTER and not INCREMENTAL_EVAL  # incremental は1案ずつ中でやる
+    deadline = time.monotonic() + FANOUT_DEADLINE_SEC
+
+    def judged(r):
+        if INCREMENTAL_EVAL:
+            return r["candidates"]["judged"]
+        return r["prefilter"]["survivors"] if prefilter else stage_candidates(r)
+
+    def judge(r):
+        if INCREMENTAL_EVAL:
+            return r["candidates"]["eval"]
+        # ローカル事前フィルタで1案しか残らなければ LLM 採点は飛ばす（残ったのが代替案なら飛ばさない。
+        # avoid_colors から推しただけの NG で落とした案があるときも、読み違いかもしれないので飛ばさない）
+        survivors = r["prefilter"]["survivors"] if prefilter else []
+        if len(survivors) == 1 and not is_fallback_candidate(survivors[0]) and not r["prefilter"]["inferred_drop"]:
+            return local_eval_payload(r["prefilter"])
+        return ops.evaluate_candidates(judged(r), r["free_spec"], selected_summary)
+
+    # 勝者が決まったら負けた案の投機 edit_prompt を止める
+    losers = {cid: threading.Event() for cid in CANDIDATE_IDS}
+
+    def pick(r):
+        picked = pick_by_expected_utility(judged(r), r["eval"], posterior, r["free_spec"])
+        winner = (picked.get("candidate") or {}).get("id")
+        for cid, cancelled in losers.items():
+            if cid != winner:
+                cancelled.set()
+        return picked
+
+    def picked_plan(r):
+        cands = stage_candidates(r)
+        return (r["picked"].get("candidate") or {}).get("plan_ja") or cands[0].get("plan_ja", "")
+
+    stages = {
+        "free_spec": ((), lambda r: ops.extract_free_spec(free_text, selected_summary, use_cache)),
+        "upload": ((), lambda r: ops.prepare_image_upload(img_bytes)),
+        "eval": (("prefilter",) if prefilter else tuple(cand_keys), judge),
+        "picked": (("eval",), pick),
+    }
+    if prefilter:
+        stages["prefilter"] = (
+            tuple(cand_keys),
+            lambda r: local_prefilter(stage_candidates(r), r["free_spec"], selected_summary)
+        )
+    if INCREMENTAL_EVAL:
+        jobs = fanout_jobs(personas) if personas else [(cid, persona) for cid in CANDIDATE_IDS]
+        stages["candidates"] = (
+            ("free_spec",),
+            lambda r: ops.generate_candidates_incremental(
+                jobs, user_text, selected_summary, r["free_spec"], posterior, deadline)
+        )
+    elif personas:
+        stages["candidates"] = (
+            ("free_spec",),
+            lambda r: ops.generate_candidates_fanout(personas, user_text, selected_summary, r["free_spec"], deadline)
+        )
+    else:
+        for cid in CANDIDATE_IDS:
+            stages["cand_" + cid] = (
+                ("free_spec",),
+                lambda r, cid=cid: ops.generate_candidate(cid, persona, user_text, selected_summary, r["free_spec"])
+            )
+
+    if SPECULATIVE_EDIT_PROMPT and "cand_" + CANDIDATE_IDS[0] in cand_keys:
+        # eval の結果を待たずに全候補分の edit_prompt を作っておき、勝者の分だけ使う
+        for cid in CANDIDATE_IDS:
+            stages["edit_prompt_" + cid] = speculative_stage(
+                ("free_spec", "cand_" + cid),
+                lambda r, cid=cid: ops.try_generate_edit_prompt(
+                    r["cand_" + cid].get("plan_ja", ""), r["free_spec"], selected_summary, user_text, losers[cid]),
+                losers[cid]
+            )
+
+        def winner_edit_prompt(r):
+            winner = (r["picked"].get("candidate") or {}).get("id")
+            return "edit_prompt_" + winner if winner in CANDIDATE_IDS else None
+
+        def select_edit_prompt(r):
+            winner = (r["picked"].get("candidate") or {}).get("id")
+            speculated = r.get("edit_prompt_" + str(winner))
+            if speculated:
+                return speculated
+            return ops.generate_edit_prompt(picked_plan(r), r["free_spec"], selected_summary, user_text)
+
+        stages["edit_prompt"] = (("picked", winner_edit_prompt), select_edit_prompt)
+    else:
+        stages["edit_prompt"] = (
+            ("picked",),
+            lambda r: ops.generate_edit_prompt(picked_plan(r), r["free_spec"], selected_summary, user_text)
+        )
+
+    stages["image"] = (("edit_prompt", "upload"), lambda r: ops.run_image_edit(r["upload"], r["edit_prompt"]))
+    return stages
+
+def build_finalize_payload(r: dict, posterior: list, persona: dict, result_token: str = None, base_url: str = "") -> dict:
+    """
+    ステージ結果 -> レスポンスJSON（Flask/ASGI 共通の契約）
+    """
+    free_spec = r["free_spec"]
+    candidates = stage_candidates(r)
+    picked = r["picked"]
+    plan_text = (picked.get("candidate") or {}).get("plan_ja") or candidates[0].get("plan_ja", "")
+    picked_id = (picked.get("candidate") or {}).get("id")
+    if "candidates" in r and ":" in str(picked_id):
+        # 複数ペルソナ比較なら勝った案のネイリスト
+        persona = PERSONA_REGISTRY.get(picked_id.rsplit(":", 1)[0])
 
     top = sorted(
         [{"type": th["id"], "name": th["name"], "p": posterior[i]} for i, th in enumerate(TYPE_SPACE)],
@@ -955,21 +3362,498 @@ Chosen nail plan (Japanese, for reference only):
         reverse=True
     )[:3]
 
-    return jsonify({
+    return {
         "plan": plan_text,
-        "image_data_url": image_data_url,
-        "image_error": image_error,
+        "image_data_url": public_image_url(r["image"]["image_data_url"], base_url),
+        "image_error": r["image"]["image_error"],
+        "result_token": result_token,
         "debug": {
             "persona_id_used": persona.get("persona_id"),
             "persona_name": persona.get("display_name"),
             "free_spec": free_spec,
             "posterior_top3": top,
             "picked_expected_utility": picked.get("eu"),
-            "picked_id": (picked.get("candidate") or {}).get("id"),
+            "picked_id": picked_id,
             "candidates_debug": candidates,
-            "eval_debug": eval_payload
+            "eval_debug": r["eval"],
+            "prefilter_debug": r.get("prefilter") and {k: r["prefilter"][k] for k in ("terms", "scores")},
+            "generation": {
+                k: r["candidates"][k] for k in ("persona_ids", "dropped", "early_exit", "prefilter_scores")
+                if k in r["candidates"]
+            } if "candidates" in r else None
         }
+    }
+
+VARIATION_PROMPT_SUFFIX = (
+    " Create a fresh variation of this same design: keep the concept, palette and accent placement,"
+    " but vary small details such as art strokes, glitter density and accent finish."
+)
+
+def store_result(img_bytes: bytes, r: dict) -> str:
+    """
+    画像だけ作り直せるように、finalize 済みの edit_prompt / plan / 画像を短期保存する
+    """
+    picked = (r["picked"].get("candidate") or {})
+    token = secrets.token_urlsafe(16)
+    RESULT_STORE.put(token, {
+        "img_bytes": img_bytes,
+        "edit_prompt": r["edit_prompt"],
+        "plan": picked.get("plan_ja") or stage_candidates(r)[0].get("plan_ja", ""),
+        "picked_id": picked.get("id"),
+    })
+    return token
+
+def load_result(token, variation="") -> tuple:
+    """
+    -> (result, edit_prompt)。variation が立っていれば同じプランの別バリエーションを頼む
+    """
+    token = str(token or "").strip()
+    result = RESULT_STORE.get(token) if token else None
+    if result is None:
+        raise GameInputError("結果の有効期限が切れました。最初からやり直してください。")
+    edit_prompt = result["edit_prompt"]
+    if str(variation or "").strip().lower() in ("1", "true", "yes"):
+        edit_prompt += VARIATION_PROMPT_SUFFIX
+    return result, edit_prompt
+
+def build_retry_payload(token: str, result: dict, image: dict, base_url: str = "") -> dict:
+    return {
+        "plan": result["plan"],
+        "image_data_url": public_image_url(image["image_data_url"], base_url),
+        "image_error": image["image_error"],
+        "result_token": token,
+    }
+
+def stage_event(name: str, value, r: dict):
+    """
+    ステージ完了 -> ストリームに流すイベント (event, data)。流さないステージは None
+    """
+    if name == "free_spec":
+        return "free_spec", value
+    if name.startswith("cand_"):
+        return "candidate", value
+    if name == "candidates":
+        return "candidates", value
+    if name == "eval":
+        return "eval", value
+    if name == "picked":
+        picked = value.get("candidate") or {}
+        plan = picked.get("plan_ja") or stage_candidates(r)[0].get("plan_ja", "")
+        return "plan", {"plan": plan, "picked_id": picked.get("id"), "picked_expected_utility": value.get("eu")}
+    return None
+
+def timing_debug(timings: dict, t0: float) -> dict:
+    """debug.timing: stages は始まった順のリスト（JSON のオブジェクトにするとキー順で並べ替えられるので）"""
+    stages = [{"stage": name, **t} for name, t in timings.items()]
+    return {"total_ms": round(1000 * (time.perf_counter() - t0), 1),
+            "stages": sorted(stages, key=lambda t: t["start_ms"] or 0)}
+
+def finalize_events(img_bytes: bytes, form: dict, posterior: list, use_cache: bool = True, base_url: str = "",
+                    timing: bool = False, timings: dict = None, t0: float = None):
+    """
+    finalize をステージ完了ごとの (event, data) として流す。最後は "result"（通常のレスポンスと同じJSON）
+    timing=True なら debug.timing にステージごとの内訳を入れる。ルートで測った posterior / ask_more の分は
+    timings と、そのときの起点 t0（perf_counter）で渡す
+    """
+    t0 = time.perf_counter() if t0 is None else t0
+    timings = {} if timings is None else timings
+    user_text = build_user_text(form)
+    selected_summary = build_selected_summary(form)
+    persona = get_persona_from_form(form)
+    personas = personas_from_form(form)
+
+    stages = build_finalize_stages(img_bytes, form, posterior, persona, user_text, selected_summary,
+                                   use_cache=use_cache, personas=personas)
+    r = {}
+    for name, value in iter_stage_graph(stages, timings, t0):
+        r[name] = value
+        ev = stage_event(name, value, r)
+        if ev is not None:
+            yield ev
+    payload = build_finalize_payload(r, posterior, persona, store_result(img_bytes, r), base_url)
+    if timing:
+        payload["debug"]["timing"] = timing_debug(timings, t0)
+    yield "result", payload
+
+def finalize_with_posterior(img_bytes: bytes, form: dict, posterior: list, use_cache: bool = True, base_url: str = "",
+                            timing: bool = False, timings: dict = None, t0: float = None):
+    payload = None
+    for event, data in finalize_events(img_bytes, form, posterior, use_cache, base_url, timing, timings, t0):
+        if event == "result":
+            payload = data
+    return jsonify(payload)
+
+# =========================================================
+# 7) Streaming (Server-Sent Events)
+# =========================================================
+
+def wants_stream(accept: str = "", stream: str = "") -> bool:
+    """
+    ?stream=1 か Accept: text/event-stream ならステージごとに SSE で返す
+    """
+    if "text/event-stream" in (accept or ""):
+        return True
+    return str(stream or "").strip().lower() in ("1", "true", "yes")
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_response(events):
+    def generate():
+        try:
+            for event, data in events:
+                yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+# =========================================================
+# 8) Background jobs (SQLite queue + worker threads)
+# =========================================================
+# ?job=1（か Prefer: respond-async、JOB_MODE=1 なら常に）で finalize をキューに積んで
+# すぐ 202 + job_id を返し、ワーカーが裏で回す。進み具合と結果は GET /api/jobs/<job_id>。
+# キューは SQLite なのでプロセスが落ちても残り、lease が切れた running は別のワーカーが拾い直す。
+# ワーカーは Web プロセス内のスレッド（JOB_WORKERS）でも、別プロセス（python job_worker.py）でもよい。
+# 別プロセスにするなら画像の作り直し用の結果も共有されるよう SESSION_BACKEND=sqlite にする。
+
+JOB_MODE = os.getenv("JOB_MODE", "0") == "1"
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "nail_jobs.sqlite3"))
+JOB_BLOB_DIR = os.getenv("JOB_BLOB_DIR", os.path.join(tempfile.gettempdir(), "nail_job_blobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # この Web プロセスで回すワーカースレッド数（0 なら積むだけ）
+JOB_LEASE_SEC = float(os.getenv("JOB_LEASE_SEC", "300"))  # ステージが進むたびに延長。切れたら拾い直される
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+JOB_MAX_QUEUED = int(os.getenv("JOB_MAX_QUEUED", "500"))
+JOB_TTL_SEC = float(os.getenv("JOB_TTL_SEC", str(60 * 60)))  # 終わったジョブ（結果）を残す時間
+JOB_POLL_SEC = float(os.getenv("JOB_POLL_SEC", "0.5"))
+
+def wants_job(prefer: str = "", job: str = "") -> bool:
+    return JOB_MODE or query_flag(job) or "respond-async" in (prefer or "").lower()
+
+class JobQueue:
+    """
+    jobs テーブル 1行 = finalize 1回。画像は blob ディレクトリにファイルで置く
+    status: queued -> running -> done / failed（running のまま lease が切れたら queued 扱い）
+    claim するたびに claims を1つ進め、その値を持っている worker の書き込みだけを通す
+    （lease 切れで別の worker に取られたあとの遅れた finish / fail が結果を上書きしないように）
+    attempts は実際に回した回数。混雑（UpstreamBusy）で戻したぶんは数えない
+    """
+    def __init__(self, db_path: str, blob_dir: str, lease_sec: float = JOB_LEASE_SEC,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, ttl_sec: float = JOB_TTL_SEC):
+        self.db_path = db_path
+        self.blob_dir = blob_dir
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+        self.ttl_sec = ttl_sec
+        os.makedirs(blob_dir, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT NOT NULL, stage TEXT NOT NULL, attempts INTEGER NOT NULL,"
+                " created REAL NOT NULL, updated REAL NOT NULL, lease_until REAL NOT NULL,"
+                " params TEXT NOT NULL, blob_path TEXT NOT NULL, result TEXT, error TEXT,"
+                " claims INTEGER NOT NULL DEFAULT 0, not_before REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in con.execute("PRAGMA table_info(jobs)")}
+            for col, typ in (("claims", "INTEGER"), ("not_before", "REAL")):
+                if col not in columns:  # 前の版で作った DB
+                    con.execute(f"ALTER TABLE jobs ADD COLUMN {col} {typ} NOT NULL DEFAULT 0")
+            con.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created)")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def _remove_blob(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def overloaded(self):
+        """JOB_MAX_QUEUED まで積まれていれば retry_after 秒、まだ積めるなら None"""
+        with self._connect() as con:
+            (queued,) = con.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()
+        if queued >= JOB_MAX_QUEUED:
+            return JOB_LEASE_SEC * queued / max(1, JOB_MAX_QUEUED) / 10
+        return None
+
+    def submit(self, img_bytes: bytes, params: dict) -> str:
+        retry_after = self.overloaded()
+        if retry_after is not None:
+            raise UpstreamBusy("jobs", retry_after)
+        job_id = secrets.token_urlsafe(16)
+        path = os.path.join(self.blob_dir, f"job_{job_id}.bin")
+        with open(path + ".tmp", "wb") as f:
+            f.write(img_bytes)
+        os.replace(path + ".tmp", path)
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "INSERT INTO jobs (id, status, stage, attempts, created, updated, lease_until, params, blob_path)"
+                " VALUES (?, 'queued', 'queued', 0, ?, ?, 0, ?, ?)",
+                (job_id, now, now, json.dumps(params, ensure_ascii=False), path)
+            )
+        return job_id
+
+    def claim(self):
+        """
+        いちばん古い queued（か lease 切れの running）を取る -> (job_id, claim, img_bytes, params) / None
+        not_before（混雑で戻したときの retry_after）が来ていないものは飛ばす
+        BEGIN IMMEDIATE で書き込みロックを取ってから選ぶので、複数プロセスでも二重に取らない
+        """
+        now = time.time()
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute(
+                "SELECT id, params, blob_path, claims FROM jobs"
+                " WHERE (status = 'queued' OR (status = 'running' AND lease_until < ?)) AND attempts < ?"
+                " AND not_before <= ? ORDER BY created LIMIT 1",
+                (now, self.max_attempts, now)
+            ).fetchone()
+            if row is not None:
+                con.execute(
+                    "UPDATE jobs SET status = 'running', stage = 'started', attempts = attempts + 1,"
+                    " claims = claims + 1, updated = ?, lease_until = ? WHERE id = ?",
+                    (now, now + self.lease_sec, row[0])
+                )
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+        if row is None:
+            return None
+        job_id, params, blob_path, claims = row
+        claim = claims + 1
+        try:
+            with open(blob_path, "rb") as f:
+                img_bytes = f.read()
+        except OSError:
+            self.fail(job_id, claim, "アップロード画像が見つかりません", retry=False)
+            return None
+        return job_id, claim, img_bytes, json.loads(params)
+
+    def _update_running(self, job_id: str, claim: int, sets: str, args: tuple) -> bool:
+        """自分の claim がまだ生きているときだけ更新する（取られていたら False）"""
+        with self._connect() as con:
+            return con.execute(
+                f"UPDATE jobs SET {sets} WHERE id = ? AND claims = ? AND status = 'running'",
+                args + (job_id, claim)
+            ).rowcount == 1
+
+    def heartbeat(self, job_id: str, claim: int) -> bool:
+        now = time.time()
+        return self._update_running(job_id, claim, "updated = ?, lease_until = ?", (now, now + self.lease_sec))
+
+    def set_stage(self, job_id: str, claim: int, stage: str) -> bool:
+        now = time.time()
+        return self._update_running(
+            job_id, claim, "stage = ?, updated = ?, lease_until = ?", (stage, now, now + self.lease_sec)
+        )
+
+    def _close(self, job_id: str, claim: int, status: str, result=None, error: str = None) -> bool:
+        done = self._update_running(
+            job_id, claim, "status = ?, stage = ?, updated = ?, lease_until = 0, result = ?, error = ?",
+            (status, status, time.time(), None if result is None else json.dumps(result, ensure_ascii=False), error)
+        )
+        if done:
+            with self._connect() as con:
+                row = con.execute("SELECT blob_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is not None:
+                self._remove_blob(row[0])
+        return done
+
+    def finish(self, job_id: str, claim: int, result: dict) -> bool:
+        return self._close(job_id, claim, "done", result=result)
+
+    def fail(self, job_id: str, claim: int, error: str, retry: bool = True) -> bool:
+        """retry=True で試行回数が残っていれば queued に戻す"""
+        if retry:
+            with self._connect() as con:
+                n = con.execute(
+                    "UPDATE jobs SET status = 'queued', stage = 'retrying', updated = ?, lease_until = 0, error = ?"
+                    " WHERE id = ? AND claims = ? AND status = 'running' AND attempts < ?",
+                    (time.time(), error, job_id, claim, self.max_attempts)
+                ).rowcount
+            if n:
+                return True
+        return self._close(job_id, claim, "failed", error=error)
+
+    def defer(self, job_id: str, claim: int, retry_after: float, error: str = None) -> bool:
+        """混雑で回せなかった。試行回数に数えずに retry_after 秒後まで寝かせる"""
+        now = time.time()
+        return self._update_running(
+            job_id, claim,
+            "status = 'queued', stage = 'waiting', attempts = attempts - 1, updated = ?, lease_until = 0,"
+            " not_before = ?, error = ?",
+            (now, now + retry_after, error)
+        )
+
+    def get(self, job_id: str):
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT status, stage, attempts, created, updated, lease_until, result, error FROM jobs WHERE id = ?",
+                (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        status, stage, attempts, created, updated, lease_until, result, error = row
+        if status == "running" and lease_until < time.time():
+            # ワーカーが落ちた。試行回数が残っていれば次に claim したワーカーがやり直す
+            status, stage = ("queued", "retrying") if attempts < self.max_attempts else ("failed", "failed")
+            error = error or "ワーカーが応答しなくなりました"
+        job = {"job_id": job_id, "status": status, "stage": stage, "attempts": attempts,
+               "created_at": created, "updated_at": updated}
+        if result is not None:
+            job["result"] = json.loads(result)
+        if error and status in ("failed", "queued"):
+            job["error"] = error
+        return job
+
+    def cleanup(self, limit: int = SESSION_CLEANUP_BATCH):
+        """終わってから ttl_sec 経ったジョブと、lease 切れのまま試行回数を使い切ったジョブを片付ける"""
+        now = time.time()
+        with self._connect() as con:
+            stale = con.execute(
+                "SELECT id, claims FROM jobs WHERE status = 'running' AND lease_until < ? AND attempts >= ? LIMIT ?",
+                (now, self.max_attempts, limit)
+            ).fetchall()
+            rows = con.execute(
+                "SELECT id, blob_path FROM jobs WHERE status IN ('done', 'failed') AND updated <= ? LIMIT ?",
+                (now - self.ttl_sec, limit)
+            ).fetchall()
+            con.executemany("DELETE FROM jobs WHERE id = ?", [(r[0],) for r in rows])
+        for job_id, claim in stale:
+            self._close(job_id, claim, "failed", error="ワーカーが応答しなくなりました")
+        for _, path in rows:
+            self._remove_blob(path)
+
+    def stats(self) -> dict:
+        with self._connect() as con:
+            rows = con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+_JOB_QUEUE = None
+_JOB_QUEUE_LOCK = threading.Lock()
+
+def job_queue() -> JobQueue:
+    """
+    最初の submit / status で作る（ジョブモードを使わないプロセスでは DB も blob ディレクトリも作らない）
+    """
+    global _JOB_QUEUE
+    with _JOB_QUEUE_LOCK:
+        if _JOB_QUEUE is None:
+            _JOB_QUEUE = JobQueue(JOB_DB_PATH, JOB_BLOB_DIR)
+        return _JOB_QUEUE
+
+METRICS.append(Gauge("nail_jobs", "Background finalize jobs, by status",
+                     lambda: [({"status": status}, n) for status, n in sorted(_JOB_QUEUE.stats().items())]
+                     if _JOB_QUEUE is not None else []))
+
+def job_admission_check():
+    """
+    ?job=1 の受付。上流の混み具合では断らない（混んでいるときのためのキュー。走らせる側が defer する）。
+    JOB_MAX_QUEUED まで積まれていれば UpstreamBusy
+    """
+    retry_after = job_queue().overloaded()
+    if retry_after is not None:
+        UPSTREAM_REJECTED.inc(kind="jobs")
+        raise UpstreamBusy("jobs", retry_after)
+
+def submit_job(img_bytes: bytes, form: dict, posterior: list, use_cache: bool = True, base_url: str = "",
+               timing: bool = False) -> dict:
+    """finalize をキューに積む -> 202 で返す本文"""
+    job_id = job_queue().submit(img_bytes, {
+        "form": form, "posterior": list(posterior), "use_cache": use_cache, "base_url": base_url, "timing": timing,
     })
+    ensure_job_workers()
+    return {"status": "queued", "job_id": job_id, "status_url": f"{base_url.rstrip('/')}/api/jobs/{job_id}"}
+
+def run_job(queue: JobQueue, job_id: str, claim: int, img_bytes: bytes, params: dict):
+    # images.edit は再試行込みで lease より長くかかりうるので、ステージの合間とは別に lease を延ばし続ける
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(queue.lease_sec / 3):
+            if not queue.heartbeat(job_id, claim):
+                return
+
+    beat = threading.Thread(target=heartbeat, name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+    beat.start()
+    try:
+        payload = None
+        for event, data in finalize_events(img_bytes, params["form"], params["posterior"], params["use_cache"],
+                                           params["base_url"], params["timing"]):
+            if event == "result":
+                payload = data
+            else:
+                queue.set_stage(job_id, claim, event)
+        queue.finish(job_id, claim, payload)
+    except UpstreamBusy as e:
+        queue.defer(job_id, claim, e.retry_after, str(e))
+    except Exception as e:
+        record_error("job")
+        queue.fail(job_id, claim, str(e))
+    finally:
+        stop.set()
+
+class JobWorkers:
+    """queue を見張って run_job するスレッドたち"""
+
+    def __init__(self, queue: JobQueue, n: int):
+        self.queue = queue
+        self.n = n
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except sqlite3.Error:
+                job = None
+            if job is None:
+                self._stop.wait(JOB_POLL_SEC)
+                continue
+            run_job(self.queue, *job)
+
+    def start(self):
+        with self._lock:
+            if self._threads or self.n <= 0:
+                return
+            for i in range(self.n):
+                t = threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+_JOB_WORKER_POOL = None
+_JOB_WORKER_POOL_LOCK = threading.Lock()
+
+def ensure_job_workers():
+    """最初にジョブを積んだ/覗いたときに起動（前のプロセスが残したジョブもここで拾われる）"""
+    global _JOB_WORKER_POOL
+    queue = job_queue()
+    with _JOB_WORKER_POOL_LOCK:
+        if _JOB_WORKER_POOL is None:
+            _JOB_WORKER_POOL = JobWorkers(queue, JOB_WORKERS)
+        _JOB_WORKER_POOL.start()
+
+def job_status(job_id: str):
+    """GET /api/jobs/<job_id> の本文（見つからなければ None）"""
+    ensure_job_workers()
+    queue = job_queue()
+    queue.cleanup()
+    return queue.get((job_id or "").strip())
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
@@ -0,0 +1,572 @@
+"""
+ASGI 版のエントリーポイント（/api/game/start, /api/game/answer, /api/game/retry_image）
+
+Flask 版 (app.py) と同じルート・CORS・JSON 契約のまま、AsyncOpenAI で
+finalize を回すので、1プロセスで大量の待ち状態のパイプラインを抱えられる。
+?job=1 で積んだジョブだけは app.py のワーカー（スレッド + 同期版パイプライン）が回す。
+セッション/結果ストアと、SQLite 層のある LLM 応答キャッシュは asyncio.to_thread 越しに呼ぶ。
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 10000
+"""
+import asyncio
+import inspect
+import os
+import time
+from types import SimpleNamespace
+
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from app import (
+    CANDIDATE_STREAM,
+    CORS_ORIGINS,
+    FANOUT_MAX_CONCURRENCY,
+    FREE_SPEC_CACHE,
+    IMAGE_ARTIFACT_TTL_SEC,
+    LOCAL_PREFILTER,
+    METRICS_CONTENT_TYPE,
+    SSE_HEADERS,
+    TRUSTED_PROXY_HOPS,
+    GameInputError,
+    SpeculationSkipped,
+    UpstreamBusy,
+    JsonStreamParser,
+    admission_check,
+    build_finalize_payload,
+    build_finalize_stages,
+    build_retry_payload,
+    build_selected_summary,
+    build_user_text,
+    busy_headers,
+    cache_allowed,
+    candidate_request,
+    call_with_retry_async,
+    cleanup_sessions,
+    cut_off,
+    edit_prompt_request,
+    empty_free_spec,
+    estimate_tokens,
+    eval_request,
+    fallback_candidate,
+    fallback_edit_prompt,
+    fanout_jobs,
+    find_artifact,
+    finish_free_spec,
+    free_spec_cache_key,
+    free_spec_request,
+    get_persona_from_form,
+    image_edit_request,
+    incremental_result,
+    is_abandoned,
+    is_speculative,
+    job_admission_check,
+    job_status,
+    load_result,
+    local_score_candidate,
+    maybe_ask_more,
+    observe_stage,
+    openai_client,
+    parse_answers,
+    parse_candidate,
+    parse_edit_prompt,
+    parse_eval,
+    parse_free_spec,
+    parse_image_result,
+    passes_early_exit,
+    personas_from_form,
+    posterior_from_form,
+    prefilter_terms,
+    prepare_image_upload,
+    preprocess_upload,
+    query_flag,
+    quick_specificity_heuristic,
+    record_error,
+    record_usage,
+    record_stream_usage,
+    render_metrics,
+    resume_session,
+    sse_event,
+    stage_event,
+    stage_ready,
+    store_result,
+    submit_job,
+    timing_debug,
+    wants_job,
+    wants_stream,
+)
+
+# app.py の ProxyFix と同じ役目（request.base_url を X-Forwarded-Proto で https にする）。
+# TRUSTED_PROXY_HOPS > 0 のときだけ。信じる送り元は uvicorn の --forwarded-allow-ips と同じ環境変数で、
+# 既定は uvicorn と同じ 127.0.0.1（プロキシのアドレスが決まらない PaaS では明示的に "*" にする）
+FORWARDED_ALLOW_IPS = os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+aclient = openai_client("chat", is_async=True)
+aimage_client = openai_client("image", is_async=True)
+
+# =========================================================
+# 1) Async stage ops (same prompts/parsers as app.py)
+# =========================================================
+
+async def cache_get(cache, key: str):
+    """
+    ResponseCache.get。SQLite 層（LLM_CACHE_DB_PATH）があるときだけスレッドに逃がす（メモリだけなら dict 引き）
+    """
+    if cache.db_path:
+        return await asyncio.to_thread(cache.get, key)
+    return cache.get(key)
+
+async def cache_put(cache, key: str, value):
+    if cache.db_path:
+        await asyncio.to_thread(cache.put, key, value)
+    else:
+        cache.put(key, value)
+
+async def extract_free_spec(free_text: str, selected_summary: dict, use_cache: bool = True) -> dict:
+    free_text = (free_text or "").strip()
+    if not free_text:
+        return empty_free_spec()
+    req = free_spec_request(free_text, selected_summary)
+    key = free_spec_cache_key(free_text, selected_summary, req["model"])
+    spec = await cache_get(FREE_SPEC_CACHE, key) if use_cache else None
+    if spec is None:
+        try:
+            res = await call_with_retry_async(
+                "free_spec", lambda: aclient.chat.completions.create(**req), estimate_tokens(req)
+            )
+            record_usage("free_spec", res)
+            spec = parse_free_spec(res.choices[0].message.content, cut_off(res))
+        except Exception:
+            record_error("free_spec")
+            return empty_free_spec(quick_specificity_heuristic(free_text))
+        if use_cache:
+            await cache_put(FREE_SPEC_CACHE, key, spec)
+    return finish_free_spec(spec, free_text)
+
+async def read_json_stream(stream, req: dict = None) -> str:
+    parser, usage_chunk = JsonStreamParser(), None
+    try:
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage_chunk = chunk
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta and parser.feed(delta):
+                break
+    finally:
+        await stream.close()
+    record_stream_usage("candidate", usage_chunk, req or {}, parser.text)
+    return parser.text
+
+async def generate_candidate(candidate_id: str, persona: dict, user_text: str, selected_summary: dict, free_spec: dict) -> dict:
+    try:
+        req = candidate_request(candidate_id, persona, user_text, selected_summary, free_spec)
+        truncated = False  # ストリームは JSON が閉じたかどうかで見る（parse_candidate の drop_cut_field）
+        if CANDIDATE_STREAM:
+            content = await call_with_retry_async(
+                "candidate",
+                lambda: aclient.chat.completions.create(**req, stream=True, stream_options={"include_usage": True}),
+                estimate_tokens(req), consume=lambda stream: read_json_stream(stream, req),
+            )
+        else:
+            res = await call_with_retry_async(
+                "candidate", lambda: aclient.chat.completions.create(**req), estimate_tokens(req)
+            )
+            record_usage("candidate", res)
+            content, truncated = res.choices[0].message.content, cut_off(res)
+        return parse_candidate(content, candidate_id, persona, truncated)
+    except Exception:
+        record_error("candidate")
+        return fallback_candidate(candidate_id, persona)
+
+async def generate_candidates_fanout(personas: list, user_text: str, selected_summary: dict, free_spec: dict,
+                                     deadline: float) -> dict:
+    """
+    app.generate_candidates_fanout の asyncio 版。締め切りに間に合わなかったタスクはキャンセルする
+    """
+    jobs = fanout_jobs(personas)
+    sem = asyncio.Semaphore(max(1, FANOUT_MAX_CONCURRENCY))
+
+    async def one(cid, persona):
+        async with sem:
+            return await generate_candidate(cid, persona, user_text, selected_summary, free_spec)
+
+    tasks = [asyncio.ensure_future(one(cid, persona)) for cid, persona in jobs]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+        if not done:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return {
+        "candidates": [t.result() for t in tasks if t in done],
+        "dropped": [cid for (cid, _), t in zip(jobs, tasks) if t not in done],
+        "persona_ids": [p["persona_id"] for p in personas],
+    }
+
+async def evaluate_candidates(candidates: list, free_spec: dict, selected_summary: dict) -> dict:
+    req = eval_request(candidates, free_spec, selected_summary)
+    res = await call_with_retry_async("eval", lambda: aclient.chat.completions.create(**req), estimate_tokens(req))
+    record_usage("eval", res)
+    return parse_eval(res.choices[0].message.content, cut_off(res))
+
+async def judge_one(candidate: dict, terms, free_spec: dict, selected_summary: dict):
+    local = local_score_candidate(candidate, terms) if terms is not None else None
+    if local and local["disqualified"]:
+        return None, local
+    try:
+        results = (await evaluate_candidates([candidate], free_spec, selected_summary)).get("results") or []
+    except Exception:
+        return None, local
+    return (dict(results[0], id=candidate.get("id")) if results else None), local
+
+async def generate_candidates_incremental(jobs: list, user_text: str, selected_summary: dict, free_spec: dict,
+                                          posterior: list, deadline: float) -> dict:
+    """
+    app.generate_candidates_incremental の asyncio 版。打ち切った生成/採点はキャンセルし、
+    セマフォ待ちから抜けたものも stop を見て LLM を呼ばない
+    """
+    terms = prefilter_terms(free_spec, selected_summary) if LOCAL_PREFILTER else None
+    sem = asyncio.Semaphore(max(1, FANOUT_MAX_CONCURRENCY))
+    stop = asyncio.Event()
+
+    async def one(cid, persona):
+        async with sem:
+            if stop.is_set():
+                return None
+            c = await generate_candidate(cid, persona, user_text, selected_summary, free_spec)
+            if stop.is_set():
+                return c, None, None
+            return (c,) + await judge_one(c, terms, free_spec, selected_summary)
+
+    pending = {asyncio.ensure_future(one(cid, persona)): cid for cid, persona in jobs}
+    finished, early_exit = {}, None
+    try:
+        while pending and early_exit is None:
+            timeout = max(0.0, deadline - time.monotonic()) if finished else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                cid = pending.pop(task)
+                finished[cid] = task.result()
+                if early_exit is None and passes_early_exit(finished[cid][1], posterior, free_spec):
+                    early_exit = cid
+    finally:
+        stop.set()
+        for task in pending:
+            task.cancel()
+    return incremental_result(jobs, finished, early_exit)
+
+async def generate_edit_prompt(plan_text: str, free_spec: dict, selected_summary: dict, user_text: str,
+                               cancelled=None) -> str:
+    req = edit_prompt_request(plan_text, free_spec, selected_summary, user_text)
+    res = await call_with_retry_async("edit_prompt", lambda: aclient.chat.completions.create(**req), estimate_tokens(req),
+                                      cancelled=cancelled)
+    record_usage("edit_prompt", res)
+    edit_prompt = parse_edit_prompt(res.choices[0].message.content, cut_off(res))
+    return edit_prompt or fallback_edit_prompt(free_spec)
+
+async def try_generate_edit_prompt(plan_text: str, free_spec: dict, selected_summary: dict, user_text: str, cancelled):
+    try:
+        return await generate_edit_prompt(plan_text, free_spec, selected_summary, user_text, cancelled)
+    except SpeculationSkipped:
+        return None
+    except Exception:
+        record_error("edit_prompt")
+        return None
+
+async def run_image_edit(img_stream, edit_prompt: str) -> dict:
+    try:
+        img_res = await call_with_retry_async(
+            "image", lambda: aimage_client.images.edit(**image_edit_request(img_stream, edit_prompt))
+        )
+        record_usage("image", img_res)
+        # b64 デコードとファイル書き込みはイベントループの外で
+        return await asyncio.to_thread(parse_image_result, img_res)
+    except Exception as e:
+        record_error("image")
+        return {"image_data_url": None, "image_error": str(e)}
+
+ASYNC_STAGE_OPS = SimpleNamespace(
+    extract_free_spec=extract_free_spec,
+    prepare_image_upload=prepare_image_upload,
+    generate_candidate=generate_candidate,
+    generate_candidates_fanout=generate_candidates_fanout,
+    generate_candidates_incremental=generate_candidates_incremental,
+    evaluate_candidates=evaluate_candidates,
+    generate_edit_prompt=generate_edit_prompt,
+    try_generate_edit_prompt=try_generate_edit_prompt,
+    run_image_edit=run_image_edit,
+)
+
+# =========================================================
+# 2) Async stage graph
+# =========================================================
+
+async def _run_stage(name: str, fn, results: dict, timings: dict = None, origin: float = None):
+    with observe_stage(name, timings, origin):
+        value = fn(results)
+        if inspect.isawaitable(value):
+            value = await value
+        return value
+
+async def iter_stage_graph_async(stages: dict, timings: dict = None, origin: float = None):
+    """
+    app.iter_stage_graph の asyncio 版。ステージ関数は値かコルーチンを返してよい
+    負けが決まった（cancelled が立った）投機ステージと、最後に残った投機ステージはキャンセルする
+    （上流に投げている最中でも止まり、call_with_retry_async の finally で枠を返す）
+    """
+    results = {}
+    pending = dict(stages)
+    running = {}
+    origin = time.perf_counter() if origin is None else origin
+    try:
+        while pending or any(not is_speculative(stages[n]) for n in running.values()):
+            for name, (deps, fn) in list(pending.items()):
+                if stage_ready(deps, results):
+                    running[asyncio.ensure_future(_run_stage(name, fn, dict(results), timings, origin))] = name
+                    del pending[name]
+            if not running:
+                raise ValueError("ステージの依存関係が解決できません: " + ", ".join(sorted(pending)))
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = running.pop(task)
+                results[name] = task.result()
+                yield name, results[name]
+            for task in [t for t, name in running.items() if is_abandoned(stages[name])]:
+                del running[task]
+                task.cancel()
+    finally:
+        for task in running:
+            task.cancel()
+
+async def finalize_events(img_bytes: bytes, form: dict, posterior: list, use_cache: bool = True, base_url: str = "",
+                          timing: bool = False, timings: dict = None, t0: float = None):
+    t0 = time.perf_counter() if t0 is None else t0
+    timings = {} if timings is None else timings
+    user_text = build_user_text(form)
+    selected_summary = build_selected_summary(form)
+    persona = get_persona_from_form(form)
+    personas = personas_from_form(form)
+
+    stages = build_finalize_stages(img_bytes, form, posterior, persona, user_text, selected_summary,
+                                   ops=ASYNC_STAGE_OPS, use_cache=use_cache, personas=personas)
+    r = {}
+    async for name, value in iter_stage_graph_async(stages, timings, t0):
+        r[name] = value
+        ev = stage_event(name, value, r)
+        if ev is not None:
+            yield ev
+    result_token = await asyncio.to_thread(store_result, img_bytes, r)
+    payload = build_finalize_payload(r, posterior, persona, result_token, base_url)
+    if timing:
+        payload["debug"]["timing"] = timing_debug(timings, t0)
+    yield "result", payload
+
+async def finalize_with_posterior(img_bytes: bytes, form: dict, posterior: list, use_cache: bool = True,
+                                  base_url: str = "", timing: bool = False, timings: dict = None,
+                                  t0: float = None) -> JSONResponse:
+    payload = None
+    async for event, data in finalize_events(img_bytes, form, posterior, use_cache, base_url, timing, timings, t0):
+        if event == "result":
+            payload = data
+    return JSONResponse(payload)
+
+def sse_response(events) -> StreamingResponse:
+    async def generate():
+        try:
+            if hasattr(events, "__aiter__"):
+                async for event, data in events:
+                    yield sse_event(event, data)
+            else:
+                for event, data in events:
+                    yield sse_event(event, data)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+    return StreamingResponse(generate(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# =========================================================
+# 3) Routes
+# =========================================================
+
+def form_to_dict(form) -> dict:
+    """
+    app.form_to_dict と同じ形。Starlette の form はファイルも含むので除外する
+    """
+    data = {}
+    for k in form.keys():
+        vals = [v for v in form.getlist(k) if not isinstance(v, UploadFile)]
+        if not vals:
+            continue
+        data[k] = vals if len(vals) != 1 else vals[0]
+    return data
+
+async def game_start(request):
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+
+    t0, timings = time.perf_counter(), {}
+    try:
+        # セッション/結果ストアはファイルや SQLite を触るので、ここから先もイベントループの外で呼ぶ
+        await asyncio.to_thread(cleanup_sessions)
+
+        form_data = await request.form()
+        image_file = form_data.get("image")
+        if not isinstance(image_file, UploadFile):
+            return JSONResponse({"error": "爪の写真が必要です（image が見つかりません）"}, status_code=400)
+        img_bytes = await image_file.read()
+        if not img_bytes:
+            return JSONResponse({"error": "爪の写真が空でした（ファイルサイズ0の可能性）"}, status_code=400)
+        img_bytes = await asyncio.to_thread(preprocess_upload, img_bytes)
+
+        form = form_to_dict(form_data)
+        post = posterior_from_form(form, timings, t0)
+
+        stream = wants_stream(request.headers.get("accept", ""), request.query_params.get("stream", ""))
+
+        need_more = await asyncio.to_thread(maybe_ask_more, img_bytes, form, post, timings=timings, origin=t0)
+        if need_more is not None:
+            return sse_response([("need_more", need_more)]) if stream else JSONResponse(need_more)
+
+        job = wants_job(request.headers.get("prefer", ""), request.query_params.get("job", ""))
+        if job:
+            await asyncio.to_thread(job_admission_check)
+        else:
+            admission_check()
+        use_cache = cache_allowed(request.headers.get("cache-control", ""), request.query_params.get("no_cache", ""))
+        base_url = str(request.base_url)
+        timing = query_flag(request.query_params.get("timing", ""))
+        if job:
+            submitted = await asyncio.to_thread(submit_job, img_bytes, form, post, use_cache, base_url, timing)
+            return JSONResponse(submitted, status_code=202)
+        if stream:
+            return sse_response(finalize_events(img_bytes, form, post, use_cache, base_url, timing, timings, t0))
+        return await finalize_with_posterior(img_bytes, form, post, use_cache, base_url, timing, timings, t0)
+
+    except GameInputError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except UpstreamBusy as e:
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=503, headers=busy_headers(e))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def game_answer(request):
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+
+    t0, timings = time.perf_counter(), {}
+    try:
+        await asyncio.to_thread(cleanup_sessions)
+
+        form_data = await request.form()
+        answers = parse_answers(
+            form_data.get("answers", ""),
+            form_data.get("question_id", ""),
+            form_data.get("answer", "")
+        )
+        job = wants_job(request.headers.get("prefer", ""), request.query_params.get("job", ""))
+        if job:
+            await asyncio.to_thread(job_admission_check)
+        else:
+            admission_check()
+        img_bytes, form, post2, asked = await asyncio.to_thread(resume_session, form_data.get("token", ""), answers, timings, t0)
+
+        stream = wants_stream(request.headers.get("accept", ""), request.query_params.get("stream", ""))
+
+        need_more = await asyncio.to_thread(maybe_ask_more, img_bytes, form, post2, asked, timings, t0)
+        if need_more is not None:
+            return sse_response([("need_more", need_more)]) if stream else JSONResponse(need_more)
+
+        use_cache = cache_allowed(request.headers.get("cache-control", ""), request.query_params.get("no_cache", ""))
+        base_url = str(request.base_url)
+        timing = query_flag(request.query_params.get("timing", ""))
+        if job:
+            submitted = await asyncio.to_thread(submit_job, img_bytes, form, post2, use_cache, base_url, timing)
+            return JSONResponse(submitted, status_code=202)
+        if stream:
+            return sse_response(finalize_events(img_bytes, form, post2, use_cache, base_url, timing, timings, t0))
+        return await finalize_with_posterior(img_bytes, form, post2, use_cache, base_url, timing, timings, t0)
+
+    except GameInputError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except UpstreamBusy as e:
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=503, headers=busy_headers(e))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def game_retry_image(request):
+    if request.method == "OPTIONS":
+        return Response(status_code=204)
+
+    try:
+        await asyncio.to_thread(cleanup_sessions)
+
+        admission_check(("image",))
+        form_data = await request.form()
+        token = form_data.get("result_token", "")
+        result, edit_prompt = await asyncio.to_thread(load_result, token, form_data.get("variation", ""))
+        image = await run_image_edit(prepare_image_upload(result["img_bytes"]), edit_prompt)
+        return JSONResponse(build_retry_payload(token.strip(), result, image, str(request.base_url)))
+
+    except GameInputError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except UpstreamBusy as e:
+        return JSONResponse({"error": str(e), "retry_after": e.retry_after}, status_code=503, headers=busy_headers(e))
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def get_image(request):
+    """
+    app.get_image と同じ（ETag/If-None-Match, Range 対応）
+    """
+    artifact_id = request.path_params["artifact_id"]
+    path = find_artifact(artifact_id)
+    if path is None:
+        return JSONResponse({"error": "画像が見つかりません（期限切れの可能性）"}, status_code=404)
+    etag = f'"{artifact_id}"'
+    headers = {"etag": etag, "cache-control": f"public, max-age={int(IMAGE_ARTIFACT_TTL_SEC)}, immutable"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/png", headers=headers)
+
+async def get_job(request):
+    """
+    app.get_job と同じ
+    """
+    try:
+        job = await asyncio.to_thread(job_status, request.path_params["job_id"])
+        if job is None:
+            return JSONResponse({"error": "ジョブが見つかりません（期限切れの可能性）"}, status_code=404)
+        return JSONResponse(job)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def metrics(request):
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+app = Starlette(
+    routes=[
+        Route("/api/game/start", game_start, methods=["POST", "OPTIONS"]),
+        Route("/api/game/answer", game_answer, methods=["POST", "OPTIONS"]),
+        Route("/api/game/retry_image", game_retry_image, methods=["POST", "OPTIONS"]),
+        Route("/api/images/{artifact_id}", get_image, methods=["GET"]),
+        Route("/api/jobs/{job_id}", get_job, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    middleware=[
+        *([Middleware(ProxyHeadersMiddleware, trusted_hosts=FORWARDED_ALLOW_IPS)] if TRUSTED_PROXY_HOPS > 0 else []),
+        Middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_methods=["*"], allow_headers=["*"]),
+    ],
+)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("PORT", 10000))
+    uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,236 @@
+"""
+ローカル用の偽 OpenAI サーバー（chat.completions / images.edits だけ）
+
+app.py / asgi_app.py を OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 で向ければ、
+お金もネットワークも使わずにパイプライン全体を回せる。
+
+レイテンシは分布（const / uniform / lognormal）で揺らせるほか、一定割合で
+429/5xx を返したり、壊れた JSON（前後に文章・末尾カンマ・途中で切れる など）を
+返したりできるので、SDK の再試行や safe_extract_json の経路も負荷試験で通る。
+
+    python bench/fake_openai.py --port 18080 --latency-ms 800 --latency-dist lognormal \
+        --error-rate 0.02 --malformed-rate 0.1
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import random
+import re
+import struct
+import time
+import zlib
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+LATENCY_SEC = float(os.getenv("FAKE_OPENAI_LATENCY_MS", "800")) / 1000.0
+IMAGE_LATENCY_SEC = float(os.getenv("FAKE_OPENAI_IMAGE_LATENCY_MS", "3000")) / 1000.0
+LATENCY_DIST = os.getenv("FAKE_OPENAI_LATENCY_DIST", "const")  # const / uniform / lognormal
+LATENCY_JITTER = float(os.getenv("FAKE_OPENAI_LATENCY_JITTER", "0.3"))  # uniform なら ±割合、lognormal なら sigma
+ERROR_RATE = float(os.getenv("FAKE_OPENAI_ERROR_RATE", "0"))
+MALFORMED_RATE = float(os.getenv("FAKE_OPENAI_MALFORMED_RATE", "0"))
+
+ERROR_STATUSES = [429, 500, 503]
+MALFORMED_KINDS = ["prose", "trailing_comma", "single_quote", "truncated"]
+
+STATS = {"chat": 0, "image": 0, "errors": 0, "malformed": 0}
+
+def sample_latency(mean: float) -> float:
+    if mean <= 0:
+        return 0.0
+    if LATENCY_DIST == "uniform":
+        return random.uniform(mean * max(0.0, 1 - LATENCY_JITTER), mean * (1 + LATENCY_JITTER))
+    if LATENCY_DIST == "lognormal":
+        # 平均が mean になるように mu をずらす（裾が長い = p99 が伸びる）
+        sigma = max(LATENCY_JITTER, 1e-6)
+        return random.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+    return mean
+
+async def maybe_error(mean: float):
+    """
+    ERROR_RATE の割合で OpenAI 風のエラーを返す（429 には retry-after-ms を付ける）
+    """
+    if random.random() >= ERROR_RATE:
+        return None
+    STATS["errors"] += 1
+    await asyncio.sleep(sample_latency(mean) / 4)
+    status = random.choice(ERROR_STATUSES)
+    headers = {"retry-after-ms": "100"} if status == 429 else {}
+    kind = "rate_limit_exceeded" if status == 429 else "server_error"
+    return JSONResponse({"error": {"message": f"fake {status}", "type": kind, "code": kind}},
+                        status_code=status, headers=headers)
+
+def malform(content: str) -> str:
+    """
+    MALFORMED_RATE の割合で、LLM がやりがちな壊れ方をさせる
+    """
+    if random.random() >= MALFORMED_RATE:
+        return content
+    STATS["malformed"] += 1
+    kind = random.choice(MALFORMED_KINDS)
+    if kind == "prose":
+        return "以下が結果です。\n" + content + "\n以上、よろしくお願いします。"
+    if kind == "trailing_comma":
+        i = content.rfind("}")
+        return content[:i] + "," + content[i:] if i >= 0 else content
+    if kind == "single_quote":
+        return content.replace('"', "'")
+    return content[:max(1, int(len(content) * 0.7))]
+
+def _tiny_png(size: int = 64) -> bytes:
+    raw = b"".join(b"\x00" + b"\xf4\xc2\xc2" * size for _ in range(size))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+PNG_B64 = base64.b64encode(_tiny_png()).decode()
+
+CANNED_FREE_SPEC = {
+    "specificity": 55,
+    "must": ["ピンク系"],
+    "must_not": ["黒"],
+    "soft": ["ちゅるん"],
+    "keywords": ["ピンク", "ちゅるん"],
+    "summary": "黒NG・ピンク系"
+}
+
+def canned_content(system: str, user: str) -> str:
+    """
+    system プロンプトでステージを見分けて、それっぽい JSON を返す
+    """
+    if "strict evaluator" in system:
+        ids = re.findall(r'"id": "([A-Za-z0-9_:-]+)"', user.split("候補：", 1)[-1]) or ["A", "B", "C"]
+        results = []
+        for i, cid in enumerate(ids):
+            results.append({
+                "id": cid,
+                "scores": {
+                    "adherence_to_selections": 80 - i,
+                    "wearability_daily_fit": 75,
+                    "novelty_target_80": 70 + i,
+                    "colorfulness_not_beige_only": 72,
+                    "accent_fit_one_point": 70,
+                    "free_input_alignment": 78 - 2 * i
+                },
+                "notes": "fake"
+            })
+        return json.dumps({"results": results}, ensure_ascii=False)
+    if "image editing" in system:
+        return json.dumps({"edit_prompt_en": "Keep the same hand. Sheer pink nails with one aurora accent."})
+    if "ネイルアーティスト" in system:
+        m = re.search(r'"id": "([A-Za-z0-9_:-]+)"', user)
+        cid = m.group(1) if m else "A"
+        return "```json\n" + json.dumps({
+            "id": cid,
+            "plan_ja": f"【ネイルコンセプト】\n案{cid}: シアーピンクのちゅるんネイル\n【デザイン詳細】\nオーロラを1本だけ",
+            "style_hint": "fake"
+        }, ensure_ascii=False) + "\n```"
+    return json.dumps(CANNED_FREE_SPEC, ensure_ascii=False)
+
+STREAM_CHUNK_CHARS = 16
+
+def stream_chunks(model: str, content: str):
+    """
+    stream=True 用の chat.completion.chunk（最初のトークンまでに半分、残りを小分けに流す）
+    """
+    pieces = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)] or [""]
+    latency = sample_latency(LATENCY_SEC)
+
+    async def gen():
+        await asyncio.sleep(latency / 2)
+        for i, piece in enumerate(pieces):
+            if i:
+                await asyncio.sleep(latency / 2 / len(pieces))
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(gen(), media_type="text/event-stream")
+
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages") or []
+    system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    user = next((m.get("content", "") for m in messages if m.get("role") == "user"), "")
+    STATS["chat"] += 1
+    error = await maybe_error(LATENCY_SEC)
+    if error is not None:
+        return error
+    content = malform(canned_content(system, user))
+    if body.get("stream"):
+        return stream_chunks(body.get("model", "gpt-4o-mini"), content + "\n補足: {このあとの解説は読まなくてよい}")
+    await asyncio.sleep(sample_latency(LATENCY_SEC))
+    return JSONResponse({
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": len(user) // 2, "completion_tokens": len(content) // 2,
+                  "total_tokens": (len(user) + len(content)) // 2}
+    })
+
+async def images_edits(request: Request):
+    form = await request.form()
+    image = form.get("image")
+    if image is not None and hasattr(image, "read"):
+        await image.read()
+    STATS["image"] += 1
+    error = await maybe_error(IMAGE_LATENCY_SEC)
+    if error is not None:
+        return error
+    await asyncio.sleep(sample_latency(IMAGE_LATENCY_SEC))
+    return JSONResponse({"created": int(time.time()), "data": [{"b64_json": PNG_B64}]})
+
+async def stats(request: Request):
+    """負荷試験側が前後の差分を取るためのカウンタ"""
+    return JSONResponse(STATS)
+
+app = Starlette(routes=[
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/v1/images/edits", images_edits, methods=["POST"]),
+    Route("/_stats", stats, methods=["GET"]),
+])
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency-ms", type=float, default=LATENCY_SEC * 1000.0)
+    parser.add_argument("--image-latency-ms", type=float, default=IMAGE_LATENCY_SEC * 1000.0)
+    parser.add_argument("--latency-dist", choices=["const", "uniform", "lognormal"], default=LATENCY_DIST)
+    parser.add_argument("--latency-jitter", type=float, default=LATENCY_JITTER)
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE, help="429/5xx を返す割合")
+    parser.add_argument("--malformed-rate", type=float, default=MALFORMED_RATE, help="壊れた JSON を返す割合")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    LATENCY_SEC = args.latency_ms / 1000.0
+    IMAGE_LATENCY_SEC = args.image_latency_ms / 1000.0
+    LATENCY_DIST = args.latency_dist
+    LATENCY_JITTER = args.latency_jitter
+    ERROR_RATE = args.error_rate
+    MALFORMED_RATE = args.malformed_rate
+    random.seed(args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,246 @@
+"""
+偽 OpenAI サーバーに向けた負荷試験（同時接続数を上げたときのスループットを見る）
+
+偽サーバーとアプリ（asgi / flask）を子プロセスで立ち上げ、/api/game/start
+（need_more なら /api/game/answer まで）を同時接続数ごとに叩いて集計する。
+p50/p95/p99・rps・エラー率に加えて、モードごとにサーバープロセスのピーク RSS と
+アプリの /metrics に出たステージ失敗数（壊れた JSON のフォールバックなど）を出す。
+
+全セッションが同じ FORM を送るので、既定では Cache-Control: no-cache を付けて LLM 応答キャッシュを
+切る（付けないと 2セッション目以降は free_spec がキャッシュから返り、パイプラインを測れない）。
+キャッシュが当たったときの数字を見たいときだけ --cache を付ける。
+
+    python bench/loadtest.py --mode asgi,flask --concurrency 1,8,32,128 --requests 128 \\
+        --latency-dist lognormal --error-rate 0.02 --malformed-rate 0.1 --json baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORM = {
+    "age": "20代",
+    "nail_duration": "3週間",
+    "purpose": "仕事用",
+    "vibe": "上品",
+    "avoid_colors": "黒NG、ピンク系がいい",
+}
+
+NO_CACHE_HEADERS = {"Cache-Control": "no-cache"}
+
+ERRORS_RE = re.compile(r'^nail_stage_errors_total\{stage="([^"]+)"\} ([0-9.e+]+)$', re.M)
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    xs = sorted(values)
+    k = min(len(xs) - 1, max(0, int(round(q * (len(xs) - 1)))))
+    return xs[k]
+
+def wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/", timeout=0.5)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"port {port} が起動しませんでした")
+
+def peak_rss_mb(pid: int):
+    """/proc/<pid>/status の VmHWM（Linux 以外では None）"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+def start_fake_openai(port: int, args) -> subprocess.Popen:
+    cmd = [
+        sys.executable, os.path.join(ROOT, "bench", "fake_openai.py"),
+        "--port", str(port),
+        "--latency-ms", str(args.latency_ms),
+        "--image-latency-ms", str(args.image_latency_ms),
+        "--latency-dist", args.latency_dist,
+        "--latency-jitter", str(args.latency_jitter),
+        "--error-rate", str(args.error_rate),
+        "--malformed-rate", str(args.malformed_rate),
+    ]
+    if args.seed is not None:
+        cmd += ["--seed", str(args.seed)]
+    return subprocess.Popen(cmd)
+
+def start_app(mode: str, port: int, fake_port: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{fake_port}/v1"
+    env["OPENAI_API_KEY"] = "sk-fake"
+    env["PORT"] = str(port)
+    if mode == "asgi":
+        cmd = [sys.executable, "-m", "uvicorn", "asgi_app:app",
+               "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "app.py"]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def stage_errors(base: str) -> dict:
+    try:
+        text = httpx.get(base + "/metrics", timeout=5.0).text
+    except httpx.HTTPError:
+        return {}
+    return {stage: int(float(n)) for stage, n in ERRORS_RE.findall(text)}
+
+def fake_stats(fake_port: int) -> dict:
+    try:
+        return httpx.get(f"http://127.0.0.1:{fake_port}/_stats", timeout=5.0).json()
+    except httpx.HTTPError:
+        return {}
+
+def diff_counts(after: dict, before: dict) -> dict:
+    return {k: after[k] - before.get(k, 0) for k in after if after[k] - before.get(k, 0)}
+
+async def one_session(http: httpx.AsyncClient, base: str, image: bytes, headers: dict) -> str:
+    """
+    1セッション回して "ok" / "degraded"（結果は返ったが画像か採点が欠けた）/ "error" を返す
+    """
+    res = await http.post(base + "/api/game/start", data=FORM, headers=headers,
+                          files={"image": ("nail.jpg", image, "image/jpeg")})
+    body = res.json()
+    if body.get("status") == "need_more":
+        q = body["question"]
+        res = await http.post(base + "/api/game/answer", headers=headers, data={
+            "token": body["token"],
+            "question_id": q["id"],
+            "answer": q["options"][0]["value"],
+        })
+        body = res.json()
+    if res.status_code != 200 or not body.get("plan"):
+        return "error"
+    eval_debug = (body.get("debug") or {}).get("eval_debug") or {}
+    if body.get("image_error") or "parse_error" in eval_debug:
+        return "degraded"
+    return "ok"
+
+async def run_level(base: str, concurrency: int, total: int, image: bytes, headers: dict) -> dict:
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    outcomes = {"ok": 0, "degraded": 0, "error": 0}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(timeout=300.0, limits=limits) as http:
+        async def worker():
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    outcome = await one_session(http, base, image, headers)
+                except (httpx.HTTPError, ValueError):
+                    outcome = "error"
+                outcomes[outcome] += 1
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(total)])
+        wall = time.perf_counter() - t0
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        **outcomes,
+        "error_rate": outcomes["error"] / total if total else 0.0,
+        "wall_s": wall,
+        "rps": total / wall if wall > 0 else 0.0,
+        "p50_s": percentile(latencies, 0.50),
+        "p95_s": percentile(latencies, 0.95),
+        "p99_s": percentile(latencies, 0.99),
+    }
+
+def run_mode(mode: str, args, levels: list, image: bytes) -> dict:
+    server = start_app(mode, args.port, args.fake_port)
+    try:
+        wait_for_port(args.port)
+        base = f"http://127.0.0.1:{args.port}"
+        errors0, fake0 = stage_errors(base), fake_stats(args.fake_port)
+
+        print(f"\nmode={mode}")
+        print(f"{'conc':>5} {'reqs':>5} {'ok':>5} {'degr':>5} {'err':>5} {'wall_s':>8} {'rps':>8} "
+              f"{'p50_s':>8} {'p95_s':>8} {'p99_s':>8}")
+        rows = []
+        headers = {} if args.cache else NO_CACHE_HEADERS
+        for c in levels:
+            r = asyncio.run(run_level(base, c, args.requests or c, image, headers))
+            rows.append(r)
+            print(f"{r['concurrency']:>5} {r['requests']:>5} {r['ok']:>5} {r['degraded']:>5} {r['error']:>5} "
+                  f"{r['wall_s']:>8.2f} {r['rps']:>8.2f} {r['p50_s']:>8.2f} {r['p95_s']:>8.2f} {r['p99_s']:>8.2f}")
+
+        result = {
+            "mode": mode,
+            "levels": rows,
+            "peak_rss_mb": peak_rss_mb(server.pid),
+            "stage_errors": diff_counts(stage_errors(base), errors0),
+            "upstream": diff_counts(fake_stats(args.fake_port), fake0),
+        }
+        rss = result["peak_rss_mb"]
+        print(f"peak_rss={rss:.1f}MB" if rss is not None else "peak_rss=n/a",
+              f"stage_errors={result['stage_errors']} upstream={result['upstream']}")
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", default="asgi", help="asgi / flask（カンマ区切りで両方）")
+    parser.add_argument("--concurrency", default="1,8,32,128")
+    parser.add_argument("--requests", type=int, default=0, help="1段あたりのリクエスト数（0なら同時接続数と同じ）")
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--image-latency-ms", type=float, default=3000)
+    parser.add_argument("--latency-dist", choices=["const", "uniform", "lognormal"], default="const")
+    parser.add_argument("--latency-jitter", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="偽サーバーが 429/5xx を返す割合")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="偽サーバーが壊れた JSON を返す割合")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cache", action="store_true",
+                        help="LLM 応答キャッシュを効かせたまま回す（既定は no-cache。同じ FORM なので free_spec はほぼキャッシュヒットになる）")
+    parser.add_argument("--image", default=os.path.join(ROOT, "background_blue.png"), help="アップロードする写真")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--fake-port", type=int, default=18080)
+    parser.add_argument("--json", default="", help="結果を JSON で書き出す（ベースラインとして残す用）")
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.mode.split(",") if m.strip()]
+    for m in modes:
+        if m not in ("asgi", "flask"):
+            parser.error(f"--mode は asgi / flask です: {m}")
+    levels = [int(x) for x in args.concurrency.split(",") if x.strip()]
+
+    with open(args.image, "rb") as f:
+        image = f.read()
+    fake = start_fake_openai(args.fake_port, args)
+    try:
+        wait_for_port(args.fake_port)
+        print(f"chat_latency={args.latency_ms:.0f}ms image_latency={args.image_latency_ms:.0f}ms "
+              f"dist={args.latency_dist} error_rate={args.error_rate} malformed_rate={args.malformed_rate} "
+              f"cache={'on' if args.cache else 'off'}")
+        results = [run_mode(m, args, levels, image) for m in modes]
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    if args.json:
+        config = {k: getattr(args, k) for k in ("latency_ms", "image_latency_ms", "latency_dist", "latency_jitter",
+                                                "error_rate", "malformed_rate", "seed", "requests", "cache")}
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "modes": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
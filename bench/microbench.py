@@ -0,0 +1,259 @@
+"""
+LLM を呼ばない部分（ベイズ推定・質問選択・期待効用・プロンプト組み立て）のマイクロベンチマーク
+
+選択肢の全組み合わせ（purpose × vibe × age）と追加質問の回答を合成したフォームで
+各関数を回し、1呼び出しあたりの時間を JSON で出す。--check で保存済みのベースラインと
+比べて、許容幅を超えて遅くなった関数があれば終了コード 1 を返す。
+
+マシン差を打ち消すため、比較は固定の純 Python ループ（calibration）との比で行う。
+calibration は各関数の計測の前後に挟んで取り、全体の最小値を使う（途中でクロックが変わっても揃うように）。
+--check のときは --rounds が小さくても CHECK_MIN_ROUNDS ラウンドは回し、許容幅を超えた関数は
+CHECK_RETRIES 回まで測り直して一番速かった値で判定する（共有マシンの一時的な遅れで落ちないように）。
+--update-baseline は BASELINE_RUNS 回測って関数ごとに中央値の回を残す。NumPy の小さい配列演算が
+中心の関数（NUMPY_HEAVY）は割り当てや BLAS のスレッドで揺れやすいので許容幅を別に持つ。
+
+    python bench/microbench.py                    # 計測して表示
+    python bench/microbench.py --check            # bench/microbench_baseline.json と比較
+    python bench/microbench.py --update-baseline  # ベースラインを書き直す
+"""
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")  # import 時に OpenAI() を作るので
+
+import numpy as np  # noqa: E402
+
+import app  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, "bench", "microbench_baseline.json")
+CHECK_MIN_ROUNDS = 15
+CHECK_RETRIES = 2
+BASELINE_RUNS = 3
+CALIBRATION_LOOP = 100000
+NUMPY_HEAVY = {"bayes_update", "choose_next_question"}
+
+AGES = ["", "10代", "20代", "30代", "40代", "50代"]
+FREE_TEXTS = ["", "黒NG、ピンク系がいい", "ボルドーのマグネットを親指だけ、ラメなし、短め"]
+
+def subsets(values: list) -> list:
+    return [list(c) for r in range(len(values) + 1) for c in itertools.combinations(values, r)]
+
+def synthetic_forms(rng: random.Random) -> list:
+    """
+    purpose × vibe × age の全組み合わせ。追加質問はランダムに 0〜全部答えた状態にする
+    """
+    forms = []
+    for purpose, vibe, age in itertools.product(subsets(app.PRIOR_PURPOSES), subsets(app.PRIOR_VIBES), AGES):
+        form = {"age": age, "nail_duration": "3週間", "purpose": purpose, "vibe": vibe,
+                "avoid_colors": rng.choice(FREE_TEXTS)}
+        for qid, q in app.QUESTIONS.items():
+            if rng.random() < 0.5:
+                form[qid] = rng.choice(q["options"])["value"]
+        forms.append(form)
+    return forms
+
+def synthetic_free_spec(rng: random.Random) -> dict:
+    spec = app.empty_free_spec(rng.choice([0, 25, 45, 75]))
+    spec.update({"must": ["ピンク系"], "must_not": ["黒"], "keywords": ["ピンク", "ちゅるん"], "summary": "黒NG・ピンク系"})
+    return spec
+
+def synthetic_scores(rng: random.Random) -> dict:
+    return {ax: rng.randint(40, 95) for ax in app.AXES_BASE + [app.FREE_AXIS]}
+
+def build_cases(seed: int) -> dict:
+    """
+    関数名 -> (関数, 引数タプルのリスト)
+    """
+    rng = random.Random(seed)
+    forms = synthetic_forms(rng)
+    posts = [app.prior_from_selections(f) for f in forms]
+    answers = [(qid, o["value"]) for qid, q in app.QUESTIONS.items() for o in q["options"]]
+    personas = [app.PERSONA_REGISTRY.get(pid) for pid in app.PERSONA_REGISTRY.ids()]
+
+    def candidates(n):
+        ids = [f"{p['persona_id']}:{r}" for p in personas for r in "ABC"][:n] or list("ABC")[:n]
+        cands = [{"id": cid, "plan_ja": "シアーピンク"} for cid in ids]
+        return cands, {"results": [{"id": cid, "scores": synthetic_scores(rng)} for cid in ids]}
+
+    return {
+        "prior_from_selections": (app.prior_from_selections, [(f,) for f in forms]),
+        "bayes_update": (app.bayes_update, [
+            (post, form) + answers[i % len(answers)] for i, (post, form) in enumerate(zip(posts, forms))
+        ]),
+        "choose_next_question": (app.choose_next_question, list(zip(posts, forms))),
+        "expected_utility": (app.expected_utility, [
+            (synthetic_scores(rng), post, synthetic_free_spec(rng)) for post in posts
+        ]),
+        "pick_by_expected_utility": (app.pick_by_expected_utility, [
+            candidates(rng.choice([3, 3, 12])) + (post, synthetic_free_spec(rng)) for post in posts
+        ]),
+        "build_persona_candidate_prompt": (app.build_persona_candidate_prompt, [
+            ("ABC"[i % 3], personas[i % len(personas)], app.build_user_text(form),
+             app.build_selected_summary(form), synthetic_free_spec(rng))
+            for i, form in enumerate(forms)
+        ]),
+    }
+
+def time_calls(fn, cases: list, rounds: int) -> list:
+    """1ラウンド = 全ケースを1回ずつ。ラウンドごとの 1呼び出しあたり秒を返す（timeit と同じく GC は止める）"""
+    per_call = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            for args in cases:
+                fn(*args)
+            per_call.append((time.perf_counter() - t0) / len(cases))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return per_call
+
+def calibrate(rounds: int) -> float:
+    """このマシンの純 Python の速さの目安（固定ループ 1回あたり秒の最小値）"""
+    def loop():
+        acc = 0.0
+        for i in range(CALIBRATION_LOOP):
+            acc += (i % 7) * 0.5
+        return acc
+    return min(time_calls(loop, [()], rounds))
+
+def run(seed: int, rounds: int, only: list = None) -> dict:
+    cases = build_cases(seed)
+    results = {}
+    calibs = [calibrate(5)]
+    for name, (fn, args) in cases.items():
+        if only and name not in only:
+            continue
+        time_calls(fn, args, 1)  # ウォームアップ
+        xs = time_calls(fn, args, rounds)
+        calibs.append(calibrate(5))
+        results[name] = {
+            "calls": len(args),
+            "median_us": statistics.median(xs) * 1e6,
+            "min_us": min(xs) * 1e6,
+            "max_us": max(xs) * 1e6,
+        }
+    calib = min(calibs)
+    for r in results.values():
+        r["relative"] = r["min_us"] / (calib * 1e6)  # ノイズに強いので最小値同士で比べる
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "seed": seed,
+            "rounds": rounds,
+            "n_types": len(app.TYPE_SPACE),
+            "n_questions": len(app.QUESTIONS),
+            "n_options": sum(len(q["options"]) for q in app.QUESTIONS.values()),
+            "calibration_us": calib * 1e6,
+        },
+        "results": results,
+    }
+
+def median_run(runs: list) -> dict:
+    """関数ごとに relative が中央値だった回の結果を集めたもの（meta は最初の回）"""
+    results = {}
+    for name in runs[0]["results"]:
+        entries = sorted((r["results"][name] for r in runs), key=lambda e: e["relative"])
+        results[name] = entries[len(entries) // 2]
+    return {"meta": dict(runs[0]["meta"], runs=len(runs)), "results": results}
+
+def compare(current: dict, baseline: dict, tolerance: float, numpy_tolerance: float) -> list:
+    """
+    relative（calibration 比）が baseline の (1 + tolerance) 倍を超えた関数の一覧
+    NUMPY_HEAVY の関数は numpy_tolerance で見る
+    """
+    regressions = []
+    for name, cur in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        ratio = cur["relative"] / base["relative"] if base["relative"] > 0 else float("inf")
+        cur["vs_baseline"] = ratio
+        allowed = 1.0 + (numpy_tolerance if name in NUMPY_HEAVY else tolerance)
+        if ratio > allowed:
+            regressions.append((name, ratio, allowed))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", default="", help="カンマ区切りで関数を絞る")
+    parser.add_argument("--json", default="", help="結果の書き出し先（- なら標準出力）")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--check", action="store_true", help="ベースラインより遅くなっていたら終了コード 1")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する遅れ（0.25 = 25%%）")
+    parser.add_argument("--numpy-tolerance", type=float, default=0.5, help="NUMPY_HEAVY の関数に許容する遅れ")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    only = [x.strip() for x in args.only.split(",") if x.strip()]
+    rounds = max(args.rounds, CHECK_MIN_ROUNDS) if args.check or args.update_baseline else args.rounds
+    if rounds != args.rounds:
+        print(f"note: --check / --update-baseline なので {rounds} ラウンド回します", file=sys.stderr)
+    if args.update_baseline:
+        current = median_run([run(args.seed, rounds, only) for _ in range(BASELINE_RUNS)])
+    else:
+        current = run(args.seed, rounds, only)
+
+    regressions = []
+    if args.check:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        for key in ("n_types", "n_questions", "n_options"):
+            if baseline["meta"].get(key) != current["meta"][key]:
+                print(f"note: {key} が {baseline['meta'].get(key)} -> {current['meta'][key]}（入力の大きさが変わっています）",
+                      file=sys.stderr)
+        regressions = compare(current, baseline, args.tolerance, args.numpy_tolerance)
+        for retry in range(CHECK_RETRIES):
+            if not regressions:
+                break
+            names = [name for name, _, _ in regressions]
+            print(f"note: 測り直し {retry + 1}/{CHECK_RETRIES}: {', '.join(names)}", file=sys.stderr)
+            again = run(args.seed, rounds, names)
+            for name, r in again["results"].items():
+                if r["relative"] < current["results"][name]["relative"]:
+                    current["results"][name] = r
+            regressions = compare(current, baseline, args.tolerance, args.numpy_tolerance)
+
+    meta = current["meta"]
+    print(f"python={meta['python']} numpy={meta['numpy']} calibration={meta['calibration_us']:.0f}us "
+          f"types={meta['n_types']} questions={meta['n_questions']}", file=sys.stderr)
+    print(f"{'function':<32} {'calls':>6} {'median_us':>10} {'min_us':>10} {'relative':>9} {'vs_base':>8}", file=sys.stderr)
+    for name, r in current["results"].items():
+        vs = f"{r['vs_baseline']:.2f}x" if "vs_baseline" in r else "-"
+        print(f"{name:<32} {r['calls']:>6} {r['median_us']:>10.2f} {r['min_us']:>10.2f} {r['relative']:>9.5f} {vs:>8}",
+              file=sys.stderr)
+
+    if args.json == "-":
+        json.dump(current, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+
+    if regressions:
+        for name, ratio, allowed in regressions:
+            print(f"REGRESSION {name}: {ratio:.2f}x（許容 {allowed:.2f}x）", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
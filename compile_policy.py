@@ -0,0 +1,48 @@
+"""
+追加質問のポリシーテーブル（question_policy.npz）をオフラインで作る / 検証する
+
+    python compile_policy.py                      # 全状態を列挙して書き出す
+    python compile_policy.py --verify             # 書き出し済みのテーブルをライブ計算と全件照合
+    python compile_policy.py --verify --sample 5000
+
+質問・タイプ・事前分布・閾値（ASK_MORE_ENTROPY）を変えたら作り直すこと
+（前提が変わったテーブルは起動時に読み捨てられ、ライブ計算に戻る）。
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+import app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=app.QUESTION_POLICY_PATH)
+    parser.add_argument("--verify", action="store_true", help="コンパイルせずに既存テーブルを検証する")
+    parser.add_argument("--sample", type=int, default=0, help="検証する状態数（0なら全件）")
+    args = parser.parse_args()
+
+    n_states = app.N_PRIOR_KEYS * app.N_ANSWER_KEYS
+    if args.verify:
+        policy = app.QuestionPolicy.load(args.out)
+        if policy is None:
+            sys.exit(f"{args.out} がないか、今のコードと前提が合いません。作り直してください")
+        t0 = time.perf_counter()
+        mismatches = app.verify_question_policy(policy, sample=args.sample)
+        checked = args.sample or n_states
+        print(f"checked {checked} states in {time.perf_counter() - t0:.1f}s, mismatches={len(mismatches)}")
+        for m in mismatches[:10]:
+            print(m)
+        sys.exit(1 if mismatches else 0)
+
+    t0 = time.perf_counter()
+    policy = app.compile_question_policy()
+    policy.save(args.out)
+    print(f"wrote {args.out}: {n_states} states "
+          f"({app.N_PRIOR_KEYS} priors x {app.N_ANSWER_KEYS} answer sets) in {time.perf_counter() - t0:.1f}s, "
+          f"{os.path.getsize(args.out)} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+finalize ジョブ（?job=1 で積まれたもの）を Web プロセスとは別に回すワーカー
+
+    JOB_WORKERS=0 uvicorn asgi_app:app ...        # Web 側は積むだけ
+    SESSION_BACKEND=sqlite python job_worker.py --workers 4
+
+JOB_DB_PATH / JOB_BLOB_DIR は Web 側と同じものを指すこと。画像の作り直し（retry_image）で
+使う結果もワーカー側で保存されるので、SESSION_BACKEND=sqlite で共有する。
+"""
+import argparse
+import signal
+import threading
+
+import app
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=max(1, app.JOB_WORKERS))
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    queue = app.job_queue()
+    pool = app.JobWorkers(queue, args.workers)
+    pool.start()
+    print(f"job workers={args.workers} db={app.JOB_DB_PATH}")
+    while not stop.wait(60):
+        queue.cleanup()
+        app.cleanup_sessions()
+    pool.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+@pytest.fixture
+def queue(tmp_path):
+    return app.JobQueue(str(tmp_path / "jobs.sqlite3"), str(tmp_path / "blobs"), lease_sec=0.2, max_attempts=3)
+
+def test_claimed_job_is_not_claimed_again_while_leased(queue):
+    job_id = queue.submit(b"img", {"k": "v"})
+    got = queue.claim()
+    assert got[0] == job_id and got[2] == b"img" and got[3] == {"k": "v"}
+    assert queue.claim() is None
+    assert queue.get(job_id)["status"] == "running"
+
+def test_expired_lease_is_reclaimed_once_and_stale_writes_are_ignored(queue):
+    job_id = queue.submit(b"img", {})
+    _, first, _, _ = queue.claim()
+    time.sleep(0.25)
+    _, second, _, _ = queue.claim()
+    assert second == first + 1
+    assert queue.claim() is None  # 取り直したあとは、その lease の間は誰も取れない
+
+    # 遅れて戻ってきた最初の worker の書き込みは通らない
+    assert not queue.heartbeat(job_id, first)
+    assert not queue.finish(job_id, first, {"from": "stale"})
+    assert queue.finish(job_id, second, {"from": "current"})
+    job = queue.get(job_id)
+    assert job["status"] == "done" and job["result"] == {"from": "current"} and job["attempts"] == 2
+    time.sleep(0.25)
+    assert queue.claim() is None
+
+def test_concurrent_claims_take_each_job_once(queue):
+    ids = {queue.submit(b"img", {}) for _ in range(8)}
+    claimed, lock = [], threading.Lock()
+
+    def worker():
+        while True:
+            got = queue.claim()
+            if got is None:
+                return
+            with lock:
+                claimed.append(got[0])
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(claimed) == sorted(ids)
+
+def test_defer_waits_without_using_an_attempt(queue):
+    job_id = queue.submit(b"img", {})
+    _, claim, _, _ = queue.claim()
+    assert queue.defer(job_id, claim, 0.2, "busy")
+    job = queue.get(job_id)
+    assert job["status"] == "queued" and job["attempts"] == 0
+    assert queue.claim() is None
+    time.sleep(0.25)
+    got = queue.claim()
+    assert got[0] == job_id and got[1] == claim + 1
+    assert queue.get(job_id)["attempts"] == 1
+
+def test_failed_attempts_retry_until_max(queue):
+    job_id = queue.submit(b"img", {})
+    for _ in range(3):
+        _, claim, _, _ = queue.claim()
+        queue.fail(job_id, claim, "boom")
+    job = queue.get(job_id)
+    assert job["status"] == "failed" and job["error"] == "boom"
+    assert queue.claim() is None
+
+def test_submit_is_bounded_by_max_queued(queue, monkeypatch):
+    monkeypatch.setattr(app, "JOB_MAX_QUEUED", 2)
+    queue.submit(b"img", {})
+    queue.submit(b"img", {})
+    assert queue.overloaded() is not None
+    with pytest.raises(app.UpstreamBusy):
+        queue.submit(b"img", {})
+
+def test_job_queue_is_built_on_first_use(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "_JOB_QUEUE", None)
+    monkeypatch.setattr(app, "JOB_DB_PATH", str(tmp_path / "lazy.sqlite3"))
+    monkeypatch.setattr(app, "JOB_BLOB_DIR", str(tmp_path / "lazy_blobs"))
+    assert not (tmp_path / "lazy.sqlite3").exists()
+    assert app.job_queue() is app.job_queue()
+    assert (tmp_path / "lazy.sqlite3").exists()
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+CUT_FREE_SPEC = '{"must": ["黒"], "must_not": ["白", "ピ'
+CUT_EVAL = '{"results": [{"id": "A", "scores": {"x": 1}}, {"id": "B", "sco'
+
+def test_fences_prose_and_trailing_commas():
+    assert app.safe_extract_json('```json\n{"a": 1, "b": [1, 2]}\n```') == {"a": 1, "b": [1, 2]}
+    assert app.safe_extract_json('説明 {x} です。\n{"a": 1} 以上') == {"a": 1}
+    assert app.safe_extract_json('{"a": 1, "b": 2,}') == {"a": 1, "b": 2}
+    with pytest.raises(ValueError):
+        app.safe_extract_json("no json here")
+
+def test_truncated_json_is_repaired_by_default():
+    assert app.safe_extract_json(CUT_FREE_SPEC) == {"must": ["黒"], "must_not": ["白", "ピ"]}
+
+def test_drop_cut_field_keeps_only_finished_fields():
+    assert app.safe_extract_json(CUT_FREE_SPEC, drop_cut_field=True) == {"must": ["黒"]}
+    assert app.safe_extract_json(CUT_EVAL, drop_cut_field=True) == {}
+
+def test_strict_rejects_truncated_json():
+    with pytest.raises(app.TruncatedJsonError):
+        app.safe_extract_json(CUT_EVAL, strict=True)
+    assert app.safe_extract_json('{"a": 1}', strict=True) == {"a": 1}
+
+def test_stream_parser_stops_at_the_first_object():
+    p = app.JsonStreamParser()
+    assert not p.feed('{"a": "x{')
+    assert p.partial() == {"a": "x{"} and p.fields() == {}
+    assert not p.feed('}", "b": [1')
+    assert p.fields() == {"a": "x{}"}
+    assert p.feed(', 2]} 解説 {"c": 1}')
+    assert p.partial() == {"a": "x{}", "b": [1, 2]}
+
+def test_cut_off_reads_finish_reason():
+    def res(reason):
+        return SimpleNamespace(choices=[SimpleNamespace(finish_reason=reason)])
+    assert app.cut_off(res("length"))
+    assert not app.cut_off(res("stop"))
+    assert not app.cut_off(SimpleNamespace(choices=[]))
+
+def test_stage_parsers_do_not_use_truncated_replies():
+    assert app.parse_eval(CUT_EVAL)["results"] == []
+    assert "parse_error" in app.parse_eval('{"results": []}', truncated=True)
+    assert app.parse_edit_prompt('{"edit_prompt_en": "pink nails"}') == "pink nails"
+    assert app.parse_edit_prompt('{"edit_prompt_en": "pink nails"}', truncated=True) is None
+    assert app.parse_edit_prompt('{"edit_prompt_en": "pink na') is None
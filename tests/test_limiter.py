@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app
+
+def limiter(cap: int, max_queue: int = 64, max_wait_sec: float = 5.0) -> app.UpstreamLimiter:
+    return app.UpstreamLimiter("test", max_concurrency=cap, rpm=0, tpm=0, max_queue=max_queue, max_wait_sec=max_wait_sec)
+
+def test_inflight_never_exceeds_cap():
+    lim = limiter(3)
+    lock = threading.Lock()
+    seen = {"now": 0, "max": 0}
+
+    def work():
+        lim.acquire()
+        try:
+            with lock:
+                seen["now"] += 1
+                seen["max"] = max(seen["max"], seen["now"])
+            time.sleep(0.005)
+            with lock:
+                seen["now"] -= 1
+        finally:
+            lim.release()
+
+    threads = [threading.Thread(target=work) for _ in range(24)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert seen["max"] == 3
+    assert lim.inflight == 0 and lim.waiting == 0
+
+def test_release_hands_the_slot_to_an_async_waiter():
+    lim = limiter(1)
+    lim.acquire()
+
+    async def main():
+        waiter = asyncio.ensure_future(lim.acquire_async())
+        await asyncio.sleep(0.02)
+        assert not waiter.done()
+        threading.Thread(target=lim.release).start()  # Flask のスレッドから返す
+        await asyncio.wait_for(waiter, 1.0)
+
+    asyncio.run(main())
+    assert lim.inflight == 1
+    lim.release()
+    assert lim.inflight == 0
+
+def test_cancelled_async_waiter_passes_the_wakeup_on():
+    lim = limiter(1)
+    lim.acquire()
+
+    async def main():
+        first = asyncio.ensure_future(lim.acquire_async())
+        second = asyncio.ensure_future(lim.acquire_async())
+        await asyncio.sleep(0.02)
+        lim.release()
+        first.cancel()
+        await asyncio.wait_for(second, 1.0)
+
+    asyncio.run(main())
+    assert lim.inflight == 1 and lim.waiting == 0
+
+def test_full_queue_is_rejected():
+    lim = limiter(1, max_queue=0)
+    lim.acquire()
+    with pytest.raises(app.UpstreamBusy):
+        lim.acquire()
+    lim.release()
+
+def test_try_acquire_does_not_wait_or_jump_the_queue():
+    lim = limiter(1)
+    assert lim.try_acquire()
+    assert not lim.try_acquire()
+    lim.release()
+    lim.waiting = 1  # 本命の呼び出しが枠を待っている
+    assert not lim.try_acquire()
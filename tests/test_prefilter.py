@@ -0,0 +1,48 @@
+import app
+
+def terms(avoid_colors: str, **free_spec) -> dict:
+    return app.prefilter_terms(dict(app.empty_free_spec(), **free_spec), {"avoid_colors": avoid_colors})
+
+def candidate(cid: str, plan: str) -> dict:
+    return {"id": cid, "plan_ja": plan, "style_hint": "test"}
+
+def test_wanted_colour_is_not_ng_because_of_kawaii():
+    t = terms("ピンクでかわいいやつがいい")
+    assert t["must_not"] == []
+
+def test_window_stops_at_contrast_and_next_term():
+    t = terms("黒がいいけど白はNG", must=["黒"])
+    assert t["must_not"] == ["白"]
+    assert t["must"] == ["黒"]
+
+def test_ng_covers_listed_terms():
+    assert terms("黒や白はNG")["must_not"] == ["白", "黒"]
+    assert terms("黒NG、ピンク系がいい")["must_not"] == ["黒"]
+    assert terms("ラメなし")["must_not"] == ["ラメ"]
+    assert terms("黒が苦手")["must_not"] == ["黒"]  # 主語の「が」では切らない
+
+def test_single_kanji_inside_compound_is_not_a_mention():
+    assert not app.mentions("面白い質感のベージュ", "白")
+    assert app.mentions("白ベースにベージュ", "白")
+    assert not app.mentions("白は使わずにベージュ", "白")
+
+def test_inferred_terms_are_marked():
+    t = terms("黒NG", must_not=["ラメ"])
+    assert t["must_not"] == ["ラメ", "黒"]
+    assert t["inferred"] == ["黒"]
+
+def test_inferred_never_overrides_free_spec_must():
+    t = terms("黒NG", must=["黒"])
+    assert t["must"] == ["黒"] and t["must_not"] == []
+
+def test_judge_not_skipped_when_only_inferred_ng_dropped_candidates():
+    cands = [candidate("A", "黒のマグネット"), candidate("B", "ネイビーのフレンチ"), candidate("C", "黒フレンチ")]
+    pre = app.local_prefilter(cands, app.empty_free_spec(), {"avoid_colors": "黒NG"})
+    assert [c["id"] for c in pre["survivors"]] == ["B"]
+    assert pre["inferred_drop"]
+
+def test_free_spec_must_not_drop_allows_judge_skip():
+    cands = [candidate("A", "黒のマグネット"), candidate("B", "ネイビーのフレンチ")]
+    pre = app.local_prefilter(cands, dict(app.empty_free_spec(), must_not=["黒"]), {"avoid_colors": "黒NG"})
+    assert [c["id"] for c in pre["survivors"]] == ["B"]
+    assert not pre["inferred_drop"]
@@ -0,0 +1,46 @@
+import os
+import sqlite3
+
+import app
+
+def store(tmp_path, ttl_sec: float) -> app.SqliteSessionStore:
+    return app.SqliteSessionStore(ttl_sec, str(tmp_path / "sessions.sqlite3"), str(tmp_path / "blobs"))
+
+def test_roundtrip_and_single_pop(tmp_path):
+    s = store(tmp_path, 60)
+    s.put("tok", {"img_bytes": b"img", "form": {"age": "20代"}, "asked": 1})
+    assert s.exists("tok")
+    assert s.get("tok") == {"img_bytes": b"img", "form": {"age": "20代"}, "asked": 1}
+    assert s.pop("tok")["img_bytes"] == b"img"
+    assert s.pop("tok") is None
+    assert os.listdir(tmp_path / "blobs") == []
+
+def test_expired_sessions_are_invisible(tmp_path):
+    expired = store(tmp_path, -1)
+    expired.put("old", {"img_bytes": b"img"})
+    assert not expired.exists("old")
+    assert expired.get("old") is None
+    assert expired.pop("old") is None
+
+def test_cleanup_removes_oldest_expired_first_in_batches(tmp_path):
+    live = store(tmp_path, 60)
+    live.put("live", {"img_bytes": b"img"})
+    for i, ttl in enumerate((-30, -20, -10)):
+        store(tmp_path, ttl).put(f"old{i}", {"img_bytes": b"img"})
+
+    live.cleanup(limit=2)
+    with sqlite3.connect(tmp_path / "sessions.sqlite3") as con:
+        left = sorted(r[0] for r in con.execute("SELECT token FROM sessions"))
+    assert left == ["live", "old2"]
+    live.cleanup()
+    assert live.stats() == {"sessions": 1}
+    assert sorted(os.listdir(tmp_path / "blobs")) == ["sessions_live.bin"]
+
+def test_cleanup_uses_the_expires_index(tmp_path):
+    s = store(tmp_path, 60)
+    with sqlite3.connect(s.db_path) as con:
+        plan = con.execute(
+            "EXPLAIN QUERY PLAN SELECT token, blob_path FROM sessions WHERE expires <= ? ORDER BY expires LIMIT ?",
+            (0, 1)
+        ).fetchall()
+    assert any("sessions_expires" in row[-1] for row in plan)
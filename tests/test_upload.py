@@ -0,0 +1,26 @@
+import io
+
+import pytest
+
+import app
+
+FAKE_HEIC = b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic" + b"\x00" * 64
+
+def test_heif_brands_are_detected():
+    assert app.is_heif(FAKE_HEIC)
+    assert app.is_heif(b"\x00\x00\x00\x18ftypmif1" + b"\x00" * 16)
+    assert not app.is_heif(b"\x89PNG\r\n\x1a\n" + b"\x00" * 16)
+
+def test_unreadable_heic_is_an_input_error():
+    with pytest.raises(app.GameInputError):
+        app.preprocess_upload(FAKE_HEIC)
+
+def test_heic_is_converted_to_jpeg():
+    pytest.importorskip("pillow_heif")
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (300, 200), "pink").save(buf, "HEIF")
+    out = app.preprocess_upload(buf.getvalue())
+    assert app.image_filename(out) == "nail.jpg"
+    assert out[:3] == b"\xff\xd8\xff"